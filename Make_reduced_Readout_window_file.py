@@ -6,45 +6,21 @@
 # If not interactive, use command line arguments, with defaults.
 
 # %%
-from ctapipe.io import EventSource,DataWriter
-from ctapipe import utils
-from matplotlib import pyplot as plt
-import numpy as np
-# %matplotlib inline
+from ctapipe.io import EventSource
 
-# %%
-from ctapipe.visualization import CameraDisplay
-from ctapipe.coordinates import EngineeringCameraFrame
-from ctapipe.calib import CameraCalibrator
-from ctapipe.instrument import SoftwareTrigger
-from ctapipe.image import tailcuts_clean
-
-# %%
-from ctapipe.image import (
-     ImageProcessor,
-     camera_to_shower_coordinates,
-     concentration_parameters,
-     hillas_parameters,
-     leakage_parameters,
-     number_of_islands,
-     timing_parameters,
-     toymodel,
- )
-from traitlets.config import Config
-from ctapipe.reco import ShowerProcessor
-
-# %%
-from astropy import units as u
+# %% [markdown]
+# Plotting (matplotlib, ctapipe.visualization) is only imported where needed (with `--display`), batch jobs don't use it.
+# The processing itself is in file_processing.py.
 
 # %%
-from astropy.coordinates import AltAz, angular_separation
+from ctapipe.calib import CameraCalibrator
 
 # %%
 import os
 import sys
 
 # %%
-from glob import glob,iglob
+from glob import glob
 
 # %%
 import argparse
@@ -63,7 +39,28 @@ if hasattr(sys,'ps1'):
     site = "LaPalma"
     particle = "gamma-diffuse"
     ReduceWindow = True
+    ShowDisplay = True
+    BothWindows = False
+    ContiguousWindow = False
+    DropR0 = False
+    PeakWindow = False
+    Batched = False
+    Triage = None
+    TimingByType = False
     start_run = 0
+    workers = 1
+    shards = 1
+    throughput_every = None
+    sample_events = 5
+    Histograms = True
+    read_ahead = 0
+    STAGE_DIR = None
+    OutputProfile = "full"
+    Reprocess = False
+    VerifyChecksums = False
+    MergeSplits = False
+    MERGED_DIR = None
+    WindowScan = None
 else:
     parser = argparse.ArgumentParser(
                     prog='Make_reduced_Readout_window',
@@ -76,15 +73,80 @@ else:
                        nargs='?', default='gamma')
     parser.add_argument("--reduced-window","-r",action=argparse.BooleanOptionalAction,
                         default=True,help="Hardwired reduced window, or standard as simulated")
+    parser.add_argument("--display",action="store_true",
+                        help="Show the subarray before processing (default: headless, fast start)")
+    parser.add_argument("--both-windows",action="store_true",
+                        help="Write both the standard and the reduced window outputs, reading each file only once")
+    parser.add_argument("--contiguous-window",action="store_true",
+                        help="Copy reduced windows to compact arrays, rather than keeping views of the full windows")
+    parser.add_argument("--drop-r0",action="store_true",
+                        help="Drop R0 waveforms when reducing the window (R1 is used for calibration)")
+    parser.add_argument("--peak-window",action="store_true",
+                        help="Place the reduced window of each telescope event around its waveform peak")
+    parser.add_argument("--batched",action="store_true",
+                        help="Calibrate and clean the telescopes of the same type of each event together")
+    parser.add_argument("--triage",choices=["skip","validate"],default=None,
+                        help="Skip the calibration of telescopes whose image can't pass the image quality query "
+                             "(validate: process them anyway and count the disagreements)")
+    parser.add_argument("--timing-by-type",action="store_true",
+                        help="Also time the calibrator and image processor per telescope type (some overhead)")
     parser.add_argument("--start-run",type=int,
                         default=0,help="Start from a given run-number, ignoring previous")
+    parser.add_argument("--workers","-j",type=int,
+                        default=1,help="Number of files processed in parallel by a pool of worker processes")
+    parser.add_argument("--shards",type=int,default=1,
+                        help="Split the events of each file across this many processes (for each worker)")
+    parser.add_argument("--throughput-every",type=float,default=None,metavar="SECONDS",
+                        help="Print the number of events/s read, every this many seconds")
+    parser.add_argument("--sample-events",type=int,default=0,metavar="N",
+                        help="Keep N random events (10+ telescopes) in each output, for the array display at the end")
+    parser.add_argument("--histograms",action="store_true",
+                        help="Write running θ²/energy, multiplicity and intensity histograms in each output")
+    parser.add_argument("--read-ahead",type=int,default=0,metavar="N",
+                        help="Read (decompress, decode) events in a background thread, up to N events ahead")
+    parser.add_argument("--stage-dir",default=None,
+                        help="Copy the next input files to this (local scratch) directory while processing")
+    parser.add_argument("--output-profile",default="full",
+                        help="Output profile of output_profiles.yml: full (default), or compact (training columns, float32)")
+    parser.add_argument("--reprocess",action="store_true",
+                        help="Process all files, even those recorded as done in the manifest")
+    parser.add_argument("--verify-checksums",action="store_true",
+                        help="Only skip files whose outputs still match the checksums in the manifest")
+    parser.add_argument("--merge-splits",action="store_true",
+                        help="Append each output to its merged dataset file (see dataset_splits.yml) as soon as it is written")
+    parser.add_argument("--merged-dir",default=None,
+                        help="Directory of the merged dataset files (default: parent of OUT_DIR)")
+    parser.add_argument("--window-scan",nargs="?",const="window_scan.yml",default=None,metavar="FILE",
+                        help="Write an output for each readout window of FILE (default window_scan.yml), "
+                             "decoding each event once (with --both-windows, also the standard window)")
     args = parser.parse_args()
     #print("args:",args)
     
     site = args.site
     particle = args.particle
     ReduceWindow = True if args.reduced_window else False
+    ShowDisplay = args.display
+    BothWindows = args.both_windows
+    ContiguousWindow = args.contiguous_window
+    DropR0 = args.drop_r0
+    PeakWindow = args.peak_window
+    Batched = args.batched
+    Triage = args.triage
+    TimingByType = args.timing_by_type
     start_run = args.start_run
+    workers = args.workers
+    shards = args.shards
+    throughput_every = args.throughput_every
+    sample_events = args.sample_events
+    Histograms = args.histograms
+    read_ahead = args.read_ahead
+    STAGE_DIR = args.stage_dir
+    OutputProfile = args.output_profile
+    Reprocess = args.reprocess
+    VerifyChecksums = args.verify_checksums
+    MergeSplits = args.merge_splits
+    MERGED_DIR = args.merged_dir
+    WindowScan = args.window_scan
     if particle not in ["gamma", "gamma-diffuse", "proton", "electron"]:
         print(f"Error:\n" 
               f"  Particle type \"{particle}\" unknown. \n"
@@ -103,9 +165,25 @@ try:
 except KeyError:
     OUT_DIR = "/scr/punch/CTA/Prod6/LaPalma/2025/"+f"{particle}/"
 
+# %%
+if WindowScan is not None:
+    import yaml
+    from window_names import SCAN_PREFIX
+
+    with open(WindowScan) as stream:
+        window_scan = yaml.safe_load(stream)
+    windows = ["std"] if BothWindows else []
+    windows += [SCAN_PREFIX + name for name in window_scan["WindowScan"]]
+elif BothWindows:
+    windows = ["std", "red"]
+else:
+    windows = ["red"] if ReduceWindow else ["std"]
+
 # %%
 print("Running with:\n",
-      site,particle,"ReducedWindow" if ReduceWindow else "StandardWindow","\n",
+      site,particle,
+      f"WindowScan ({len(windows)} windows)" if WindowScan is not None else
+      "StandardWindow+ReducedWindow" if BothWindows else "ReducedWindow" if ReduceWindow else "StandardWindow","\n",
       PROD_DIR,"\n",OUT_DIR)
 
 # %% [markdown]
@@ -172,26 +250,33 @@ else:
                   58,59,60,61,62,63,64,65,66,67,68,69,70,71,72,73,74,75,76,77]  # Maybe should stop at (including) 74?? https://github.com/Eventdisplay/Eventdisplay_AnalysisFiles_CTA/blob/a534e533199b0305b86d4006956f032388636b56/DetectorGeometry/CTA.prod6S.Am-0LSTs14MSTs37SSTs.lis#L4
 
 
+# %% [markdown]
+# The subarray is read once from the first file, then taken from a cache in OUT_DIR (one per production, i.e. site and layout, and telescope list).
+
 # %%
-source = EventSource(first_file,allowed_tels=tels_alpha)
-#source = EventSource(proton_file)
+from file_processing import load_subarray
 
+# %%
+subarray = load_subarray(first_file, tels_alpha, OUT_DIR)
 
 # %%
-source.allowed_tels
+subarray
 
 # %%
-#sub_alpha = source.subarray.select_subarray(tel_ids=tels_alpha)
-#sub_alpha = source.subarray.select_subarray(tel_ids=[2,3,4])
-#ArrayDisplay(sub_alpha)
-#sub_alpha.peek()
-source.subarray.peek()
-plt.xlim([-300,400])
-plt.ylim([-350,350])
-#
-plt.show(block=False)
-from time import sleep
-sleep(10)
+if ShowDisplay:
+    from matplotlib import pyplot as plt
+    #sub_alpha = source.subarray.select_subarray(tel_ids=tels_alpha)
+    #sub_alpha = source.subarray.select_subarray(tel_ids=[2,3,4])
+    #ArrayDisplay(sub_alpha)
+    #sub_alpha.peek()
+    subarray.peek()
+    plt.xlim([-300,400])
+    plt.ylim([-350,350])
+    #
+    plt.show(block=False)
+    if not hasattr(sys,'ps1'):
+        from time import sleep
+        sleep(10)
 
 # %% [markdown]
 # ## From https://ctapipe.readthedocs.io/en/v0.20.0/auto_examples/tutorials/ctapipe_overview.html
@@ -199,43 +284,19 @@ sleep(10)
 # But, thresholds taken from ctapipe-process base_config.yaml
 #
 # And subarray as sub_alpha
+#
+# (Only a look at the first event when interactive, batch jobs go straight to the main loop.)
 
 # %%
-source = EventSource(first_file,allowed_tels=tels_alpha)
-#source = EventSource(proton_file)
-
-# %%
-source = EventSource(first_file,allowed_tels=tels_alpha)
-event_iter = iter(source)
-
-# %%
-source.subarray
-
-# %%
-tels_alpha
-
-# %%
-#sub_alpha = source.subarray.select_subarray(tels_alpha)
-
-# %%
-#sub_alpha
-
-# %%
-event = next(event_iter)
-
-# %%
-event.trigger.tels_with_trigger
-
-# %%
-calibrator = CameraCalibrator(subarray=source.subarray)
-
-# %%
-
-# %%
-calibrator(event)
-
-# %%
-source.close()
+if hasattr(sys,'ps1'):
+    source = EventSource(first_file,allowed_tels=tels_alpha)
+    #source = EventSource(proton_file)
+    event_iter = iter(source)
+    event = next(event_iter)
+    print(event.trigger.tels_with_trigger)
+    calibrator = CameraCalibrator(subarray=source.subarray)
+    calibrator(event)
+    source.close()
 
 # %% [markdown]
 # ## Main Loop
@@ -270,157 +331,191 @@ with open("dl1_to_dl2.yml") as stream:
         print(exc)
 
 # %%
-from copy import deepcopy
+with open("readout_windows.yml") as stream:
+    try:
+        readout_windows = yaml.safe_load(stream)
+        if hasattr(sys,'ps1'):
+            pprint(readout_windows)
+    except yaml.YAMLError as exc:
+        print(exc)
+
+# %%
+if ContiguousWindow:
+    readout_windows["ReadoutWindowReducer"]["contiguous"] = True
+if DropR0:
+    readout_windows["ReadoutWindowReducer"]["drop_r0"] = True
+if PeakWindow:
+    readout_windows["ReadoutWindowReducer"]["mode"] = "peak"
+if Batched:
+    # See batched_calibration.py
+    dl1_to_dl2["batched"] = True
+if Triage is not None:
+    # See image_triage.py
+    dl1_to_dl2["triage"] = Triage
+if TimingByType:
+    # See stage_timing.py
+    dl1_to_dl2["timing_by_type"] = True
 
+# %% [markdown]
+# With `--window-scan`, each window of `window_scan.yml` gets its own branch of each event, and its own output.
+# The branches are views of the same decoded waveforms, so do not use `--contiguous-window`, which would copy them for each window.
 
 # %%
-def ReadoutWindowReducer(event,subarray):
-    """
-    Fixed Readout Window Reducer
-    (Fixed over all camera)
-    Reduce the readout window for MSTs and LSTs.
-    Hardcoded for now, with for MSTs [12:27] and LSTs [10:30],
-    so a reduction of a factor of 4 for MST-NectarCAM, and factor 2 for LST
-    """
+if WindowScan is not None:
+    from readout_window import scan_window_configs
 
-    for tel_id in event.trigger.tels_with_trigger:
-        # Maybe this would be faster? tel in subarray.get_tel_ids_for_type("MST_MST_NectarCam"):
-        cam_name_lower = source.subarray.tel[tel_id].camera_name.lower()
-        if "nectarcam" == cam_name_lower:
-            event.r0.tel[tel_id].waveform = event.r0.tel[tel_id].waveform[:, :, 12:27]
-            event.r1.tel[tel_id].waveform = event.r1.tel[tel_id].waveform[:, :, 12:27]
-        elif "lstcam" == cam_name_lower: 
-            event.r0.tel[tel_id].waveform = event.r0.tel[tel_id].waveform[:, :, 10:30]
-            event.r1.tel[tel_id].waveform = event.r1.tel[tel_id].waveform[:, :, 10:30]
-        else:
-            print(f"For {tel_id}, unknown camera type {source.subarray.tel[tel_id].camera_name}!!!")
+    if ContiguousWindow:
+        print("Warning: --contiguous-window copies the waveforms for each window of the scan")
+    readout_windows["WindowScan"] = scan_window_configs(readout_windows, window_scan)
 
+# %% [markdown]
+# The output profile (`--output-profile`, see `output_profiles.yml`) sets what is written:
+# "full" as DataWriter does by default, "compact" only the dl1 parameters read by the `train_*.yml` configurations, as float32, with more compression.
+
+# %%
+from output_profile import load_output_profile
+
+output_profile = load_output_profile(OutputProfile)
+if hasattr(sys,'ps1'):
+    pprint(output_profile)
 
 # %%
 from pathlib import Path
 
 # %%
-for num_file,in_file in enumerate(simtel_files[start_index:]):
-    
-    #for ReduceWindow in [False,True]:
-
-        in_path = Path(in_file)
-        print(f"File {num_file+1+start_index} of {len(simtel_files)}:",
-              in_path.stem,"ReducedWindow" if ReduceWindow else "StandardWindow")
-
-        out_file = in_path.stem[:-7]
-        
-        #ReduceWindow = True # False # 
-        
-        out_file = OUT_DIR+out_file
-        if ReduceWindow:
-           out_file += ".redwindow.h5"
-        else:
-           out_file += ".stdwindow.h5"
-        
-        source = EventSource(in_file,allowed_tels=tels_alpha)
-        
-        image_processor_config = Config(dl1_to_dl2["ImageProcessor"])
-        shower_processor_config = Config(dl1_to_dl2["ShowerProcessor"])
-        software_trigger_config = Config(dl1_to_dl2["SoftwareTrigger"])
-                                     
-        software_trigger = SoftwareTrigger(subarray=source.subarray, config=software_trigger_config)
-        
-        calibrator = CameraCalibrator(subarray=source.subarray)
-        
-        image_processor = ImageProcessor(
-             subarray=source.subarray, config=image_processor_config
-        )
-        
-        shower_processor = ShowerProcessor(subarray=source.subarray)
-        horizon_frame = AltAz()
-        
-        with DataWriter(source, output_path=out_file, overwrite=True, write_dl1_parameters=True, write_dl2=True) as writer:
-        
-             for event in source:
-                 event_count = event.count
-                 if not event_count%1000:
-                     print(event_count, end=" ")
-                 if software_trigger(event):
-                     if ReduceWindow:
-                         ReadoutWindowReducer(event,subarray=source.subarray)
-                     calibrator(event)
-                     image_processor(event)
-                     shower_processor(event)
-        
-                     writer(event)
-        
-                     if len(event.trigger.tels_with_trigger) > 9:
-                         plotting_event = deepcopy(event)
-
-             # Added to get the shower distribution histograms in the file
-             writer.write_simulated_shower_distributions(source.simulated_shower_distributions)
-             print()
+from file_processing import output_file_name, process_files
+from manifest import Manifest
 
 # %% [markdown]
-# ## Show some results on the last file
+# The manifest (in OUT_DIR) records the status, event counts, size and checksum of each output.
+# Files whose outputs are all done are skipped, others (failed, or killed half-way) are processed again.
 
 # %%
-from ctapipe.io import DataWriter, EventSource, TableLoader
+manifest = Manifest(os.path.join(OUT_DIR, "processing_manifest.json"))
+todo_files = [
+    in_file for in_file in simtel_files[start_index:]
+    if Reprocess or not manifest.is_done(
+        in_file, {window: output_file_name(in_file, OUT_DIR, window) for window in windows},
+        verify_checksum=VerifyChecksums,
+    )
+]
+if len(todo_files) < len(simtel_files[start_index:]):
+    print(f"Skipping {len(simtel_files[start_index:]) - len(todo_files)} file(s) already done (see {manifest.path}).")
+
+# %% [markdown]
+# With `--merge-splits`, the files are split into datasets as in `dataset_splits.yml` (e.g. gamma-diffuse 4x10: train_en, train_cls, optimize_cuts, irfs),
+# and each output is appended to its merged file (`<prefix>_merged_<purpose>.<std|red>.dl2.h5` in MERGED_DIR) as soon as it is written.
+# Outputs already done, but not merged yet, are merged first.
 
 # %%
-loader = TableLoader(out_file)
-events = loader.read_subarray_events()
+merger = None
+if MergeSplits:
+    from split_merge import StreamingMerger
+
+    with open("dataset_splits.yml") as stream:
+        dataset_splits = yaml.safe_load(stream)
+    if MERGED_DIR is None:
+        MERGED_DIR = str(Path(OUT_DIR).parent)
+    merger = StreamingMerger(dataset_splits, particle, simtel_files, MERGED_DIR, manifest)
+    merger.catch_up(windows, lambda in_file, window: output_file_name(in_file, OUT_DIR, window))
+
+# %% [markdown]
+# Each file gets its own EventSource/CameraCalibrator/ImageProcessor/ShowerProcessor/DataWriter chain
+# (see `file_processing.py`), with `--workers N` the files are processed by a pool of N processes.
+# With `--both-windows`, each event is read once and goes through both a standard and a reduced window chain.
+# With `--shards M`, the events of each file are shared out to M processes, whose outputs are merged (see `event_sharding.py`).
+# With `--read-ahead N`, a thread reads the events ahead of the processing, and with `--stage-dir` the next files are copied to local scratch (see `input_stage.py`).
+#
+# The time spent in each stage of the event loop (with `--timing-by-type`, also split by telescope type) is written in `/processing/stage_timing` of each output (see `stage_timing.py`).
+# A failing file is reported, and its partial output removed, without stopping the others.
+
+# %%
+out_file = None
+failed_files = []
+for summary in process_files(todo_files, OUT_DIR, tels_alpha, dl1_to_dl2, windows, readout_windows,
+                             file_numbers=[simtel_files.index(in_file) + 1 for in_file in todo_files],
+                             n_total=len(simtel_files),
+                             workers=workers, shards=shards, throughput_interval=throughput_every,
+                             sample_events=sample_events, n_read_ahead=read_ahead, stage_dir=STAGE_DIR,
+                             output_profile=output_profile, histograms=Histograms):
+    manifest.record(summary)
+    if merger is not None and summary["status"] == "done":
+        merger.append(summary["in_file"], summary["out_files"])
+    if summary["status"] == "done":
+        print(f"Done {Path(summary['in_file']).stem}: {summary['n_written']} of {summary['n_events']} events "
+              f"written in {summary['time']:.0f} s, max. RSS {summary['max_rss_mb']:.0f} MB")
+        print("  time per stage:", ", ".join(f"{stage} {time:.1f} s" for stage, time in summary["stage_time"].items()))
+        if "staging_wait" in summary:
+            print(f"  waited {summary['staging_wait']:.1f} s for the staged input")
+        out_file = list(summary["out_files"].values())[-1]
+    else:
+        print(f"Failed {Path(summary['in_file']).stem}:\n{summary['error']}")
+        failed_files.append(summary["in_file"])
 
 # %%
-events.colnames
+if failed_files:
+    print(f"{len(failed_files)} file(s) failed:", *failed_files, sep="\n  ")
+
+# %% [markdown]
+# ## Show some results on the last file
+#
+# Only with `--display` (or interactively).
 
 # %%
-theta = angular_separation(
-     events["HillasReconstructor_az"].quantity,
-     events["HillasReconstructor_alt"].quantity,
-     events["true_az"].quantity,
-     events["true_alt"].quantity,
-)
+if ShowDisplay:
+    from matplotlib import pyplot as plt
+
+# %% [markdown]
+# θ² is histogrammed by `theta2.py`, reading only the directions, in chunks of rows: the same works for all the outputs of OUT_DIR
+# (`window_histograms(OUT_DIR)`, or `python3 theta2.py $OUT_DIR`).
 
-plt.hist(theta.to_value(u.deg) ** 2, bins=500, range=[0, 0.1])
-plt.xlabel(r"$\theta² / deg²$")
-None
+# %%
+from theta2 import theta2_histogram
 
 # %%
-from ctapipe.visualization import ArrayDisplay, CameraDisplay
+if ShowDisplay and out_file is not None:
+    theta2_hist = theta2_histogram([out_file])
+
+    plt.stairs(theta2_hist.counts, theta2_hist.bins)
+    plt.xlabel(r"$\theta² / deg²$")
+    None
 
-angle_offset = plotting_event.pointing.array_azimuth
+# %% [markdown]
+# With `--sample-events N`, N random events with 10 or more telescopes are kept in each output (`/processing/sample_events`, see `sample_events.py`),
+# with only what is needed here.
 
-plotting_hillas = {
-    tel_id: dl1.parameters.hillas for tel_id, dl1 in plotting_event.dl1.tel.items()
-}
+# %%
+from sample_events import plotting_event, read_sample_events
 
-plotting_core = {
-    tel_id: dl1.parameters.core.psi for tel_id, dl1 in plotting_event.dl1.tel.items()
-}
+sample_table = read_sample_events(out_file) if ShowDisplay and out_file is not None else None
+if sample_table is not None and len(sample_table):
+    from ctapipe.visualization import ArrayDisplay
 
+    plotting_hillas, plotting_core, true_core, reco_core = plotting_event(sample_table)
 
-disp = ArrayDisplay(source.subarray)
+    disp = ArrayDisplay(subarray)
 
-disp.set_line_hillas(plotting_hillas, plotting_core, 500)
+    disp.set_line_hillas(plotting_hillas, plotting_core, 500)
 
-plt.scatter(
-     plotting_event.simulation.shower.core_x,
-     plotting_event.simulation.shower.core_y,
-     s=200,
-     c="k",
-     marker="x",
-     label="True Impact",
-)
-plt.scatter(
-     plotting_event.dl2.stereo.geometry["HillasReconstructor"].core_x,
-     plotting_event.dl2.stereo.geometry["HillasReconstructor"].core_y,
-     s=200,
-     c="r",
-     marker="x",
-     label="Estimated Impact",
-)
+    plt.scatter(
+         *true_core,
+         s=200,
+         c="k",
+         marker="x",
+         label="True Impact",
+    )
+    plt.scatter(
+         *reco_core,
+         s=200,
+         c="r",
+         marker="x",
+         label="Estimated Impact",
+    )
 
-plt.legend(loc="lower right")
-plt.xlim(-350, 350)
-plt.ylim(-375, 225)
-None
+    plt.legend(loc="lower right")
+    plt.xlim(-350, 350)
+    plt.ylim(-375, 225)
+    None
 
 # %%
 
@@ -0,0 +1,230 @@
+"""
+Batched calibration and cleaning (`--batched`): the telescopes of an event
+with the same camera, sample count and settings (most of the alpha layout,
+the NectarCams and the LSTs) are calibrated and cleaned together
+
+CameraCalibrator and ImageProcessor handle one telescope at a time, and for
+small images (and reduced windows) the python overhead per telescope
+dominates. BatchedCameraCalibrator stacks the dl0 waveforms of each group of
+telescopes into one array, and runs the NeighborPeakWindowSum peak finding,
+window sum and integration correction of ctapipe once for the whole group
+(its numba functions take any number of channels, so telescopes are passed
+as channels). BatchedTailcutsCleaner does the tailcuts cleaning of each group
+with one sparse matrix product per step, the ImageProcessor then gets the
+masks telescope by telescope.
+
+The results are the same as telescope by telescope; telescopes that can't be
+batched (other extractors, pedestal calibration, waveforms shifted by the
+time shift calibration (apply_waveform_time_shift), a single telescope of
+its type) go through the ctapipe path. The time shift calibration that the
+simtel files have for all telescopes is subtracted from the peak times, as
+CameraCalibrator does by default.
+"""
+from collections import defaultdict
+
+import numpy as np
+from ctapipe.calib import CameraCalibrator
+from ctapipe.calib.camera.calibrator import _get_invalid_pixels, _get_pixel_index
+from ctapipe.containers import DL1CameraContainer
+from ctapipe.image import NeighborPeakWindowSum, TailcutsImageCleaner
+from ctapipe.image.extractor import extract_around_peak, neighbor_average_maximum
+
+
+class BatchedCameraCalibrator(CameraCalibrator):
+    """CameraCalibrator, with the NeighborPeakWindowSum extraction batched by telescope type"""
+
+    def _batch_key(self, event, tel_id):
+        """Telescopes of the same key are extracted together, None if tel_id can't be batched"""
+        dl0 = event.dl0.tel.get(tel_id)
+        if dl0 is None or dl0.waveform is None or dl0.waveform.shape[-1] == 1:
+            return None
+        extractor_type = self.image_extractor_type.tel[tel_id]
+        if type(self.image_extractors[extractor_type]) is not NeighborPeakWindowSum:
+            return None
+        dl1_calib = event.calibration.tel[tel_id].dl1
+        if dl1_calib.pedestal_offset is not None:
+            return None
+        # Only the shift of the extracted peak times (default) is done on the batch
+        if dl1_calib.time_shift is not None and self.apply_waveform_time_shift.tel[tel_id]:
+            return None
+        extractor = self.image_extractors[extractor_type]
+        return (
+            str(self.subarray.tel[tel_id]),
+            extractor_type,
+            dl0.waveform.shape,
+            dl0.waveform.dtype,
+            dl0.selected_gain_channel is None,
+            extractor.window_width.tel[tel_id],
+            extractor.window_shift.tel[tel_id],
+            extractor.local_weight.tel[tel_id],
+            extractor.apply_integration_correction.tel[tel_id],
+        )
+
+    def _calibrate_dl1_batch(self, event, tel_ids):
+        """_calibrate_dl1 for tel_ids of the same _batch_key, extracted together"""
+        first = tel_ids[0]
+        extractor = self.image_extractors[self.image_extractor_type.tel[first]]
+        waveforms = np.stack([event.dl0.tel[tel_id].waveform for tel_id in tel_ids])
+        n_tels, n_channels, n_pixels, n_samples = waveforms.shape
+        selected_gain_channels = [event.dl0.tel[tel_id].selected_gain_channel for tel_id in tel_ids]
+        broken_pixels = np.stack([
+            _get_invalid_pixels(n_channels, n_pixels, event.mon.tel[tel_id].pixel_status, selected_gain_channel)
+            for tel_id, selected_gain_channel in zip(tel_ids, selected_gain_channels)
+        ])
+
+        # The telescopes as channels, for the numba functions of NeighborPeakWindowSum
+        waveforms = waveforms.reshape(n_tels * n_channels, n_pixels, n_samples)
+        neighbors = self.subarray.tel[first].camera.geometry.neighbor_matrix_sparse
+        peak_index = neighbor_average_maximum(
+            waveforms,
+            neighbors_indices=neighbors.indices,
+            neighbors_indptr=neighbors.indptr,
+            local_weight=extractor.local_weight.tel[first],
+            broken_pixels=broken_pixels.reshape(n_tels * n_channels, n_pixels),
+        )
+        charge, peak_time = extract_around_peak(
+            waveforms,
+            peak_index,
+            extractor.window_width.tel[first],
+            extractor.window_shift.tel[first],
+            extractor.sampling_rate_ghz[first],
+        )
+        charge = charge.reshape(n_tels, n_channels, n_pixels)
+        peak_time = peak_time.reshape(n_tels, n_channels, n_pixels)
+
+        if extractor.apply_integration_correction.tel[first]:
+            correction = extractor._calculate_correction(tel_id=first)
+            if selected_gain_channels[0] is None:
+                charge = (charge * correction[:, np.newaxis]).astype(charge.dtype)
+            else:
+                charge = (charge * correction[np.stack(selected_gain_channels)][:, np.newaxis]).astype(charge.dtype)
+
+        pixel_index = _get_pixel_index(n_pixels)
+        for num, (tel_id, selected_gain_channel) in enumerate(zip(tel_ids, selected_gain_channels)):
+            image, time = charge[num], peak_time[num]
+            if selected_gain_channel is not None:
+                image, time = image[0], time[0]
+            dl1 = DL1CameraContainer(image=image, peak_time=time, is_valid=True)
+
+            # As CameraCalibrator._calibrate_dl1 after the extraction
+            dl1_calib = event.calibration.tel[tel_id].dl1
+            time_shift = dl1_calib.time_shift
+            if time_shift is not None and self.apply_peak_time_shift.tel[tel_id]:
+                if selected_gain_channel is not None:
+                    time_shift = time_shift[selected_gain_channel, pixel_index]
+                dl1.peak_time -= time_shift
+            if dl1_calib.relative_factor is not None and dl1_calib.absolute_factor is not None:
+                if selected_gain_channel is None:
+                    calibration = dl1_calib.relative_factor / dl1_calib.absolute_factor
+                else:
+                    calibration = (
+                        dl1_calib.relative_factor[selected_gain_channel, pixel_index]
+                        / dl1_calib.absolute_factor[selected_gain_channel, pixel_index]
+                    )
+                dl1.image *= calibration
+            if self.invalid_pixel_handler is not None:
+                dl1.image, dl1.peak_time = self.invalid_pixel_handler(
+                    tel_id, dl1.image, dl1.peak_time, broken_pixels[num],
+                )
+            event.dl1.tel[tel_id] = dl1
+
+    def __call__(self, event):
+        tel = event.r1.tel or event.dl0.tel or event.dl1.tel
+        batches = defaultdict(list)
+        for tel_id in tel.keys():
+            self._calibrate_dl0(event, tel_id)
+            key = self._batch_key(event, tel_id)
+            if key is None:
+                self._calibrate_dl1(event, tel_id)
+            else:
+                batches[key].append(tel_id)
+        for tel_ids in batches.values():
+            if len(tel_ids) == 1:
+                self._calibrate_dl1(event, tel_ids[0])
+            else:
+                self._calibrate_dl1_batch(event, tel_ids)
+
+
+class BatchedTailcutsCleaner(TailcutsImageCleaner):
+    """
+    TailcutsImageCleaner, with the masks of all the telescopes of an event
+    computed by `prepare` (batched by telescope type); __call__ returns them
+    for the same images, and cleans as TailcutsImageCleaner otherwise
+    """
+
+    def __init__(self, subarray, config=None, parent=None, **kwargs):
+        super().__init__(subarray=subarray, config=config, parent=parent, **kwargs)
+        # {tel_id: (image, mask)} of the current event
+        self._masks = {}
+
+    def _batch_key(self, tel_id, image):
+        return (
+            str(self.subarray.tel[tel_id]),
+            image.shape,
+            self.min_picture_neighbors.tel[tel_id],
+            self.keep_isolated_pixels.tel[tel_id],
+        )
+
+    def clean_batch(self, tel_ids, images):
+        """Masks (n_tels, n_pixels) of images (n_tels, n_pixels) of tel_ids, of the same _batch_key"""
+        first = tel_ids[0]
+        neighbors = self.subarray.tel[first].camera.geometry.neighbor_matrix_sparse
+        picture_thresh = np.array([self.picture_threshold_pe.tel[tel_id] for tel_id in tel_ids])
+        boundary_thresh = np.array([self.boundary_threshold_pe.tel[tel_id] for tel_id in tel_ids])
+        min_number_picture_neighbors = self.min_picture_neighbors.tel[first]
+        keep_isolated_pixels = self.keep_isolated_pixels.tel[first]
+
+        # As ctapipe.image.tailcuts_clean, with the pixels along the first axis for the neighbor matrix
+        pixels_above_picture = images.T >= picture_thresh
+        if keep_isolated_pixels or min_number_picture_neighbors == 0:
+            pixels_in_picture = pixels_above_picture
+        else:
+            number_of_neighbors_above_picture = neighbors.dot(pixels_above_picture.view(np.byte))
+            pixels_in_picture = pixels_above_picture & (
+                number_of_neighbors_above_picture >= min_number_picture_neighbors
+            )
+        pixels_above_boundary = images.T >= boundary_thresh
+        pixels_with_picture_neighbors = neighbors.dot(pixels_in_picture)
+        if keep_isolated_pixels:
+            masks = (pixels_above_boundary & pixels_with_picture_neighbors) | pixels_in_picture
+        else:
+            pixels_with_boundary_neighbors = neighbors.dot(pixels_above_boundary)
+            masks = (pixels_above_boundary & pixels_with_picture_neighbors) | (
+                pixels_in_picture & pixels_with_boundary_neighbors
+            )
+        return np.ascontiguousarray(masks.T)
+
+    def prepare(self, event):
+        """Clean the dl1 images of event, batched, for the following calls"""
+        self._masks = {}
+        batches = defaultdict(list)
+        for tel_id, dl1 in event.dl1.tel.items():
+            if dl1.image is not None:
+                batches[self._batch_key(tel_id, dl1.image)].append(tel_id)
+        for tel_ids in batches.values():
+            if len(tel_ids) == 1:
+                continue
+            images = [event.dl1.tel[tel_id].image for tel_id in tel_ids]
+            masks = self.clean_batch(tel_ids, np.stack(images))
+            for tel_id, image, mask in zip(tel_ids, images, masks):
+                self._masks[tel_id] = (image, mask)
+
+    def __call__(self, tel_id, image, arrival_times=None, *, monitoring=None):
+        prepared = self._masks.pop(tel_id, None)
+        # Not if the image was replaced since (e.g. by the ImageModifier)
+        if prepared is not None and prepared[0] is image:
+            return prepared[1]
+        return super().__call__(tel_id, image, arrival_times, monitoring=monitoring)
+
+
+def batched_image_processor_config(image_processor_config):
+    """
+    ImageProcessor configuration (the ImageProcessor section of
+    dl1_to_dl2.yml, as passed to the ImageProcessor) with BatchedTailcutsCleaner
+    as cleaner, if TailcutsImageCleaner
+    """
+    config = dict(image_processor_config)
+    if config.get("image_cleaner_type", "TailcutsImageCleaner") == "TailcutsImageCleaner":
+        # The section is passed as the configuration, so the ImageProcessor trait needs its own section
+        config["ImageProcessor"] = dict(config.get("ImageProcessor", {}), image_cleaner_type="BatchedTailcutsCleaner")
+    return config
@@ -0,0 +1,79 @@
+"""
+File size and read time of the outputs for each output profile and compression
+(see output_profile.py and output_profiles.yml)
+
+The same simtel file is processed (reduced window) once per setting, then
+the telescope events (dl1 parameters, dl2, simulated) are read back with
+TableLoader, as the training tools do.
+
+e.g.
+    python3 bench_output_profile.py --input $PROD_DIR/proton_..._run000001___cta-prod6-....simtel.zst
+"""
+import argparse
+import os
+import tempfile
+from time import perf_counter
+
+import yaml
+from ctapipe.io import TableLoader
+
+from bench_reducer import DEFAULT_INPUT, TELS_ALPHA
+from file_processing import process_file
+from output_profile import load_output_profile
+
+# (profile, overrides of the profile)
+SETTINGS = [
+    ("full", {}),
+    ("compact", dict(compression_type="blosc:zstd", compression_level=1)),
+    ("compact", dict(compression_type="blosc:zstd", compression_level=5)),
+    ("compact", dict(compression_type="blosc:zstd", compression_level=9)),
+    ("compact", dict(compression_type="zlib", compression_level=5)),
+    ("compact", dict(chunk_kib=None)),
+]
+
+
+def read_time(out_file, repeat):
+    """Best time [s] to read all telescope events of out_file, and their number"""
+    times = []
+    for _ in range(repeat):
+        t_start = perf_counter()
+        with TableLoader(out_file) as loader:
+            events = loader.read_telescope_events(dl1_parameters=True, dl2=True, simulated=True)
+        times.append(perf_counter() - t_start)
+    return min(times), len(events)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+                    prog='bench_output_profile',
+                    description='Output file size and TableLoader read time for each output profile',
+                    )
+    parser.add_argument("--input","-i",default=DEFAULT_INPUT,help="simtel file")
+    parser.add_argument("--profiles",default="output_profiles.yml")
+    parser.add_argument("--repeat",type=int,default=3,help="Take the best of this many reads")
+    args = parser.parse_args()
+
+    with open("dl1_to_dl2.yml") as stream:
+        dl1_to_dl2 = yaml.safe_load(stream)
+    with open("readout_windows.yml") as stream:
+        readout_windows = yaml.safe_load(stream)
+
+    print(f"{'profile':40s} {'columns':>8s} {'size MB':>8s} {'read s':>7s} {'events':>7s}")
+    with tempfile.TemporaryDirectory() as out_dir:
+        for num_setting, (name, overrides) in enumerate(SETTINGS):
+            profile = load_output_profile(name, args.profiles)
+            profile.update(overrides)
+            out_file = os.path.join(out_dir, f"setting{num_setting}.redwindow.h5")
+            summary = process_file(args.input, {"red": out_file}, TELS_ALPHA, dl1_to_dl2, readout_windows,
+                                   output_profile=profile)
+            if summary["status"] != "done":
+                print(summary["error"])
+                continue
+            label = name + "".join(f" {key}={value}" for key, value in overrides.items())
+            n_columns = len(profile.get("keep_parameters", [])) or "all"
+            time, n_events = read_time(out_file, args.repeat)
+            print(f"{label:40s} {n_columns:>8} {os.path.getsize(out_file) / 2**20:8.2f} {time:7.3f} {n_events:7d}")
+
+
+if __name__ == "__main__":
+    main()
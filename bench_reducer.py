@@ -0,0 +1,133 @@
+"""
+Micro-benchmark of the readout window reduction on a synthetic event stream.
+
+Compares the table-driven ReadoutWindowReducer (readout_window.py) with the
+previous function, which looked up and compared camera names for every
+triggered telescope of every event, and with its per-event window mode
+("peak"), whose cost is mostly finding the peaks.
+
+e.g.
+    python3 bench_reducer.py --input $PROD_DIR/gamma_..._run000001___cta-prod6-....simtel.zst
+(by default the subarray of a ctapipe test file is used)
+"""
+import argparse
+from time import perf_counter
+
+import numpy as np
+import yaml
+from ctapipe.containers import ArrayEventContainer
+from ctapipe.instrument import SubarrayDescription
+from traitlets.config import Config
+
+from readout_window import ReadoutWindowReducer
+
+DEFAULT_INPUT = "dataset://gamma_20deg_0deg_run1___cta-prod5-lapalma_desert-2158m-LaPalma-dark_100evts.simtel.zst"
+TELS_ALPHA = [1,2,3,4,5,6,7,8,9,10,11,14,19]
+
+
+def legacy_reducer(event,subarray):
+    """
+    ReadoutWindowReducer as it was before readout_window.ReadoutWindowReducer,
+    (with subarray instead of the global source)
+    """
+    for tel_id in event.trigger.tels_with_trigger:
+        cam_name_lower = subarray.tel[tel_id].camera_name.lower()
+        if "nectarcam" == cam_name_lower:
+            event.r0.tel[tel_id].waveform = event.r0.tel[tel_id].waveform[:, :, 12:27]
+            event.r1.tel[tel_id].waveform = event.r1.tel[tel_id].waveform[:, :, 12:27]
+        elif "lstcam" == cam_name_lower:
+            event.r0.tel[tel_id].waveform = event.r0.tel[tel_id].waveform[:, :, 10:30]
+            event.r1.tel[tel_id].waveform = event.r1.tel[tel_id].waveform[:, :, 10:30]
+        else:
+            print(f"For {tel_id}, unknown camera type {subarray.tel[tel_id].camera_name}!!!")
+
+
+def make_events(subarray, n_events, seed=0):
+    """
+    Synthetic events, with random telescope multiplicity (at least 2) and
+    r0/r1 waveforms of the simulated shape (shared between events, since
+    only the slicing is benchmarked).
+    """
+    rng = np.random.default_rng(seed)
+    waveforms = {}
+    for tel_id, tel in subarray.tel.items():
+        readout = tel.camera.readout
+        n_pixels = tel.camera.geometry.n_pixels
+        waveforms[tel_id] = (
+            rng.integers(200, 400, (readout.n_channels, n_pixels, readout.n_samples), dtype=np.uint16),
+            rng.normal(0, 1, (1, n_pixels, readout.n_samples)).astype(np.float32),
+        )
+
+    tel_ids = np.array(subarray.tel_ids)
+    events = []
+    for _ in range(n_events):
+        event = ArrayEventContainer()
+        n_triggered = rng.integers(2, len(tel_ids) + 1)
+        triggered = np.sort(rng.choice(tel_ids, n_triggered, replace=False))
+        event.trigger.tels_with_trigger = triggered
+        for tel_id in triggered:
+            event.r0.tel[tel_id].waveform, event.r1.tel[tel_id].waveform = waveforms[tel_id]
+        events.append(event)
+    return events
+
+
+def time_reducer(reducer, events):
+    """Time per event [s] of reducer(event) over all events"""
+    t_start = perf_counter()
+    for event in events:
+        reducer(event)
+    return (perf_counter() - t_start) / len(events)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+                    prog='bench_reducer',
+                    description='Micro-benchmark of ReadoutWindowReducer vs the previous function',
+                    )
+    parser.add_argument("--input","-i",default=DEFAULT_INPUT,
+                        help="File to take the subarray from (simtel or ctapipe h5)")
+    parser.add_argument("--n-events","-n",type=int,default=20000)
+    parser.add_argument("--repeat",type=int,default=5,help="Take the best of this many runs")
+    parser.add_argument("--config",default="readout_windows.yml",help="Window table")
+    args = parser.parse_args()
+
+    subarray = SubarrayDescription.read(args.input)
+    subarray = subarray.select_subarray([tel_id for tel_id in TELS_ALPHA if tel_id in subarray.tel])
+    with open(args.config) as stream:
+        readout_windows = yaml.safe_load(stream)
+
+    t_setup = perf_counter()
+    reducer = ReadoutWindowReducer(subarray=subarray, config=Config(readout_windows))
+    t_setup = perf_counter() - t_setup
+    peak_config = Config(readout_windows)
+    peak_config.ReadoutWindowReducer.mode = "peak"
+    peak_reducer = ReadoutWindowReducer(subarray=subarray, config=peak_config)
+
+    def legacy(event):
+        legacy_reducer(event, subarray)
+
+    results = {}
+    for name, function in [("legacy function", legacy), ("ReadoutWindowReducer", reducer),
+                           ("ReadoutWindowReducer peak", peak_reducer)]:
+        times = [time_reducer(function, make_events(subarray, args.n_events, seed=repeat))
+                 for repeat in range(args.repeat)]
+        results[name] = min(times)
+
+    # Both should give the same windows
+    events_legacy = make_events(subarray, 100, seed=42)
+    events_new = make_events(subarray, 100, seed=42)
+    for event_legacy, event_new in zip(events_legacy, events_new):
+        legacy(event_legacy)
+        reducer(event_new)
+        for tel_id in event_new.trigger.tels_with_trigger:
+            assert event_legacy.r1.tel[tel_id].waveform.shape == event_new.r1.tel[tel_id].waveform.shape
+
+    print(f"{len(subarray.tel)} telescopes, {args.n_events} events, best of {args.repeat}")
+    print(f"  ReadoutWindowReducer construction: {t_setup * 1e3:.2f} ms")
+    for name, time_per_event in results.items():
+        print(f"  {name:26s}: {time_per_event * 1e6:8.2f} µs/event")
+    print(f"  speedup: {results['legacy function'] / results['ReadoutWindowReducer']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
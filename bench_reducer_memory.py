@@ -0,0 +1,96 @@
+"""
+Peak memory and extraction time with the reduced window kept as views of the
+full waveforms, copied to compact arrays (contiguous), or with R0 dropped.
+
+Each mode runs in its own (forked) process, on the same events of a simtel
+file, and reports the peak RSS of that process and the time per event spent
+in the CameraCalibrator (i.e. the charge extraction).
+
+e.g.
+    python3 bench_reducer_memory.py --input $PROD_DIR/proton_..._run000001___cta-prod6-....simtel.zst -n 2000
+"""
+import argparse
+import multiprocessing
+import resource
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+
+import yaml
+from ctapipe.calib import CameraCalibrator
+from ctapipe.instrument import SoftwareTrigger
+from ctapipe.io import EventSource
+from traitlets.config import Config
+
+from bench_reducer import DEFAULT_INPUT, TELS_ALPHA
+from readout_window import ReadoutWindowReducer
+
+MODES = {
+    "full window": None,
+    "reduced, views": dict(contiguous=False, drop_r0=False),
+    "reduced, contiguous": dict(contiguous=True, drop_r0=False),
+    "reduced, contiguous, no R0": dict(contiguous=True, drop_r0=True),
+}
+
+
+def run_mode(input_url, max_events, readout_windows, dl1_to_dl2, reducer_options):
+    """
+    Calibrate the triggered events of input_url, returning the time per event in
+    the calibrator [s], the number of events and the peak RSS [MB] of the process.
+
+    Events are kept in memory (as in a high multiplicity event, or a queue of
+    events between processes) so that the memory held by the waveforms shows up.
+    """
+    source = EventSource(input_url, allowed_tels=TELS_ALPHA, max_events=max_events)
+    software_trigger = SoftwareTrigger(subarray=source.subarray, config=Config(dl1_to_dl2["SoftwareTrigger"]))
+    calibrator = CameraCalibrator(subarray=source.subarray)
+    reducer = None
+    if reducer_options is not None:
+        config = Config(readout_windows)
+        config.ReadoutWindowReducer.update(reducer_options)
+        reducer = ReadoutWindowReducer(subarray=source.subarray, config=config)
+
+    kept_events = []
+    t_calib = 0.
+    for event in source:
+        if not software_trigger(event):
+            continue
+        if reducer is not None:
+            reducer(event)
+        t_start = perf_counter()
+        calibrator(event)
+        t_calib += perf_counter() - t_start
+        kept_events.append(event)
+
+    n_events = len(kept_events)
+    max_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return t_calib / max(n_events, 1), n_events, max_rss_mb
+
+
+def main():
+    parser = argparse.ArgumentParser(
+                    prog='bench_reducer_memory',
+                    description='Peak RSS and extraction time for views/contiguous/no-R0 reduced windows',
+                    )
+    parser.add_argument("--input","-i",default=DEFAULT_INPUT,help="simtel file")
+    parser.add_argument("--max-events","-n",type=int,default=500)
+    parser.add_argument("--config",default="readout_windows.yml",help="Window table")
+    args = parser.parse_args()
+
+    with open(args.config) as stream:
+        readout_windows = yaml.safe_load(stream)
+    with open("dl1_to_dl2.yml") as stream:
+        dl1_to_dl2 = yaml.safe_load(stream)
+
+    print(f"{'mode':28s} {'events':>7s} {'calib. ms/event':>16s} {'peak RSS MB':>12s}")
+    context = multiprocessing.get_context("fork")
+    for name, reducer_options in MODES.items():
+        # A fresh process for each mode, so that peak RSS are not mixed
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            time_per_event, n_events, max_rss_mb = pool.submit(
+                run_mode, args.input, args.max_events, readout_windows, dl1_to_dl2, reducer_options
+            ).result()
+        print(f"{name:28s} {n_events:7d} {time_per_event * 1e3:16.3f} {max_rss_mb:12.0f}")
+
+
+if __name__ == "__main__":
+    main()
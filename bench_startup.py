@@ -0,0 +1,100 @@
+"""
+Startup time of Make_reduced_Readout_window_file.py batch jobs
+
+* import time of the modules used by batch jobs, and of the plotting ones
+  (matplotlib, ctapipe.visualization) which are now only imported when needed,
+  each in a fresh python process
+* reading the subarray from a simtel file (EventSource) vs from the cache
+* building the software trigger and window chains vs reusing them for the
+  next file (file_processing.get_processors)
+
+e.g.
+    python3 bench_startup.py --input $PROD_DIR/gamma_..._run000001___cta-prod6-....simtel.zst
+"""
+import argparse
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+
+IMPORTS = {
+    "batch": (
+        "from ctapipe.io import EventSource, DataWriter; "
+        "from ctapipe.calib import CameraCalibrator; "
+        "from ctapipe.image import ImageProcessor; "
+        "from ctapipe.reco import ShowerProcessor; "
+        "import file_processing"
+    ),
+    "plotting": (
+        "from matplotlib import pyplot as plt; "
+        "from ctapipe.visualization import ArrayDisplay, CameraDisplay"
+    ),
+}
+
+
+def time_import(statement, repeat):
+    """Best wall time [s] of running python -c statement, minus an empty python"""
+    def run(code):
+        t_start = perf_counter()
+        subprocess.run([sys.executable, "-c", code], check=True)
+        return perf_counter() - t_start
+
+    empty = min(run("pass") for _ in range(repeat))
+    return min(run(statement) for _ in range(repeat)) - empty
+
+
+def main():
+    parser = argparse.ArgumentParser(
+                    prog='bench_startup',
+                    description='Import and subarray loading times at the start of batch jobs',
+                    )
+    parser.add_argument("--input","-i",default=None,
+                        help="simtel file for the subarray loading (default: ctapipe test file)")
+    parser.add_argument("--repeat",type=int,default=3,help="Take the best of this many runs")
+    args = parser.parse_args()
+
+    print("Import times (fresh process, best of", args.repeat, "runs):")
+    for name, statement in IMPORTS.items():
+        print(f"  {name:10s}: {time_import(statement, args.repeat):6.2f} s")
+
+    from ctapipe.io import EventSource
+    from bench_reducer import DEFAULT_INPUT, TELS_ALPHA
+    import yaml
+    from file_processing import _processors, get_processors, load_subarray
+
+    input_url = args.input or DEFAULT_INPUT
+    with tempfile.TemporaryDirectory() as cache_dir:
+        times = []
+        for _ in range(args.repeat):
+            t_start = perf_counter()
+            with EventSource(input_url, allowed_tels=TELS_ALPHA) as source:
+                source.subarray
+            times.append(perf_counter() - t_start)
+        print(f"Subarray from EventSource: {min(times):6.3f} s")
+
+        load_subarray(input_url, TELS_ALPHA, cache_dir)  # fills the cache
+        times = []
+        for _ in range(args.repeat):
+            t_start = perf_counter()
+            load_subarray(input_url, TELS_ALPHA, cache_dir)
+            times.append(perf_counter() - t_start)
+        print(f"Subarray from cache      : {min(times):6.3f} s")
+
+        subarray = load_subarray(input_url, TELS_ALPHA, cache_dir)
+    with open("dl1_to_dl2.yml") as stream:
+        dl1_to_dl2 = yaml.safe_load(stream)
+    with open("readout_windows.yml") as stream:
+        readout_windows = yaml.safe_load(stream)
+    for label, clear in (("built ", True), ("reused", False)):
+        times = []
+        for _ in range(args.repeat):
+            if clear:
+                _processors.clear()
+            t_start = perf_counter()
+            get_processors(subarray, dl1_to_dl2, ["std", "red"], readout_windows)
+            times.append(perf_counter() - t_start)
+        print(f"Processors {label}        : {min(times):6.3f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,445 @@
+"""
+Throughput benchmark of the processing chain on synthetic events, for
+regression tracking on any (offline) linux box
+
+Showers of the ctapipe toy model (ctapipe.image.toymodel) are drawn on the
+telescopes of TELS_ALPHA (LSTCam and NectarCam), with waveforms of the full
+number of samples, and go through the same software trigger, (reduced window),
+calibrator, image processor, shower processor and writer as the simtel files
+(process_file of file_processing.py), for the std window (full samples), the
+red window (reduced samples) and both at once. Each case runs in its own
+process, for its peak memory. Before the timed events, --warmup-events other
+events go through the same processors, so that the numba compilation (and the
+construction of the processors) is not counted.
+
+The events/s, time per stage and peak memory are written as JSON (--output),
+with the versions, host and settings, and compared with an earlier run with
+--compare (exit code 1 if a case got slower than the tolerance).
+
+By default, the cameras are hexagonal cameras of the pixel size and number
+(1801 pixels) of LSTCam and NectarCam, since their geometries are downloaded
+by ctapipe; --subarray reads the subarray of a file instead, e.g. the
+subarray_<hash>.h5 cached in $OUT_DIR (see file_processing.load_subarray).
+
+e.g.
+    python3 bench_synthetic.py --n-events 500 --output bench_synthetic.json --compare bench_synthetic_v1.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from multiprocessing import get_context
+
+import astropy
+import numpy as np
+import yaml
+from astropy import units as u
+from astropy.coordinates import EarthLocation
+from ctapipe import __version__ as ctapipe_version
+from ctapipe.containers import (
+    ArrayEventContainer,
+    CoordinateFrameType,
+    EventType,
+    ObservationBlockContainer,
+    SchedulingBlockContainer,
+    SimulatedEventContainer,
+    SimulatedShowerContainer,
+    SimulationConfigContainer,
+)
+from ctapipe.coordinates import CameraFrame
+from ctapipe.core import Provenance
+from ctapipe.image import toymodel
+from ctapipe.instrument import (
+    CameraDescription,
+    CameraGeometry,
+    CameraReadout,
+    OpticsDescription,
+    PixelShape,
+    ReflectorShape,
+    SizeType,
+    SubarrayDescription,
+    TelescopeDescription,
+)
+from ctapipe.io import DataLevel, EventSource
+from scipy.special import ndtr
+
+from bench_reducer import TELS_ALPHA
+from file_processing import process_file
+
+# Cases: {name: windows processed}
+CASES = {"std": ["std"], "red": ["red"], "std+red": ["std", "red"]}
+
+# Toy cameras: pixel spacing [m], rings of hexagonal pixels around the central one,
+# focal length [m], mirror area [m²], samples at 1 GHz, width of the pulse [ns]
+TOY_CAMERAS = {
+    "LSTCam": dict(size_type=SizeType.LST, optics="LST", pix_spacing=0.05, n_rings=24,
+                   focal_length=28.0, mirror_area=386.0, n_samples=40, pulse_sigma=1.2),
+    "NectarCam": dict(size_type=SizeType.MST, optics="MST", pix_spacing=0.05, n_rings=24,
+                      focal_length=16.0, mirror_area=106.0, n_samples=60, pulse_sigma=1.6),
+}
+# Peak time of the pulses [ns], in the reduced windows of readout_windows.yml
+PEAK_TIME = {"LSTCam": 20.0, "NectarCam": 19.5}
+
+POINTING_ALT = 70 * u.deg
+POINTING_AZ = 0 * u.deg
+# Simulated showers: E^-2 spectrum [TeV], core radius [m]
+ENERGY_RANGE = (0.03, 100.0)
+CORE_RADIUS = 400.0
+NSB_LEVEL_PE = 3
+
+
+def pulse_waveform(charge, time, n_samples, sigma):
+    """
+    Waveforms (1, n_pixels, n_samples) [p.e.] of the gaussian reference pulse
+    of the toy cameras, of charge and peak time [ns] in each pixel, integrated
+    over each sample of 1 ns (as toymodel.WaveformModel, which takes ~0.1 s
+    per camera by upsampling and convolving)
+    """
+    edges = (np.arange(n_samples + 1) - time[:, np.newaxis]) / sigma
+    cumulative = ndtr(edges)
+    return (charge[:, np.newaxis] * np.diff(cumulative, axis=1))[np.newaxis]
+
+
+def toy_telescope(camera_name):
+    """TelescopeDescription of the toy camera camera_name (TOY_CAMERAS)"""
+    toy = TOY_CAMERAS[camera_name]
+    n_rings = toy["n_rings"]
+    # Axial coordinates of the hexagonal grid
+    q, r = np.meshgrid(np.arange(-n_rings, n_rings + 1), np.arange(-n_rings, n_rings + 1))
+    inside = np.abs(q + r) <= n_rings
+    q, r = q[inside], r[inside]
+    spacing = toy["pix_spacing"]
+    pix_x = spacing * (q + r / 2)
+    pix_y = spacing * r * np.sqrt(3) / 2
+    geometry = CameraGeometry(
+        name=camera_name,
+        pix_id=np.arange(len(pix_x)),
+        pix_x=pix_x * u.m,
+        pix_y=pix_y * u.m,
+        pix_area=np.full(len(pix_x), np.sqrt(3) / 2 * spacing**2) * u.m**2,
+        pix_type=PixelShape.HEXAGON,
+        frame=CameraFrame(focal_length=toy["focal_length"] * u.m),
+    )
+    pulse_time = np.arange(0, 20, 0.1)
+    readout = CameraReadout(
+        name=camera_name,
+        sampling_rate=1 * u.GHz,
+        reference_pulse_shape=np.exp(-0.5 * ((pulse_time - 5) / toy["pulse_sigma"]) ** 2)[np.newaxis],
+        reference_pulse_sample_width=0.1 * u.ns,
+        n_channels=1,
+        n_pixels=geometry.n_pixels,
+        n_samples=toy["n_samples"],
+    )
+    optics = OpticsDescription(
+        name=toy["optics"],
+        size_type=toy["size_type"],
+        reflector_shape=ReflectorShape.PARABOLIC if toy["optics"] == "LST" else ReflectorShape.HYBRID,
+        n_mirrors=1,
+        equivalent_focal_length=toy["focal_length"] * u.m,
+        effective_focal_length=toy["focal_length"] * u.m,
+        mirror_area=toy["mirror_area"] * u.m**2,
+        n_mirror_tiles=1,
+    )
+    return TelescopeDescription(
+        name=toy["optics"], optics=optics, camera=CameraDescription(name=camera_name, geometry=geometry, readout=readout)
+    )
+
+
+def toy_subarray(tel_ids=TELS_ALPHA):
+    """
+    Subarray of the toy telescopes: the first four LSTs in a square around
+    the center, the MSTs on a ring around them
+    """
+    lst = toy_telescope("LSTCam")
+    mst = toy_telescope("NectarCam")
+    n_mst = len(tel_ids) - 4
+    positions = {}
+    descriptions = {}
+    for num, tel_id in enumerate(tel_ids):
+        if num < 4:
+            angle = np.pi / 4 + num * np.pi / 2
+            radius = 85.0
+            descriptions[tel_id] = lst
+        else:
+            angle = 2 * np.pi * (num - 4) / n_mst
+            radius = 220.0
+            descriptions[tel_id] = mst
+        positions[tel_id] = [radius * np.cos(angle), radius * np.sin(angle), 0.0] * u.m
+    return SubarrayDescription(
+        "TOY_ALPHA", tel_positions=positions, tel_descriptions=descriptions,
+        reference_location=EarthLocation(lon=-17.89 * u.deg, lat=28.76 * u.deg, height=2147 * u.m),
+    )
+
+
+class ToyEventSource(EventSource):
+    """
+    n_events gamma showers of the toy model on subarray, from the pointing
+    direction, triggering at least two telescopes (with at least 3 pixels of
+    6 p.e. of signal each)
+    """
+
+    def __init__(self, subarray, n_events=100, seed=0, obs_id=1, **kwargs):
+        # The events are not read from a file, any existing path will do
+        super().__init__(input_url=__file__, **kwargs)
+        self._subarray = subarray
+        self.n_events = n_events
+        self.seed = seed
+        self.obs_id = obs_id
+        self.n_showers = 0
+
+    @staticmethod
+    def is_compatible(file_path):
+        return False
+
+    @property
+    def subarray(self):
+        return self._subarray
+
+    @property
+    def is_simulation(self):
+        return True
+
+    @property
+    def datalevels(self):
+        return (DataLevel.R0, DataLevel.R1)
+
+    @property
+    def observation_blocks(self):
+        return {self.obs_id: ObservationBlockContainer(
+            obs_id=np.uint64(self.obs_id), sb_id=np.uint64(self.obs_id),
+            subarray_pointing_frame=CoordinateFrameType.ALTAZ,
+            subarray_pointing_lat=POINTING_ALT, subarray_pointing_lon=POINTING_AZ,
+        )}
+
+    @property
+    def scheduling_blocks(self):
+        return {self.obs_id: SchedulingBlockContainer(sb_id=np.uint64(self.obs_id))}
+
+    @property
+    def simulation_config(self):
+        return {self.obs_id: SimulationConfigContainer(
+            energy_range_min=ENERGY_RANGE[0] * u.TeV, energy_range_max=ENERGY_RANGE[1] * u.TeV,
+            spectral_index=-2.0, max_scatter_range=CORE_RADIUS * u.m,
+        )}
+
+    def _telescope_image(self, tel_id, energy, core, rng):
+        """(image, signal [p.e.], impact distance [m], pulse time [ns]) of the shower on telescope tel_id"""
+        tel = self.subarray.tel[tel_id]
+        toy = TOY_CAMERAS[tel.camera.name]
+        geometry = tel.camera.geometry
+        position = self.subarray.positions[tel_id][:2].to_value(u.m)
+        impact = np.hypot(*(position - core))
+        # Image along the direction of the core, further from the source position with the impact distance
+        psi = np.arctan2(*(position - core)[::-1])
+        disp = np.deg2rad(min(0.009 * impact, 2.0))
+        centroid = toy["focal_length"] * np.tan(disp) * np.array([np.cos(psi), np.sin(psi)])
+        log_energy = np.log10(energy)
+        length = np.deg2rad(max(0.15 * (1 + 0.3 * log_energy) + 0.05 * impact / 100, 0.03)) * toy["focal_length"]
+        width = np.deg2rad(max(0.05 * (1 + 0.2 * log_energy), 0.02)) * toy["focal_length"]
+        # Flat Cherenkov pool up to 120 m, then falling
+        pool = 1.0 if impact < 120 else np.exp(-(impact - 120) / 60)
+        intensity = 10 * toy["mirror_area"] * energy * pool
+
+        model = toymodel.Gaussian(centroid[0] * u.m, centroid[1] * u.m, length * u.m, width * u.m, psi * u.rad)
+        image, signal, _ = model.generate_image(geometry, intensity=intensity, nsb_level_pe=NSB_LEVEL_PE, rng=rng)
+        # 3 ns/deg along the shower axis
+        time = toymodel.obtain_time_image(
+            geometry.pix_x, geometry.pix_y, centroid[0] * u.m, centroid[1] * u.m, psi * u.rad,
+            np.rad2deg(3.0 / toy["focal_length"]) * u.ns / u.m, PEAK_TIME[tel.camera.name] * u.ns,
+        )
+        return image, signal, impact, time
+
+    def _generator(self):
+        rng = np.random.default_rng(self.seed)
+        min_energy, max_energy = ENERGY_RANGE
+        n_events = 0
+        while n_events < self.n_events:
+            self.n_showers += 1
+            energy = 1 / (1 / min_energy - rng.uniform() * (1 / min_energy - 1 / max_energy))
+            core_angle = rng.uniform(0, 2 * np.pi)
+            core = CORE_RADIUS * np.sqrt(rng.uniform()) * np.array([np.cos(core_angle), np.sin(core_angle)])
+            images = {}
+            for tel_id in self.subarray.tel:
+                image, signal, impact, time = self._telescope_image(tel_id, energy, core, rng)
+                if np.count_nonzero(signal >= 6) >= 3:
+                    images[tel_id] = (image, signal, impact, time)
+            if len(images) < 2:
+                continue
+
+            event = ArrayEventContainer()
+            event.index.obs_id = self.obs_id
+            event.index.event_id = self.n_showers
+            event.count = n_events
+            event.trigger.event_type = EventType.SUBARRAY
+            event.trigger.tels_with_trigger = np.array(sorted(images))
+            event.simulation = SimulatedEventContainer(shower=SimulatedShowerContainer(
+                energy=energy * u.TeV, alt=POINTING_ALT, az=POINTING_AZ, core_x=core[0] * u.m, core_y=core[1] * u.m,
+                h_first_int=20 * u.km, x_max=300 * u.g / u.cm**2, starting_grammage=0 * u.g / u.cm**2,
+                shower_primary_id=0,
+            ))
+            event.pointing.array_altitude = POINTING_ALT
+            event.pointing.array_azimuth = POINTING_AZ
+            for tel_id, (image, signal, impact, time) in images.items():
+                camera = self.subarray.tel[tel_id].camera
+                waveform = pulse_waveform(image, time, camera.readout.n_samples, TOY_CAMERAS[camera.name]["pulse_sigma"])
+                # Electronic noise [p.e.]
+                waveform += rng.normal(0, 0.3, waveform.shape)
+                n_pixels = waveform.shape[1]
+                event.r1.tel[tel_id].waveform = waveform.astype(np.float32)
+                event.r1.tel[tel_id].pixel_status = np.zeros(n_pixels, np.uint8)
+                event.r1.tel[tel_id].selected_gain_channel = np.zeros(n_pixels, np.int8)
+                # 10 ADC counts per p.e. above a pedestal of 400
+                event.r0.tel[tel_id].waveform = np.clip(waveform * 10 + 400, 0, 4095).astype(np.uint16)
+                event.trigger.tel[tel_id].time = event.trigger.time
+                event.pointing.tel[tel_id].altitude = POINTING_ALT
+                event.pointing.tel[tel_id].azimuth = POINTING_AZ
+                simulation = event.simulation.tel[tel_id]
+                simulation.true_image = signal.astype(np.int32)
+                simulation.true_image_sum = np.float32(signal.sum())
+                simulation.impact.distance = impact * u.m
+                simulation.impact.distance_uncert = 0 * u.m
+            yield event
+            n_events += 1
+
+
+def run_case(windows, subarray, n_events, seed, dl1_to_dl2, readout_windows, n_warmup=0):
+    """
+    Summary of process_file (file_processing.py) for windows on the toy events,
+    after n_warmup other events through the same processors (not timed)
+    """
+    # For the reference metadata of the outputs (the ctapipe tools start one)
+    Provenance().start_activity("bench_synthetic")
+    with tempfile.TemporaryDirectory() as out_dir:
+        out_files = {window: os.path.join(out_dir, f"toy.{window}.h5") for window in windows}
+        if n_warmup > 0:
+            # The processors are reused by the next process_file, with their timers reset
+            warmup = process_file("toy", out_files, list(subarray.tel), dl1_to_dl2, readout_windows,
+                                  label="warm-up", progress_prefix="toy",
+                                  source=ToyEventSource(subarray, n_events=n_warmup, seed=seed + 1))
+            if warmup["status"] != "done":
+                return warmup
+            for out_file in out_files.values():
+                os.remove(out_file)
+        source = ToyEventSource(subarray, n_events=n_events, seed=seed)
+        summary = process_file("toy", out_files, list(subarray.tel), dl1_to_dl2, readout_windows,
+                               label="+".join(windows), progress_prefix="toy", source=source)
+    summary["n_showers"] = source.n_showers
+    return summary
+
+
+def git_commit():
+    """Commit of this repository, None if not in a git checkout"""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, reference, tolerance):
+    """Print the events/s of results vs reference, True if a case got slower than tolerance"""
+    regression = False
+    print(f"{'case':10s} {'events/s':>9s} {'before':>9s} {'ratio':>6s}")
+    for name, case in results["cases"].items():
+        before = reference["cases"].get(name)
+        if before is None or "events_per_s" not in case or "events_per_s" not in before:
+            continue
+        ratio = case["events_per_s"] / before["events_per_s"]
+        slower = ratio < 1 - tolerance
+        regression |= slower
+        print(f"{name:10s} {case['events_per_s']:9.2f} {before['events_per_s']:9.2f} {ratio:6.2f}"
+              + ("  REGRESSION" if slower else ""))
+    return regression
+
+
+def main():
+    parser = argparse.ArgumentParser(
+                    prog='bench_synthetic',
+                    description='Events/s, time per stage and peak memory of the processing on toy model events',
+                    )
+    parser.add_argument("--n-events",type=int,default=200,help="Events per case")
+    parser.add_argument("--warmup-events",type=int,default=10,help="Events processed before the timed ones, per case")
+    parser.add_argument("--seed",type=int,default=0)
+    parser.add_argument("--cases",nargs="+",default=list(CASES),choices=list(CASES))
+    parser.add_argument("--batched",action="store_true",help="Batched calibration and cleaning (batched_calibration.py)")
+    parser.add_argument("--subarray",default=None,help="Subarray of this file instead of the toy cameras")
+    parser.add_argument("--output","-o",default="bench_synthetic.json")
+    parser.add_argument("--compare",default=None,help="Earlier output to compare with")
+    parser.add_argument("--tolerance",type=float,default=0.1,help="Slowdown counted as a regression")
+    args = parser.parse_args()
+
+    with open("dl1_to_dl2.yml") as stream:
+        dl1_to_dl2 = yaml.safe_load(stream)
+    with open("readout_windows.yml") as stream:
+        readout_windows = yaml.safe_load(stream)
+    if args.batched:
+        dl1_to_dl2["batched"] = True
+    if args.subarray is None:
+        subarray = toy_subarray()
+    else:
+        subarray = SubarrayDescription.from_hdf(args.subarray).select_subarray(TELS_ALPHA)
+
+    results = dict(
+        date=datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        host=platform.node(),
+        platform=platform.platform(),
+        processor=platform.processor(),
+        cpu_count=os.cpu_count(),
+        commit=git_commit(),
+        versions=dict(python=platform.python_version(), ctapipe=ctapipe_version, numpy=np.__version__,
+                      astropy=astropy.__version__),
+        settings=dict(n_events=args.n_events, warmup_events=args.warmup_events, seed=args.seed, subarray=args.subarray or "toy", batched=args.batched,
+                      tels=[int(tel_id) for tel_id in subarray.tel], argv=sys.argv[1:]),
+        cases={},
+    )
+    for name in args.cases:
+        # A new process per case, for its own peak memory (and no processors cached from the previous case)
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context("fork")) as executor:
+            summary = executor.submit(run_case, CASES[name], subarray, args.n_events, args.seed,
+                                      dl1_to_dl2, readout_windows, args.warmup_events).result()
+        if summary["status"] != "done":
+            print(summary["error"])
+            results["cases"][name] = dict(status=summary["status"])
+            continue
+        stage_time = summary["stage_time"]
+        processing_time = summary["time"] - stage_time.get("source", 0.)
+        results["cases"][name] = dict(
+            status=summary["status"],
+            n_events=summary["n_events"],
+            n_written=summary["n_written"],
+            n_showers=summary["n_showers"],
+            time=summary["time"],
+            events_per_s=summary["n_events"] / summary["time"],
+            # Without drawing the toy events (the "source" stage)
+            processing_events_per_s=summary["n_events"] / processing_time,
+            stage_time=stage_time,
+            max_rss_mb=summary["max_rss_mb"],
+        )
+
+    print(f"{'case':10s} {'events':>7s} {'events/s':>9s} {'w/o src':>9s} {'RSS MB':>7s}  time per stage [s]")
+    for name, case in results["cases"].items():
+        if case["status"] != "done":
+            print(f"{name:10s} {case['status']}")
+            continue
+        stages = " ".join(f"{stage}={time:.2f}" for stage, time in case["stage_time"].items())
+        print(f"{name:10s} {case['n_events']:7d} {case['events_per_s']:9.2f} {case['processing_events_per_s']:9.2f} "
+              f"{case['max_rss_mb']:7.0f}  {stages}")
+
+    with open(args.output, "w") as stream:
+        json.dump(results, stream, indent=1)
+    print("Results in", args.output)
+
+    if args.compare is not None:
+        with open(args.compare) as stream:
+            reference = json.load(stream)
+        if compare(results, reference, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -61,8 +61,7 @@ import graphviz
 import matplotlib.pyplot as plt
 
 from datapipe_testbench import benchmarks
-from datapipe_testbench.benchmark import MissingInputError
-from datapipe_testbench.store import InputDataset, MetricsStore, ResultStore
+from datapipe_testbench.store import InputDataset, ResultStore
 from datapipe_testbench.visualization import graphviz_inputs_to_benchmarks
 
 # %% [markdown]
@@ -180,23 +179,15 @@ graph
 # %% [markdown]
 # ### Pre-process the InputDatasets into MetricStores
 #
-# For each experiment's input_dataset, we will create a MetricStore with the same name, and run `benchmark.generate_metrics()` to fill it with the data:
+# For each experiment's input_dataset, we will create a MetricStore with the same name, and run `benchmark.generate_metrics()` to fill it with the data.
+#
+# `generate_metrics` of metrics_generation.py only runs the (input_dataset, benchmark) pairs whose inputs (dl3_irf, dl3_benchmark...) changed since their metrics were generated, on `metric_workers` processes (`force=True` to run them all):
 
 # %%
-metric_store_list = []
-for input_dataset in input_list:
-    print(f"* PROCESSING {input_dataset.name}")
-    metrics = MetricsStore.from_path_and_input_dataset(
-        experiments_path / input_dataset.name, input_dataset.to_dict()
-    )
-    metric_store_list.append(metrics)
-    for benchmark in benchmark_list:
-        print(f"    * GENERATING Metrics for: {benchmark.__class__.__name__}")
-        try:
-            benchmark.check_input_dataset(metrics.get_inputdata())
-            benchmark.generate_metrics(metrics)
-        except MissingInputError as err:
-            print(f"       -> {err}")
+from metrics_generation import generate_metrics
+
+metric_workers = 4
+metric_store_list = generate_metrics(input_list, benchmark_list, experiments_path, workers=metric_workers)
 
 # %%
 # !tree $experiments_path
@@ -215,9 +206,13 @@ import matplotlib.pyplot as plt
 #plt.style.use([{"axes.grid": True}, "vibrant"])
 
 # %% [markdown]
-# Now, let's load up the experiments. Each one is a MetricsStore object that cam be read from a Path using it's constructor:
+# Now, let's load up the experiments. Each one is a MetricsStore object that cam be read from a Path using it's constructor.
+#
+# `CachedMetricsStore` of metrics_cache.py is a MetricsStore whose metrics are read once, and shared by all the benchmarks of the study (`METRICS_CACHE` shows the cache hits and misses):
 
 # %%
+from metrics_cache import METRICS_CACHE, CachedMetricsStore
+
 experiments = [
     experiments_path / "Standard_Window",
     experiments_path / "Reduced_Window",
@@ -226,7 +221,7 @@ experiments = [
     #experiments_path / "prod6-north-alpha_zen20_az000",
     #experiments_path / "prod6-north-alpha_zen20_az180",
 ]
-loaded_metric_list = [MetricsStore(x) for x in experiments]
+loaded_metric_list = [CachedMetricsStore(x) for x in experiments]
 
 # %% [markdown]
 # Now, we can genreate the comparison plots.  Again we have to make a list of benchmarks that work with these Metrics. SInce this is the same notebook, we'll just reuse the `benchmarks_list` we defined before:
@@ -236,6 +231,7 @@ loaded_metric_list = [MetricsStore(x) for x in experiments]
 new_results = ResultStore(results_path / "study2")
 for benchmark in benchmark_list:
     benchmark.compare_to_reference(loaded_metric_list, new_results)
+METRICS_CACHE
 
 # %% [markdown]
 # ## Accessing individual plots from the intermediate experiment data
@@ -0,0 +1,271 @@
+"""
+Event-level sharding of a single simtel file across processes (`--shards N`)
+
+The calling process reads (decompresses, decodes) the events and runs the
+software trigger, then hands the triggered events out round-robin to N shard
+processes. Each shard has its own window chains and writes partial outputs,
+which are merged at the end. The shards are forked after the reader has
+built (or reused) the processors (see file_processing.get_processors), so
+they inherit them rather than building their own. This cuts the time spent on the largest (proton)
+files, which otherwise make a long tail when processing one file per core.
+"""
+import multiprocessing
+import os
+import queue
+import resource
+import traceback
+from contextlib import ExitStack
+from pathlib import Path
+from time import perf_counter
+
+import tables
+from ctapipe.io import EventSource
+
+from file_processing import (
+    get_processors, open_writers, output_checksums, run_chains, stage_time_summary, window_label,
+)
+from file_utils import ensure_group
+from input_stage import read_ahead
+from output_profile import repack
+from stage_timing import StageTimer, write_timing
+
+
+def shard_file_name(out_file, shard):
+    """e.g. ....redwindow.h5 -> ....redwindow.shard03.h5"""
+    return str(Path(out_file).with_suffix(f".shard{shard:02d}.h5"))
+
+
+def merge_shards(shard_files, out_file, chunk_size=100_000):
+    """
+    Merge the outputs of the shards of one file into out_file.
+
+    The first shard is taken as it is (configuration, and shower distributions,
+    which are only written by shard 0). The event tables (.../event/...) of the
+    other shards are appended to it, or copied when the first shard doesn't
+    have them (e.g. a telescope only in events of another shard).
+    Events end up grouped by shard, not in the order of the simtel file.
+    """
+    os.replace(shard_files[0], out_file)
+    with tables.open_file(out_file, mode="a") as out:
+        for shard_file in shard_files[1:]:
+            with tables.open_file(shard_file) as shard:
+                for table in shard.walk_nodes("/", classname="Table"):
+                    path = table._v_pathname
+                    if "/event/" not in path:
+                        continue
+                    if path in out:
+                        out_table = out.get_node(path)
+                        for start in range(0, table.nrows, chunk_size):
+                            out_table.append(table.read(start, start + chunk_size))
+                    else:
+                        table._f_copy(newparent=ensure_group(out, table._v_parent._v_pathname))
+            os.remove(shard_file)
+
+
+def _shard_errors(result_queue):
+    """Errors of the results already sent by the shards (e.g. by a shard that stopped on an exception)"""
+    errors = []
+    while True:
+        try:
+            result = result_queue.get(timeout=1)
+        except queue.Empty:
+            return errors
+        if result["error"] is not None:
+            errors.append(result["error"])
+
+
+def _put(event_queue, item, process, result_queue):
+    """Put item in the queue of a shard, failing with its error if the shard process died"""
+    while True:
+        try:
+            event_queue.put(item, timeout=10)
+            return
+        except queue.Full:
+            if not process.is_alive():
+                raise RuntimeError("\n".join(
+                    [f"Shard process {process.name} died (exit code {process.exitcode})",
+                     *_shard_errors(result_queue)]
+                ))
+
+
+def _get_result(result_queue, processes):
+    while True:
+        try:
+            return result_queue.get(timeout=10)
+        except queue.Empty:
+            if not any(process.is_alive() for process in processes):
+                raise RuntimeError("Shard process(es) died without a result")
+
+
+def _shard_worker(shard, input_path, shard_out_files, tels_alpha, dl1_to_dl2, readout_windows,
+                  sample_events, histograms, output_profile, event_queue, result_queue):
+    """
+    Process the events of event_queue with its own window chains, until ("end", distributions)
+    """
+    result = dict(shard=shard, n_written=0, error=None, max_rss_mb=0., timers=None, sample_events=None,
+                  histograms=None, triage=None)
+    try:
+        # Not iterated, only for the subarray and metadata of the outputs
+        source = EventSource(input_path, allowed_tels=tels_alpha)
+        _, chains = get_processors(source.subarray, dl1_to_dl2, shard_out_files, readout_windows)
+        for chain in chains:
+            chain.reset(sample_events, histograms)
+        with ExitStack() as stack:
+            writers = open_writers(stack, source, shard_out_files, output_profile)
+            while True:
+                kind, item = event_queue.get()
+                if kind == "end":
+                    if item is not None:
+                        for writer in writers:
+                            writer.write_simulated_shower_distributions(item)
+                    break
+                run_chains(item, chains, writers)
+                result["n_written"] += 1
+        source.close()
+        result["timers"] = [chain.timer for chain in chains]
+        result["sample_events"] = [chain.sample_events for chain in chains]
+        result["histograms"] = [chain.histograms for chain in chains]
+        result["triage"] = [chain.triage_stats for chain in chains]
+    except Exception:
+        result["error"] = f"Shard {shard}:\n" + traceback.format_exc()
+    result["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    result_queue.put(result)
+
+
+def process_file_sharded(in_file, out_files, tels_alpha, dl1_to_dl2, readout_windows=None,
+                         label="", progress_prefix=None, n_shards=2, queue_size=20, throughput_interval=None,
+                         sample_events=0, n_read_ahead=0, input_path=None, output_profile=None, histograms=False):
+    """
+    As file_processing.process_file, but with the triggered events of in_file
+    processed by n_shards processes. Returns the same summary.
+
+    The stage timing, sample events, running histograms and triage counts of
+    the shards are merged, and written in the merged outputs.
+    """
+    in_path = Path(in_file)
+    print(f"{label}:" if label else "", in_path.stem,
+          *[window_label(window) for window in out_files], f"({n_shards} shards)", flush=True)
+
+    summary = dict(in_file=str(in_file), out_files=dict(out_files), status="failed",
+                   n_events=0, n_written=0, time=0., error=None)
+    t_start = perf_counter()
+
+    context = multiprocessing.get_context("fork")
+    shard_out_files = [
+        {window: shard_file_name(out_file, shard) for window, out_file in out_files.items()}
+        for shard in range(n_shards)
+    ]
+    event_queues = [context.Queue(maxsize=queue_size) for _ in range(n_shards)]
+    result_queue = context.Queue()
+    processes = [
+        context.Process(
+            target=_shard_worker,
+            args=(shard, input_path or in_file, shard_out_files[shard], tels_alpha, dl1_to_dl2, readout_windows,
+                  sample_events, histograms, output_profile, event_queues[shard], result_queue),
+            name=f"{in_path.stem}-shard{shard:02d}",
+            daemon=True,
+        )
+        for shard in range(n_shards)
+    ]
+    try:
+        source = EventSource(input_path or in_file, allowed_tels=tels_alpha)
+        software_trigger, _ = get_processors(source.subarray, dl1_to_dl2, out_files, readout_windows)
+        for process in processes:
+            process.start()
+
+        read_timer = StageTimer(source.subarray, name=progress_prefix or in_path.stem,
+                                throughput_interval=throughput_interval)
+        n_sent = 0
+        events = read_ahead(source, n_read_ahead) if n_read_ahead > 0 else iter(source)
+        while True:
+            with read_timer.stage("source"):
+                event = next(events, None)
+            if event is None:
+                break
+            read_timer.event_done()
+            event_count = event.count
+            if not event_count%1000:
+                if progress_prefix is None:
+                    print(event_count, end=" ", flush=True)
+                else:
+                    print(f"{progress_prefix}: {event_count} events", flush=True)
+            summary["n_events"] += 1
+            with read_timer.stage("software_trigger"):
+                triggered = software_trigger(event)
+            if triggered:
+                shard = n_sent % n_shards
+                # Includes the time waiting for the shard to take the event
+                with read_timer.stage("send_to_shard"):
+                    _put(event_queues[shard], ("event", event), processes[shard], result_queue)
+                n_sent += 1
+
+        # The shower distributions are complete once all events are read, only shard 0 writes them
+        for shard in range(n_shards):
+            distributions = source.simulated_shower_distributions if shard == 0 else None
+            _put(event_queues[shard], ("end", distributions), processes[shard], result_queue)
+        source.close()
+        if progress_prefix is None:
+            print()
+
+        results = [_get_result(result_queue, processes) for _ in processes]
+        for process in processes:
+            process.join()
+        errors = [result["error"] for result in results if result["error"] is not None]
+        if errors:
+            raise RuntimeError("\n".join(errors))
+
+        summary["n_written"] = sum(result["n_written"] for result in results)
+        summary["max_rss_mb_shards"] = max(result["max_rss_mb"] for result in results)
+        chain_timers = results[0]["timers"]
+        chain_samples = results[0]["sample_events"]
+        chain_histograms = results[0]["histograms"]
+        chain_triage = results[0]["triage"]
+        for result in results[1:]:
+            for timer, shard_timer in zip(chain_timers, result["timers"]):
+                timer.merge(shard_timer)
+            for samples, shard_samples in zip(chain_samples, result["sample_events"]):
+                if samples is not None:
+                    samples.merge(shard_samples)
+            for window_histograms, shard_histograms in zip(chain_histograms, result["histograms"]):
+                if window_histograms is not None:
+                    window_histograms.merge(shard_histograms)
+            for triage_stats, shard_triage_stats in zip(chain_triage, result["triage"]):
+                if triage_stats is not None:
+                    triage_stats.merge(shard_triage_stats)
+        for num_window, (window, out_file) in enumerate(out_files.items()):
+            merge_shards([files[window] for files in shard_out_files], out_file)
+            write_timing(out_file, read_timer, chain_timers[num_window])
+            if chain_samples[num_window] is not None:
+                chain_samples[num_window].write(out_file)
+            if chain_histograms[num_window] is not None:
+                chain_histograms[num_window].write(out_file)
+            if chain_triage[num_window] is not None:
+                chain_triage[num_window].write(out_file, chain_timers[num_window])
+            repack(out_file, output_profile)
+        summary["stage_time"] = stage_time_summary(read_timer, chain_timers)
+        summary["outputs"] = output_checksums(out_files)
+        summary["status"] = "done"
+    except Exception:
+        summary["error"] = traceback.format_exc()
+        for out_file in out_files.values():
+            if os.path.exists(out_file):
+                os.remove(out_file)
+    finally:
+        for process in processes:
+            if process.pid is None:
+                continue
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        # Events left in the queues of failed shards would block the exit of this process
+        for process_queue in [*event_queues, result_queue]:
+            process_queue.cancel_join_thread()
+            process_queue.close()
+        for files in shard_out_files:
+            for shard_file in files.values():
+                if os.path.exists(shard_file):
+                    os.remove(shard_file)
+
+    summary["time"] = perf_counter() - t_start
+    summary["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return summary
@@ -0,0 +1,511 @@
+"""
+Per-file processing for Make_reduced_Readout_window_file.py
+
+Each simtel file gets its own EventSource/CameraCalibrator/ImageProcessor/
+ShowerProcessor/DataWriter chain, so that files can be handed out to a pool
+of worker processes (`--workers N`).
+
+A file can be processed for several readout windows at once ("std" for the
+window as simulated, "red" for the reduced window), each window with its own
+calibrator, processors and output file, reading and decompressing the events
+only once (`--both-windows`). The same goes for the windows of a scan
+(`--window-scan`, see window_scan.yml): the branches of an event share its
+decoded waveforms, each branch only slicing its own window out of them.
+
+The software trigger and window chains are built once per process and reused
+for the following files as long as their subarray (by `subarray_hash`) and
+configuration are the same, rather than rebuilt for every file.
+
+With `"batched": true` in the dl1_to_dl2 configuration (`--batched`), the
+telescopes of the same type of each event are calibrated and cleaned together
+(see batched_calibration.py). With `"triage": "skip"` or `"validate"`
+(`--triage`), the telescopes whose image can't pass the image quality query
+are triaged before the calibration (see image_triage.py).
+"""
+import hashlib
+import json
+import os
+import resource
+import traceback
+import multiprocessing
+from contextlib import ExitStack
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+from copy import copy
+from functools import partial
+from pathlib import Path
+from time import perf_counter
+
+from ctapipe.io import EventSource, DataWriter
+from ctapipe.calib import CameraCalibrator
+from ctapipe.instrument import SoftwareTrigger, SubarrayDescription
+from ctapipe.image import ImageProcessor
+from ctapipe.reco import ShowerProcessor
+from traitlets.config import Config
+
+from batched_calibration import BatchedCameraCalibrator, batched_image_processor_config
+from file_utils import file_sha256
+from image_triage import ImageTriage, TriageStats
+from input_stage import FileStager, read_ahead
+from output_profile import apply_output_profile, repack, writer_config
+from readout_window import ReadoutWindowReducer
+from running_histograms import RunningHistograms
+from sample_events import EventReservoir
+from stage_timing import StageTimer, write_timing
+from window_names import SCAN_PREFIX, WINDOW_SUFFIXES
+
+
+def subarray_hash(subarray):
+    """
+    sha256 of what the processors depend on in subarray: telescope ids, types,
+    positions, camera geometries and readouts
+    """
+    sha = hashlib.sha256()
+    for tel_id, tel in sorted(subarray.tel.items()):
+        camera = tel.camera
+        # As python types: a subarray read back from HDF5 has e.g. numpy tel_ids
+        sha.update(repr((
+            int(tel_id), str(tel), tel.optics.name,
+            subarray.positions[tel_id].to_value("m").round(3).tolist(),
+            camera.name, int(camera.geometry.n_pixels),
+            int(camera.readout.n_samples), int(camera.readout.n_channels),
+            float(camera.readout.sampling_rate.to_value("GHz")),
+        )).encode())
+    return sha.hexdigest()
+
+
+def subarray_production(in_file):
+    """
+    Production of a simtel file, which fixes its subarray: the part of the file
+    name after "___" (e.g. cta-prod6-lapalma-2147m-LaPalma-dark: site,
+    altitude, layout), or the whole file name if it doesn't have one
+    """
+    name = Path(in_file).name
+    return name.partition("___")[2].split(".")[0] or name
+
+
+def load_subarray(in_file, tels_alpha, cache_dir):
+    """
+    SubarrayDescription of in_file restricted to tels_alpha, read from a cache
+    file in cache_dir if there is one for the production of in_file (see
+    subarray_production) and these telescopes, otherwise from in_file (and
+    then cached). The processors are still checked against the subarray of
+    each file, by subarray_hash (see get_processors).
+    """
+    key = hashlib.sha1(repr((subarray_production(in_file), sorted(tels_alpha))).encode()).hexdigest()[:10]
+    cache_file = os.path.join(cache_dir, f"subarray_{key}.h5")
+    if os.path.exists(cache_file):
+        return SubarrayDescription.from_hdf(cache_file)
+
+    with EventSource(in_file, allowed_tels=tels_alpha) as source:
+        subarray = source.subarray
+    os.makedirs(cache_dir, exist_ok=True)
+    subarray.to_hdf(cache_file, overwrite=True)
+    return subarray
+
+
+def output_file_name(in_file, out_dir, window):
+    """
+    Output file for a given simtel file and window ("std", "red", or "scan_<name>"), e.g.
+    gamma_..._run000001___cta-prod6-...simtel.zst -> OUT_DIR/gamma_..._run000001___cta-prod6-....redwindow.h5
+    (or ....scan_<name>.h5)
+    """
+    out_file = Path(in_file).stem[:-7]  # Remove the ".simtel" left after removing ".zst"
+    return os.path.join(out_dir, out_file + WINDOW_SUFFIXES.get(window, f".{window}.h5"))
+
+
+def window_label(window):
+    return {"std": "StandardWindow", "red": "ReducedWindow"}.get(window, window)
+
+
+def reducer_config(window, readout_windows):
+    """
+    Configuration of the ReadoutWindowReducer of window, None for the window as simulated.
+
+    readout_windows is the content of readout_windows.yml, with the configuration
+    of each window of a scan in readout_windows["WindowScan"] (see
+    readout_window.scan_window_configs).
+    """
+    if window == "std":
+        return None
+    if window.startswith(SCAN_PREFIX):
+        return readout_windows["WindowScan"][window[len(SCAN_PREFIX):]]
+    return {key: value for key, value in (readout_windows or {}).items() if key != "WindowScan"}
+
+
+def branch_event(event):
+    """
+    Copy of event for an independent processing branch, without copying waveforms.
+
+    Simulation, trigger, pointing etc. are shared with event. The r0/r1
+    telescope containers are copied, so that a branch can replace its
+    waveforms by a reduced window without touching the ones of event, and
+    dl0/dl1/dl2 are new, empty, containers for the branch's own calibrator
+    and processors to fill.
+    """
+    branch = copy(event)
+    for level in ("r0", "r1"):
+        level_container = type(getattr(event, level))()
+        for tel_id, tel_container in getattr(event, level).tel.items():
+            level_container.tel[tel_id] = copy(tel_container)
+        setattr(branch, level, level_container)
+    for level in ("dl0", "dl1", "dl2"):
+        setattr(branch, level, type(getattr(event, level))())
+    return branch
+
+
+class WindowChain:
+    """
+    (Reduced readout window), calibrator, image and shower processor for one output,
+    with the time spent in each stage in self.timer
+    """
+
+    def __init__(self, subarray, dl1_to_dl2, window, readout_windows=None):
+        self.window = window
+        self.subarray = subarray
+        self.triage_mode = dl1_to_dl2.get("triage")
+        self.timing_by_type = dl1_to_dl2.get("timing_by_type", False)
+        self.reset()
+        config = reducer_config(window, readout_windows)
+        if config is None:
+            self.reducer = None
+        else:
+            self.reducer = ReadoutWindowReducer(subarray=subarray, config=Config(config))
+        self.batched = dl1_to_dl2.get("batched", False)
+        if self.batched:
+            self.calibrator = BatchedCameraCalibrator(subarray=subarray)
+            image_processor_config = batched_image_processor_config(dl1_to_dl2["ImageProcessor"])
+        else:
+            self.calibrator = CameraCalibrator(subarray=subarray)
+            image_processor_config = dl1_to_dl2["ImageProcessor"]
+        self.image_processor = ImageProcessor(
+             subarray=subarray, config=Config(image_processor_config)
+        )
+        self.shower_processor = ShowerProcessor(subarray=subarray)
+        if self.triage_mode is None:
+            self.triage = None
+        else:
+            self.triage = ImageTriage(subarray, self.calibrator, self.image_processor, self.triage_mode)
+
+    def reset(self, sample_events=0, histograms=False):
+        """
+        New (empty) stage timer, e.g. for the next file, reservoir of sample
+        events (see sample_events.py) if sample_events > 0, running
+        histograms (see running_histograms.py) if histograms, and triage
+        counts (see image_triage.py) with the triage
+        """
+        self.timer = StageTimer(self.subarray, name=self.window, by_type=self.timing_by_type)
+        self.triage_stats = None if self.triage_mode is None else TriageStats.from_subarray(self.subarray,
+                                                                                             self.triage_mode)
+        self.sample_events = EventReservoir(sample_events) if sample_events > 0 else None
+        if histograms:
+            self.histograms = RunningHistograms.from_subarray(self.subarray)
+        else:
+            self.histograms = None
+
+    def process_images(self, event):
+        if self.batched and hasattr(self.image_processor.clean, "prepare"):
+            self.image_processor.clean.prepare(event)
+        self.image_processor(event)
+
+    def __call__(self, event):
+        timer = self.timer
+        if self.reducer is not None:
+            if self.reducer.mode == "fixed":
+                windows = self.reducer.windows
+            else:
+                with timer.stage("peak_finder"):
+                    windows = self.reducer.event_windows(event)
+            with timer.stage("reducer"):
+                self.reducer(event, windows)
+        triaged = None
+        if self.triage is not None:
+            with timer.stage("triage"):
+                triaged = self.triage(event, self.triage_stats)
+        timer.stage_by_type("calibrator", event, self.calibrator)
+        timer.stage_by_type("image_processor", event, self.process_images)
+        if triaged:
+            with timer.stage("triage_finish"):
+                self.triage.finish(event, triaged, self.triage_stats)
+        with timer.stage("shower_processor"):
+            self.shower_processor(event)
+
+
+# Processors of this process (each pool worker has its own), see get_processors
+_processors = {}
+
+
+def get_processors(subarray, dl1_to_dl2, windows, readout_windows=None):
+    """
+    (software trigger, [WindowChain for each window]) for subarray, reused from
+    the previous file if it had the same subarray (by hash) and configuration,
+    with the chain timers reset.
+    """
+    key = (
+        subarray_hash(subarray),
+        tuple(windows),
+        json.dumps([dl1_to_dl2, readout_windows], sort_keys=True, default=str),
+    )
+    if key not in _processors:
+        # Only the latest subarray/configuration is kept
+        _processors.clear()
+        software_trigger = SoftwareTrigger(subarray=subarray, config=Config(dl1_to_dl2["SoftwareTrigger"]))
+        chains = [WindowChain(subarray, dl1_to_dl2, window, readout_windows) for window in windows]
+        _processors[key] = (software_trigger, chains)
+    else:
+        software_trigger, chains = _processors[key]
+        for chain in chains:
+            chain.reset()
+    return software_trigger, chains
+
+
+def open_writers(stack, source, out_files, output_profile=None):
+    """
+    A DataWriter (dl1 parameters and dl2) for each output, closed with the
+    ExitStack stack, writing what output_profile keeps (see output_profile.py)
+    """
+    writers = []
+    for out_file in out_files.values():
+        writer = stack.enter_context(
+            DataWriter(source, output_path=out_file, overwrite=True, write_dl1_parameters=True, write_dl2=True,
+                       config=writer_config(output_profile))
+        )
+        apply_output_profile(writer, output_profile)
+        writers.append(writer)
+    return writers
+
+
+def run_chains(event, chains, writers):
+    """
+    Process and write a triggered event with each window chain, all but the
+    last chain working on a branch of the event.
+    """
+    for num_chain, (chain, writer) in enumerate(zip(chains, writers)):
+        if num_chain == len(chains) - 1:
+            chain_event = event
+        else:
+            with chain.timer.stage("branch_event"):
+                chain_event = branch_event(event)
+        chain(chain_event)
+        with chain.timer.stage("writer"):
+            writer(chain_event)
+        if chain.sample_events is not None:
+            with chain.timer.stage("sample_events"):
+                chain.sample_events.offer(chain_event)
+        if chain.histograms is not None:
+            with chain.timer.stage("histograms"):
+                chain.histograms.offer(chain_event)
+        chain.timer.event_done()
+
+
+def stage_time_summary(read_timer, chain_timers):
+    """{stage: total wall time [s]}, with the stages of the chains as window:stage"""
+    stage_time = read_timer.totals()
+    for timer in chain_timers:
+        stage_time.update({f"{timer.name}:{stage}": time for stage, time in timer.totals().items()})
+    return stage_time
+
+
+def output_checksums(out_files):
+    """Size and sha256 of each output, for the manifest"""
+    return {
+        out_file: dict(size=os.path.getsize(out_file), sha256=file_sha256(out_file))
+        for out_file in out_files.values()
+    }
+
+
+def process_file(in_file, out_files, tels_alpha, dl1_to_dl2, readout_windows=None,
+                 label="", progress_prefix=None, sample_events=0, throughput_interval=None,
+                 n_read_ahead=0, input_path=None, output_profile=None, histograms=False, source=None):
+    """
+    Run the software trigger on one simtel file, then for each window in
+    out_files ({window: out_file}) the (reduced window), calibration, image and
+    shower processing, writing dl1 parameters and dl2 to its out_file.
+
+    Each event is read once; when there is more than one window, all but the
+    last window get a branch of the event (see `branch_event`).
+
+    The time spent in each stage is written in each output (see stage_timing.py),
+    with the events/s printed every throughput_interval seconds, if given.
+    With sample_events > 0, as many events are sampled for plotting, and written
+    in each output (see sample_events.py). With histograms, running histograms
+    of the events are written in each output (see running_histograms.py).
+
+    With n_read_ahead > 0, events are read by a background thread up to that
+    many events ahead (see input_stage.py), the "source" stage is then the time
+    waiting for them. input_path is where to read in_file from, if not in_file
+    itself (e.g. a copy on local scratch). source is an EventSource to read
+    instead of in_file (e.g. the synthetic events of bench_synthetic.py).
+
+    output_profile selects the columns, precision and compression of the
+    outputs (see output_profile.py), None for the DataWriter defaults.
+
+    Any exception is caught and returned in the summary (and the partial outputs
+    removed), so that one corrupt file does not stop a whole batch. The size and
+    checksum of the outputs are in summary["outputs"], for the manifest.
+    """
+    in_path = Path(in_file)
+    print(f"{label}:" if label else "", in_path.stem,
+          *[window_label(window) for window in out_files], flush=True)
+
+    summary = dict(in_file=str(in_file), out_files=dict(out_files), status="failed",
+                   n_events=0, n_written=0, time=0., error=None)
+    t_start = perf_counter()
+    try:
+        if source is None:
+            source = EventSource(input_path or in_file, allowed_tels=tels_alpha)
+        software_trigger, chains = get_processors(source.subarray, dl1_to_dl2, out_files, readout_windows)
+        for chain in chains:
+            chain.reset(sample_events, histograms)
+        read_timer = StageTimer(source.subarray, name=progress_prefix or in_path.stem,
+                                throughput_interval=throughput_interval)
+
+        with ExitStack() as stack:
+            writers = open_writers(stack, source, out_files, output_profile)
+
+            events = read_ahead(source, n_read_ahead) if n_read_ahead > 0 else iter(source)
+            while True:
+                # Reading includes the decompression and decoding of the simtel file (unless read ahead)
+                with read_timer.stage("source"):
+                    event = next(events, None)
+                if event is None:
+                    break
+                read_timer.event_done()
+                event_count = event.count
+                if not event_count%1000:
+                    if progress_prefix is None:
+                        print(event_count, end=" ", flush=True)
+                    else:
+                        print(f"{progress_prefix}: {event_count} events", flush=True)
+                summary["n_events"] += 1
+                with read_timer.stage("software_trigger"):
+                    triggered = software_trigger(event)
+                if triggered:
+                    run_chains(event, chains, writers)
+                    summary["n_written"] += 1
+
+            # Added to get the shower distribution histograms in the file
+            for writer in writers:
+                writer.write_simulated_shower_distributions(source.simulated_shower_distributions)
+            if progress_prefix is None:
+                print()
+
+        source.close()
+        for chain, out_file in zip(chains, out_files.values()):
+            write_timing(out_file, read_timer, chain.timer)
+            if chain.sample_events is not None:
+                chain.sample_events.write(out_file)
+            if chain.histograms is not None:
+                chain.histograms.write(out_file)
+            if chain.triage_stats is not None:
+                chain.triage_stats.write(out_file, chain.timer)
+            repack(out_file, output_profile)
+        summary["stage_time"] = stage_time_summary(read_timer, [chain.timer for chain in chains])
+        summary["outputs"] = output_checksums(out_files)
+        summary["status"] = "done"
+    except Exception:
+        summary["error"] = traceback.format_exc()
+        for out_file in out_files.values():
+            if os.path.exists(out_file):
+                os.remove(out_file)
+
+    summary["time"] = perf_counter() - t_start
+    # Peak resident memory of this process so far (kB on linux)
+    summary["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return summary
+
+
+def process_files(simtel_files, out_dir, tels_alpha, dl1_to_dl2, windows, readout_windows=None,
+                  workers=1, shards=1, file_numbers=None, n_total=None, throughput_interval=None, sample_events=0,
+                  n_read_ahead=0, stage_dir=None, output_profile=None, histograms=False):
+    """
+    Process a list of simtel files for the given windows (e.g. ["red"], or
+    ["std", "red"]), yielding the summary of each file when done.
+
+    With workers > 1, files are sent to a pool of worker processes (order of
+    completion, not of the list). "fork" is used, since the main script is a
+    notebook and can't be re-imported by "spawn" workers.
+
+    With shards > 1, the events of each file are processed by that many
+    processes (see event_sharding.py), for each of the workers.
+
+    With stage_dir, the next files are copied to stage_dir while the current
+    ones are processed, and read from there (see input_stage.py); the time
+    waited for a copy is in summary["staging_wait"].
+
+    The progress labels are "File <number> of <n_total>", with the numbers of
+    the files in file_numbers (e.g. their place in the full list, when some
+    are skipped), by default 1, 2... of len(simtel_files).
+    """
+    if file_numbers is None:
+        file_numbers = range(1, len(simtel_files) + 1)
+    if n_total is None:
+        n_total = len(simtel_files)
+
+    if shards > 1:
+        from event_sharding import process_file_sharded
+        process = partial(process_file_sharded, n_shards=shards, throughput_interval=throughput_interval,
+                          sample_events=sample_events, n_read_ahead=n_read_ahead, output_profile=output_profile,
+                          histograms=histograms)
+    else:
+        process = partial(process_file, throughput_interval=throughput_interval,
+                          sample_events=sample_events, n_read_ahead=n_read_ahead, output_profile=output_profile,
+                          histograms=histograms)
+
+    def file_args(num_file, in_file):
+        out_files = {window: output_file_name(in_file, out_dir, window) for window in windows}
+        label = f"File {file_numbers[num_file]} of {n_total}"
+        return (in_file, out_files, tels_alpha, dl1_to_dl2, readout_windows, label)
+
+    stager = FileStager(simtel_files, stage_dir, n_staged=workers + 1) if stage_dir is not None else None
+
+    def staged(in_file):
+        """(extra arguments of process, time waited for the staged copy [s])"""
+        if stager is None:
+            return {}, 0.
+        input_path, staging_wait = stager.get(in_file)
+        return dict(input_path=input_path), staging_wait
+
+    def done(summary, staging_wait):
+        if stager is not None:
+            stager.release(summary["in_file"])
+            summary["staging_wait"] = staging_wait
+        return summary
+
+    try:
+        if workers <= 1:
+            for num_file, in_file in enumerate(simtel_files):
+                extra, staging_wait = staged(in_file)
+                yield done(process(*file_args(num_file, in_file), **extra), staging_wait)
+            return
+
+        context = multiprocessing.get_context("fork")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+            futures = {}
+
+            def result(future):
+                args, staging_wait = futures.pop(future)
+                try:
+                    summary = future.result()
+                except Exception:
+                    # e.g. worker killed (BrokenProcessPool), the file itself is not to blame
+                    in_file, out_files = args[:2]
+                    summary = dict(in_file=str(in_file), out_files=out_files, status="failed",
+                                   n_events=0, n_written=0, time=0., error=traceback.format_exc())
+                return done(summary, staging_wait)
+
+            for num_file, in_file in enumerate(simtel_files):
+                if stager is not None:
+                    # Submitted as they are staged, with no more files in the pool than workers
+                    while len(futures) >= workers:
+                        finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                        for future in finished:
+                            yield result(future)
+                extra, staging_wait = staged(in_file)
+                args = file_args(num_file, in_file)
+                future = pool.submit(process, *args, progress_prefix=Path(in_file).stem, **extra)
+                futures[future] = (args, staging_wait)
+            for future in as_completed(list(futures)):
+                yield result(future)
+    finally:
+        if stager is not None:
+            stager.close()
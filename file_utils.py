@@ -0,0 +1,34 @@
+"""
+File and HDF5 helpers shared by the processing, the pipeline and the caches
+"""
+import hashlib
+import os
+
+
+def file_sha256(path, block_size=2**20):
+    """sha256 of a file, read by blocks"""
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def file_sha256_entry(path, entry=None):
+    """
+    dict(size, mtime_ns, sha256) of path: entry (from a previous call) if the
+    size and modification time of path are unchanged, else with the sha256
+    computed again
+    """
+    stat = os.stat(path)
+    if entry is not None and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+        return entry
+    return dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns, sha256=file_sha256(path))
+
+
+def ensure_group(h5file, path):
+    """Group path of the open (pytables) h5file, created (with its parents) if missing"""
+    if path in h5file:
+        return h5file.get_node(path)
+    parent, name = path.rsplit("/", 1)
+    return h5file.create_group(parent or "/", name, createparents=True)
@@ -0,0 +1,290 @@
+"""
+Triage of the telescope events before the calibration (`--triage skip`):
+telescopes whose image can't pass the ImageQualityQuery of dl1_to_dl2.yml
+("image.sum() > 50", "np.count_nonzero(image) > 2" on the cleaned image)
+are not calibrated nor cleaned, and get the parameters of a failed quality query
+
+The image is estimated in numpy for the whole camera, from the window sums of
+the extractor over the (reduced) R1 waveforms, cleaned with the tailcuts of the
+image processor. Telescopes for which the estimate is not meaningful (other
+extractors, time shift calibration, broken pixels, ...) are not triaged.
+`--triage validate` processes all telescopes and counts the triaged ones that
+do pass the quality query (disagreements, expected 0).
+
+The counts per telescope type (and in skip mode, with `--timing-by-type`, an
+estimate of the time saved) are written in /processing/triage of each output,
+the disagreements in /processing/triage_disagreements.
+"""
+import re
+
+import numpy as np
+from astropy.table import Table
+from ctapipe.containers import DL1CameraContainer
+from ctapipe.image import TailcutsImageCleaner, tailcuts_clean
+from ctapipe.image.image_processor import DEFAULT_TRUE_IMAGE_PARAMETERS
+from ctapipe.io import write_table
+from scipy.sparse import identity
+
+TRIAGE_TABLE = "/processing/triage"
+DISAGREEMENT_TABLE = "/processing/triage_disagreements"
+TRIAGE_MODES = ("skip", "validate")
+# Extractors summing a window of samples (with the integration correction)
+WINDOW_SUM_EXTRACTORS = {"NeighborPeakWindowSum", "LocalPeakWindowSum", "GlobalPeakWindowSum"}
+# Disagreements kept (with their ids) per output
+MAX_DISAGREEMENTS = 1000
+# Scale of the cleaned charge estimate, so that images at the charge threshold are not triaged
+ESTIMATE_SCALE = 1.05
+
+
+def quality_thresholds(quality_criteria):
+    """
+    (min charge, min number of pixels) of the image quality criteria ("image.sum() > X",
+    "np.count_nonzero(image) > N"), None for those not found
+    """
+    min_charge = None
+    min_pixels = None
+    for _, criterion in quality_criteria:
+        match = re.fullmatch(r"\s*image\.sum\(\)\s*>\s*([0-9.eE+-]+)\s*", criterion)
+        if match:
+            min_charge = float(match.group(1))
+        match = re.fullmatch(r"\s*np\.count_nonzero\(image\)\s*>\s*([0-9]+)\s*", criterion)
+        if match:
+            min_pixels = int(match.group(1))
+    return min_charge, min_pixels
+
+
+class TriageStats:
+    """Counts of the triage per telescope type, and the disagreements of the validation"""
+
+    def __init__(self, tel_types, mode):
+        # {tel_id: telescope type}
+        self.tel_types = dict(tel_types)
+        self.mode = mode
+        types = sorted(set(self.tel_types.values()))
+        self.n_tel_events = dict.fromkeys(types, 0)
+        self.n_triaged = dict.fromkeys(types, 0)
+        self.n_not_checked = dict.fromkeys(types, 0)
+        self.n_disagreements = dict.fromkeys(types, 0)
+        # (obs_id, event_id, tel_id, hillas intensity, charge estimate)
+        self.disagreements = []
+
+    @classmethod
+    def from_subarray(cls, subarray, mode):
+        return cls({tel_id: str(tel) for tel_id, tel in subarray.tel.items()}, mode)
+
+    def merge(self, other):
+        """Add the counts of other (e.g. another shard)"""
+        for counts, other_counts in ((self.n_tel_events, other.n_tel_events), (self.n_triaged, other.n_triaged),
+                                     (self.n_not_checked, other.n_not_checked),
+                                     (self.n_disagreements, other.n_disagreements)):
+            for tel_type, count in other_counts.items():
+                counts[tel_type] = counts.get(tel_type, 0) + count
+        self.disagreements.extend(other.disagreements[:MAX_DISAGREEMENTS - len(self.disagreements)])
+
+    def to_table(self, timer):
+        """
+        One row per telescope type, with (in skip mode) the time saved
+        estimated from timer (the StageTimer of the chain, which times the
+        calibrator and image processor per telescope type with by_type)
+        """
+        rows = []
+        for tel_type in sorted(self.n_tel_events):
+            # Per telescope event of the type processed by each stage (in skip mode, not the triaged ones)
+            time_per_tel = 0.
+            for stage in ("calibrator", "image_processor"):
+                stage_wall, _, n_tel_events = timer.by_type.get((stage, tel_type), (0., 0., 0))
+                time_per_tel += stage_wall / n_tel_events if n_tel_events > 0 else np.nan
+            rows.append(dict(
+                tel_type=tel_type, n_tel_events=self.n_tel_events[tel_type], n_triaged=self.n_triaged[tel_type],
+                n_not_checked=self.n_not_checked[tel_type], n_disagreements=self.n_disagreements[tel_type],
+                # Nothing is skipped in validate mode
+                time_saved_s=self.n_triaged[tel_type] * time_per_tel if self.mode == "skip" else np.nan,
+            ))
+        names = ["tel_type", "n_tel_events", "n_triaged", "n_not_checked", "n_disagreements", "time_saved_s"]
+        table = Table(rows=rows, names=names) if rows else Table(names=names, dtype=[str, int, int, int, int, float])
+        table.meta["mode"] = self.mode
+        table.meta["comment"] = (
+            "time_saved_s: estimate, triaged x measured (calibrator + image_processor) time per processed "
+            "telescope event of the type (an upper estimate: the images failing the quality query are not "
+            "parameterized); nan in validate mode, and without --timing-by-type"
+        )
+        return table
+
+    def write(self, out_file, timer):
+        """Write the counts (TRIAGE_TABLE) and disagreements (DISAGREEMENT_TABLE) in out_file"""
+        write_table(self.to_table(timer), out_file, TRIAGE_TABLE, overwrite=True)
+        if self.mode == "validate":
+            names = ["obs_id", "event_id", "tel_id", "hillas_intensity", "charge_estimate"]
+            disagreements = Table(rows=self.disagreements, names=names, dtype=[np.int64, np.int64, np.int16,
+                                                                               np.float64, np.float64])
+            write_table(disagreements, out_file, DISAGREEMENT_TABLE, overwrite=True)
+
+
+class ImageTriage:
+    """
+    Triage (see the module docstring) with the settings of the calibrator and
+    image processor of a window chain, in mode "skip" or "validate"
+    """
+
+    def __init__(self, subarray, calibrator, image_processor, mode="skip"):
+        if mode not in TRIAGE_MODES:
+            raise ValueError(f"Triage mode {mode!r} is not one of {TRIAGE_MODES}")
+        self.subarray = subarray
+        self.calibrator = calibrator
+        self.image_processor = image_processor
+        self.mode = mode
+        self.min_charge, self.min_pixels = quality_thresholds(image_processor.check_image.quality_criteria)
+        self._settings = {tel_id: self._tel_settings(tel_id) for tel_id in subarray.tel}
+        # r1 of the triaged telescopes of the current event (skip mode)
+        self._set_aside = {}
+
+    def _tel_settings(self, tel_id):
+        """
+        (largest integration correction of the gains, window width, window
+        shift, peak (see below), tailcuts settings (None for other cleaners))
+        of tel_id, None if it can't be triaged
+        """
+        if self.min_charge is None and self.min_pixels is None:
+            return None
+        if self.image_processor.apply_image_modifier.tel[tel_id]:
+            return None
+        extractor_type = self.calibrator.image_extractor_type.tel[tel_id]
+        if extractor_type not in WINDOW_SUM_EXTRACTORS:
+            return None
+        extractor = self.calibrator.image_extractors[extractor_type]
+        correction = 1.
+        if extractor.apply_integration_correction.tel[tel_id]:
+            correction = float(np.max(extractor._calculate_correction(tel_id=tel_id)))
+        geometry = self.subarray.tel[tel_id].camera.geometry
+        # Peak of the window of each pixel: of the neighbours (and local_weight x the pixel) summed
+        # waveform, of the pixel waveform (None), or of the brightest pixels of the camera (their number)
+        if extractor_type == "NeighborPeakWindowSum":
+            local_weight = extractor.local_weight.tel[tel_id]
+            peak = geometry.neighbor_matrix_sparse + local_weight * identity(geometry.n_pixels, format="csr")
+        elif extractor_type == "LocalPeakWindowSum":
+            peak = None
+        else:
+            peak = max(1, int(extractor.pixel_fraction.tel[tel_id] * geometry.n_pixels))
+        cleaner = self.image_processor.clean
+        cleaning = None
+        if isinstance(cleaner, TailcutsImageCleaner):
+            cleaning = dict(
+                picture_thresh=cleaner.picture_threshold_pe.tel[tel_id],
+                boundary_thresh=cleaner.boundary_threshold_pe.tel[tel_id],
+                min_number_picture_neighbors=cleaner.min_picture_neighbors.tel[tel_id],
+                keep_isolated_pixels=cleaner.keep_isolated_pixels.tel[tel_id],
+            )
+        return correction, extractor.window_width.tel[tel_id], extractor.window_shift.tel[tel_id], peak, cleaning
+
+    def _checked(self, event, tel_id):
+        """Whether the estimate is meaningful for the telescope event"""
+        if self._settings[tel_id] is None:
+            return False
+        r1 = event.r1.tel[tel_id]
+        # Gain selected waveforms only
+        if r1.waveform is None or r1.waveform.shape[0] != 1 or r1.waveform.shape[-1] == 1:
+            return False
+        calibration = event.calibration.tel[tel_id].dl1
+        if (calibration.pedestal_offset is not None
+                or calibration.relative_factor is not None or calibration.absolute_factor is not None):
+            return False
+        # The time shift calibration (all simtel telescopes) only changes the charges if the waveforms are shifted
+        if calibration.time_shift is not None and self.calibrator.apply_waveform_time_shift.tel[tel_id]:
+            return False
+        pixel_status = event.mon.tel[tel_id].pixel_status
+        for mask in (pixel_status.hardware_failing_pixels, pixel_status.pedestal_failing_pixels,
+                     pixel_status.flatfield_failing_pixels):
+            if mask is not None and np.any(mask):
+                return False
+        return True
+
+    def charge_estimate(self, event, tel_id):
+        """(estimate of the cleaned image charge, of its number of pixels (None without tailcuts))"""
+        correction, width, shift, peak, cleaning = self._settings[tel_id]
+        waveform = event.r1.tel[tel_id].waveform[0]
+        n_pixels, n_samples = waveform.shape
+        if peak is None:
+            peak_index = waveform.argmax(axis=1)
+        elif isinstance(peak, int):
+            brightest = np.argpartition(waveform.max(axis=1), -peak)[-peak:]
+            peak_index = np.full(n_pixels, waveform[brightest].sum(axis=0).argmax())
+        else:
+            peak_index = (peak @ waveform).argmax(axis=1)
+        # Window sums as extract_around_peak, truncated at the ends of the waveform
+        cumulative = np.zeros((n_pixels, n_samples + 1))
+        np.cumsum(waveform, axis=1, out=cumulative[:, 1:])
+        start = np.clip(peak_index - shift, 0, n_samples)
+        end = np.clip(peak_index - shift + width, 0, n_samples)
+        pixels = np.arange(n_pixels)
+        estimate = (cumulative[pixels, end] - cumulative[pixels, start]) * correction
+        if cleaning is None:
+            return float(estimate.sum()), None
+        mask = tailcuts_clean(self.subarray.tel[tel_id].camera.geometry, estimate, **cleaning)
+        return float(estimate[mask].sum()), int(np.count_nonzero(mask))
+
+    def _fails(self, charge, n_pixels):
+        if self.min_charge is not None and charge * ESTIMATE_SCALE <= self.min_charge:
+            return True
+        return self.min_pixels is not None and n_pixels is not None and n_pixels <= self.min_pixels
+
+    def __call__(self, event, stats):
+        """
+        Triage the telescopes of event (before the calibrator): {tel_id: charge estimate}
+        of those triaged, whose r1 is set aside in skip mode (see finish)
+        """
+        triaged = {}
+        for tel_id in list(event.r1.tel):
+            tel_type = stats.tel_types[tel_id]
+            stats.n_tel_events[tel_type] += 1
+            if not self._checked(event, tel_id):
+                stats.n_not_checked[tel_type] += 1
+                continue
+            charge, n_pixels = self.charge_estimate(event, tel_id)
+            if self._fails(charge, n_pixels):
+                triaged[tel_id] = charge
+                stats.n_triaged[tel_type] += 1
+        if self.mode == "skip":
+            self._set_aside = {tel_id: event.r1.tel.pop(tel_id) for tel_id in triaged}
+        return triaged
+
+    def finish(self, event, triaged, stats):
+        """
+        After the image processor: in skip mode, the r1 of the triaged
+        telescopes is put back and they get the parameters of a failed quality
+        query (and their true parameters); in validate mode, those that pass
+        the quality query are counted as disagreements.
+        """
+        if self.mode == "skip":
+            for tel_id, r1 in self._set_aside.items():
+                event.r1.tel[tel_id] = r1
+                event.dl1.tel[tel_id] = DL1CameraContainer(
+                    is_valid=False, parameters=self.image_processor.default_image_container,
+                )
+                self._true_parameters(event, tel_id)
+            self._set_aside = {}
+            return
+        for tel_id, charge in triaged.items():
+            intensity = event.dl1.tel[tel_id].parameters.hillas.intensity
+            if np.isfinite(intensity):
+                stats.n_disagreements[stats.tel_types[tel_id]] += 1
+                if len(stats.disagreements) < MAX_DISAGREEMENTS:
+                    stats.disagreements.append((event.index.obs_id, event.index.event_id, tel_id,
+                                                intensity, charge))
+
+    def _true_parameters(self, event, tel_id):
+        """The true image parameters, as ImageProcessor computes them"""
+        if event.simulation is None or tel_id not in event.simulation.tel:
+            return
+        sim_camera = event.simulation.tel[tel_id]
+        if sim_camera.true_image is None:
+            return
+        sim_camera.true_parameters = self.image_processor._parameterize_image(
+            tel_id,
+            image=sim_camera.true_image,
+            signal_pixels=sim_camera.true_image > 0,
+            peak_time=None,
+            default=DEFAULT_TRUE_IMAGE_PARAMETERS,
+        )
+        for container in sim_camera.true_parameters.values():
+            if not container.prefix.startswith("true_"):
+                container.prefix = f"true_{container.prefix}"
@@ -0,0 +1,127 @@
+"""
+Input stage of Make_reduced_Readout_window_file.py: overlapping reading of the
+simtel files with the processing
+
+* `read_ahead`: events are read (file I/O, zstd decompression, decoding) by a
+  background thread, up to n_events ahead of the processing
+  (`--read-ahead N`). The "source" stage of the stage timing is then the time
+  the event loop waits for the input.
+* `FileStager`: the next files are copied from the (network) production
+  directory to local scratch while the current ones are processed
+  (`--stage-dir DIR`), and removed once processed.
+"""
+import os
+import queue
+import shutil
+import threading
+from pathlib import Path
+from time import perf_counter
+
+# End of the events, or exception raised by the reading thread
+_END = object()
+
+
+def read_ahead(source, n_events):
+    """
+    Iterate over the events of source, read by a background thread up to
+    n_events ahead. An exception in the reading thread is raised here.
+    """
+    events = queue.Queue(maxsize=n_events)
+    stop = threading.Event()
+
+    def put(item):
+        """False if the event loop stopped"""
+        while not stop.is_set():
+            try:
+                events.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read():
+        try:
+            for event in source:
+                if not put(event):
+                    return
+            put((_END, None))
+        except Exception as exc:
+            put((_END, exc))
+
+    thread = threading.Thread(target=read, name="read_ahead", daemon=True)
+    thread.start()
+    try:
+        while True:
+            event = events.get()
+            if isinstance(event, tuple) and event[0] is _END:
+                if event[1] is not None:
+                    raise event[1]
+                break
+            yield event
+    finally:
+        # e.g. the event loop failed: let the reading thread end
+        stop.set()
+        thread.join()
+
+
+class FileStager:
+    """
+    Copies simtel_files, in order, to stage_dir in a background thread, with at
+    most n_staged copies (done or in progress) at a time.
+
+    get(in_file) waits for the copy of in_file, release(in_file) removes it.
+    If a copy fails, the file is read from where it is.
+    """
+
+    def __init__(self, simtel_files, stage_dir, n_staged=2):
+        self.stage_dir = Path(stage_dir)
+        self.stage_dir.mkdir(parents=True, exist_ok=True)
+        self.slots = threading.Semaphore(n_staged)
+        self.staged = {str(in_file): threading.Event() for in_file in simtel_files}
+        self.paths = {}
+        self._stop = False
+        self.thread = threading.Thread(target=self._copy_all, args=(list(self.staged),),
+                                       name="file_stager", daemon=True)
+        self.thread.start()
+
+    def staged_path(self, in_file):
+        return self.stage_dir / Path(in_file).name
+
+    def _copy_all(self, simtel_files):
+        for in_file in simtel_files:
+            self.slots.acquire()
+            if self._stop:
+                return
+            staged_path = self.staged_path(in_file)
+            part_path = staged_path.with_name(staged_path.name + ".part")
+            try:
+                shutil.copyfile(in_file, part_path)
+                os.replace(part_path, staged_path)
+                self.paths[in_file] = str(staged_path)
+            except OSError as exc:
+                print(f"Staging {in_file} failed ({exc}), reading it from where it is", flush=True)
+                if part_path.exists():
+                    part_path.unlink()
+                self.slots.release()
+            self.staged[in_file].set()
+
+    def get(self, in_file):
+        """(path to read in_file from, time waited for its copy [s])"""
+        t_start = perf_counter()
+        self.staged[str(in_file)].wait()
+        return self.paths.get(str(in_file), str(in_file)), perf_counter() - t_start
+
+    def release(self, in_file):
+        """Remove the staged copy of in_file, making room for the next one"""
+        staged_path = self.paths.pop(str(in_file), None)
+        if staged_path is not None:
+            os.remove(staged_path)
+            self.slots.release()
+
+    def close(self):
+        """Stop staging, and remove the copies not released"""
+        self._stop = True
+        self.slots.release()
+        self.thread.join()
+        for in_file in list(self.paths):
+            self.release(in_file)
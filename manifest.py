@@ -0,0 +1,112 @@
+"""
+Processing manifest for Make_reduced_Readout_window_file.py
+
+A JSON file in OUT_DIR recording, for each input simtel file and output, its
+status, event counts, output size and checksum, and processing time. On
+restart, files whose outputs are recorded as done (and still on disk with the
+recorded size) are skipped; anything else (failed, killed half-way, or never
+started) is processed again.
+
+Several jobs can share the same manifest (e.g. -r and --no-r running at the
+same time): updates are merged into the file on disk under a lock.
+"""
+import fcntl
+import json
+import os
+from datetime import datetime, timezone
+from pathlib import Path
+
+from file_utils import file_sha256
+
+
+class Manifest:
+    """
+    Status of each (input file, output file) pair, saved as JSON at path
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.files = self._read()
+        # Entries changed since the last save, merged into the file on disk by save()
+        self._updated = {}
+
+    def _read(self):
+        if not self.path.exists():
+            return {}
+        with open(self.path) as stream:
+            return json.load(stream).get("files", {})
+
+    def is_done(self, in_file, out_files, verify_checksum=False):
+        """
+        True if all out_files ({window: out_file}) of in_file are recorded as
+        done, and are on disk with the recorded size (and checksum, if asked).
+        """
+        outputs = self.files.get(Path(in_file).name, {}).get("outputs", {})
+        for out_file in out_files.values():
+            entry = outputs.get(Path(out_file).name)
+            if entry is None or entry["status"] != "done":
+                return False
+            if not os.path.exists(out_file) or os.path.getsize(out_file) != entry["size"]:
+                return False
+            if verify_checksum and file_sha256(out_file) != entry["sha256"]:
+                return False
+        return True
+
+    def record(self, summary):
+        """Record the summary of process_file (see file_processing.py)"""
+        in_name = Path(summary["in_file"]).name
+        file_entry = self.files.setdefault(in_name, dict(in_file=summary["in_file"], outputs={}))
+        finished = datetime.now(timezone.utc).isoformat(timespec="seconds")
+        for window, out_file in summary["out_files"].items():
+            entry = dict(
+                window=window,
+                status=summary["status"],
+                n_events=summary["n_events"],
+                n_written=summary["n_written"],
+                time=round(summary["time"], 1),
+                finished=finished,
+            )
+            output = summary.get("outputs", {}).get(out_file)
+            if summary["status"] == "done" and output is not None:
+                entry.update(size=output["size"], sha256=output["sha256"])
+            previous = file_entry["outputs"].get(Path(out_file).name, {})
+            if previous.get("merged_into") is not None:
+                # Already (partly) in a merged file, which has to be rebuilt (see split_merge.py)
+                entry.update(merged_into=previous["merged_into"], merge="rebuild")
+            file_entry["outputs"][Path(out_file).name] = entry
+            self._updated.setdefault(in_name, {})[Path(out_file).name] = entry
+        self.save()
+
+    def output_entry(self, in_file, out_file):
+        """Manifest entry of out_file of in_file (None if not recorded)"""
+        return self.files.get(Path(in_file).name, {}).get("outputs", {}).get(Path(out_file).name)
+
+    def record_merge(self, in_file, out_file, merged_file, status):
+        """
+        Record the status of the merge of out_file into merged_file:
+        "merging" (started), "merged", or None (not merged, e.g. to rebuild merged_file)
+        """
+        in_name = Path(in_file).name
+        entry = self.files[in_name]["outputs"][Path(out_file).name]
+        entry.update(merged_into=None if status is None else Path(merged_file).name, merge=status)
+        self._updated.setdefault(in_name, {})[Path(out_file).name] = entry
+        self.save()
+
+    def save(self):
+        """
+        Merge the updated entries into the manifest on disk (which another job
+        may have changed), and write it atomically.
+        """
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(str(self.path) + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            files = self._read()
+            for in_name, outputs in self._updated.items():
+                file_entry = files.setdefault(in_name, dict(in_file=self.files[in_name]["in_file"], outputs={}))
+                file_entry["outputs"].update(outputs)
+            tmp_path = self.path.with_suffix(".tmp")
+            with open(tmp_path, "w") as stream:
+                json.dump(dict(files=files), stream, indent=1, sort_keys=True)
+            os.replace(tmp_path, self.path)
+            self.files = files
+            self._updated = {}
@@ -0,0 +1,80 @@
+"""
+Cached reading of the datapipe-testbench metrics, for the studies comparing
+experiments (demo_perf_benchmarks_multiple_for_michael_from_karl.py)
+
+Each benchmark of a study reads the metrics of each experiment again with
+MetricsStore.retrieve_data, so comparing N experiments with M benchmarks
+reads the metric (ASDF) files N x M times. CachedMetricsStore reads a metric
+when it is first retrieved, and keeps it in an LRU cache shared by all the
+CachedMetricsStores of the process, keyed by the metric file and its size and
+modification time (a metric written again is read again): each metric file
+is read once per study.
+
+The cached metrics are shared by the benchmarks, they must not be modified.
+"""
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+from datapipe_testbench.store import MetricsStore
+
+
+class MetricsCache:
+    """LRU cache of at most maxsize metrics"""
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, load):
+        """The metric of key, load() if not in cache"""
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+        metric = load()
+        with self.lock:
+            self.entries[key] = metric
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return metric
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = 0
+
+    def __repr__(self):
+        return f"MetricsCache({len(self.entries)}/{self.maxsize} metrics, {self.hits} hits, {self.misses} misses)"
+
+
+# Shared by all the CachedMetricsStores
+METRICS_CACHE = MetricsCache()
+
+
+class CachedMetricsStore(MetricsStore):
+    """MetricsStore whose retrieve_data goes through METRICS_CACHE"""
+
+    def __init__(self, path, *args, **kwargs):
+        super().__init__(path, *args, **kwargs)
+        self._cache_path = Path(path).resolve()
+
+    def _metric_key(self, name):
+        path = self._cache_path / name
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return (str(path), None, None)
+        return (str(path), stat.st_size, stat.st_mtime_ns)
+
+    def retrieve_data(self, name, *args, **kwargs):
+        if args or kwargs:
+            return super().retrieve_data(name, *args, **kwargs)
+        return METRICS_CACHE.get(self._metric_key(name), lambda: super(CachedMetricsStore, self).retrieve_data(name))
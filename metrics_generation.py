@@ -0,0 +1,133 @@
+"""
+Incremental, parallel generation of the datapipe-testbench metrics
+(demo_perf_benchmarks_multiple_for_michael_from_karl.py)
+
+Each (InputDataset, Benchmark) pair is a stage of run_pipeline.py, whose key
+is the sha256 of the benchmark (name, datapipe-testbench version), of the
+input dataset and of the content of its input files (dl3_irf,
+dl3_benchmark...), and whose outputs are the metric files of the benchmark
+(its output_names) in the MetricsStore of the dataset. The sha256 of a file is
+only computed again if its size or modification time changed. Pairs whose
+key is the one recorded when their metrics were last generated, and whose
+metric files are unchanged, are skipped, so that adding windows, zeniths or
+azimuths only runs the new pairs. Pairs with missing inputs (benchmark
+inputs not in the dataset, or files not found) are reported and skipped.
+
+The input datasets are processed in parallel, on a pool of worker
+processes, and the benchmarks of a dataset one after the other in its
+worker: the benchmarks write in the same MetricsStore (directory, index),
+which is not safe to write from several processes.
+
+The keys are in metrics_state.json of the experiments directory.
+"""
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+from pathlib import Path
+
+import datapipe_testbench
+from datapipe_testbench.benchmark import MissingInputError
+from datapipe_testbench.store import MetricsStore
+
+from metrics_cache import CachedMetricsStore
+from run_pipeline import PipelineState, Stage
+
+STATE_FILE = "metrics_state.json"
+
+# (input_list, benchmark_list, experiments_path) of generate_metrics, for the forked workers
+_study = None
+
+
+def _input_files(input_dataset, benchmark):
+    """Input files of input_dataset used by benchmark (all of them if its required inputs are not found)"""
+    inputs = {key: value for key, value in input_dataset.to_dict().items() if key != "name" and value is not None}
+    required = {str(getattr(name, "name", name)) for name in benchmark.required_inputs}
+    files = [str(path) for key, path in inputs.items() if key in required]
+    return sorted(files or map(str, inputs.values()))
+
+
+def _output_files(store_path, benchmark):
+    """Metric files of benchmark in the MetricsStore at store_path (output_names: name -> path in the store)"""
+    return sorted(str(store_path / str(getattr(output, "path", output))) for output in benchmark.output_names.values())
+
+
+def metrics_stage(input_dataset, benchmark, experiments_path):
+    """Stage (see run_pipeline.py) of the metrics of benchmark for input_dataset, in experiments_path"""
+    command = [benchmark.name, getattr(datapipe_testbench, "__version__", ""), input_dataset.to_dict()]
+    return Stage(f"{input_dataset.name}/{benchmark.name}", command, _input_files(input_dataset, benchmark),
+                 _output_files(Path(experiments_path) / input_dataset.name, benchmark))
+
+
+def _generate(num_input, num_benchmarks):
+    """
+    Generate the metrics of the benchmarks num_benchmarks of an input dataset
+    in a worker, one after the other: [traceback if it failed, else None]
+    """
+    input_list, benchmark_list, experiments_path = _study
+    errors = []
+    for num_benchmark in num_benchmarks:
+        try:
+            metrics = MetricsStore(experiments_path / input_list[num_input].name)
+            benchmark_list[num_benchmark].generate_metrics(metrics)
+        except Exception:
+            errors.append(traceback.format_exc())
+        else:
+            errors.append(None)
+    return errors
+
+
+def generate_metrics(input_list, benchmark_list, experiments_path, workers=1, force=False):
+    """
+    CachedMetricsStore of each input dataset of input_list in experiments_path,
+    with the metrics of each benchmark of benchmark_list generated if not up
+    to date (all of them with force), by workers processes (one input dataset
+    each at a time; "fork", as process_files of file_processing.py, the
+    benchmarks are not pickled).
+    """
+    global _study
+    experiments_path = Path(experiments_path)
+    experiments_path.mkdir(parents=True, exist_ok=True)
+    state = PipelineState(experiments_path / STATE_FILE)
+    # num_input -> [(num_benchmark, stage, key)] of the pairs to run
+    todo = {}
+    for num_input, input_dataset in enumerate(input_list):
+        metrics = MetricsStore.from_path_and_input_dataset(
+            experiments_path / input_dataset.name, input_dataset.to_dict()
+        )
+        for num_benchmark, benchmark in enumerate(benchmark_list):
+            try:
+                benchmark.check_input_dataset(metrics.get_inputdata())
+                stage = metrics_stage(input_dataset, benchmark, experiments_path)
+                key = state.stage_key(stage)
+            except (MissingInputError, OSError) as err:
+                print(f"* {input_dataset.name}: {benchmark.name} -> {err}")
+                continue
+            if not force and state.is_up_to_date(stage, key):
+                print(f"* {input_dataset.name}: {benchmark.name} up to date")
+                continue
+            todo.setdefault(num_input, []).append((num_benchmark, stage, key))
+
+    _study = (input_list, benchmark_list, experiments_path)
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("fork")) as executor:
+            futures = {
+                executor.submit(_generate, num_input, [num_benchmark for num_benchmark, _, _ in pairs]): pairs
+                for num_input, pairs in todo.items()
+            }
+            for future in as_completed(futures):
+                for (_, stage, key), error in zip(futures[future], future.result()):
+                    if error is None:
+                        try:
+                            state.record(stage, key)
+                        except OSError as err:
+                            error = f"metric file not written: {err}"
+                    if error is None:
+                        print(f"* {stage.name}: metrics generated")
+                    else:
+                        print(f"* {stage.name}: FAILED\n{error}")
+                state.save()
+    finally:
+        _study = None
+
+    # Read again, with the metrics written by the workers
+    return [CachedMetricsStore(experiments_path / input_dataset.name) for input_dataset in input_list]
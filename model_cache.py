@@ -0,0 +1,225 @@
+"""
+Cache of the predictions of ctapipe-apply-models (`run_pipeline.py --model-cache DIR`)
+
+The dl2 tables written by each model (energy, classification, disp geometry,
+telescope and subarray) are kept in a sidecar HDF5 file of the cache,
+keyed by the sha256 of the input file, of the configuration, and of the
+model pickle and those applied before it (the classifier uses the
+reconstructed energy as a feature). To apply models, the input is copied
+as ctapipe-apply-models does, the cached tables of the leading models are
+added, and ctapipe-apply-models is only run for the others (reading the
+predictions of the cached ones from the copy), whose tables are then cached.
+
+The cache is limited to a disk budget: the least recently used sidecars are
+removed first. Its index (index.json) is shared by concurrent stages under a
+lock.
+
+e.g.
+    python3 model_cache.py --cache-dir $OUTPUT_DIR/model_cache --input in.dl2.h5 --output out.dl2.h5 \\
+        --reconstructor energy_regressor_red.pkl particle_classifier_red.pkl -- --log-level INFO
+"""
+import argparse
+import fcntl
+import hashlib
+import json
+import os
+import subprocess
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import tables
+from ctapipe import __version__ as ctapipe_version
+from ctapipe.io import HDF5Merger
+from ctapipe.reco import Reconstructor
+
+from file_utils import ensure_group, file_sha256_entry
+
+DL2_GROUP = "/dl2"
+
+
+class PredictionCache:
+    """Sidecar files of the predictions in cache_dir, at most budget_gb GB"""
+
+    def __init__(self, cache_dir, budget_gb=100.):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.budget = budget_gb * 1e9
+        self.index_path = self.cache_dir / "index.json"
+
+    @contextmanager
+    def index(self, write=True):
+        """
+        The index, locked, and saved on exit if changed. With write=False,
+        only for lookups: under a shared lock, and never saved.
+        """
+        with open(str(self.index_path) + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX if write else fcntl.LOCK_SH)
+            index = dict(entries={}, hashes={}, prefixes={})
+            if self.index_path.exists():
+                with open(self.index_path) as stream:
+                    index.update(json.load(stream))
+            before = json.dumps(index, sort_keys=True)
+            yield index
+            if not write or json.dumps(index, sort_keys=True) == before:
+                return
+            tmp_path = self.index_path.with_suffix(".tmp")
+            with open(tmp_path, "w") as stream:
+                json.dump(index, stream, indent=1, sort_keys=True)
+            os.replace(tmp_path, self.index_path)
+
+    def file_hash(self, path):
+        """sha256 of path, computed again only if its size or modification time changed"""
+        path = str(Path(path).resolve())
+        with self.index(write=False) as index:
+            entry = index["hashes"].get(path)
+        new_entry = file_sha256_entry(path, entry)
+        if new_entry is not entry:
+            with self.index() as index:
+                index["hashes"][path] = new_entry
+        return new_entry["sha256"]
+
+    def model_prefix(self, model_path, model_hash):
+        """Prefix of the tables written by the model (read from the pickle once)"""
+        with self.index(write=False) as index:
+            prefix = index["prefixes"].get(model_hash)
+        if prefix is None:
+            prefix = Reconstructor.read(model_path).prefix
+            with self.index() as index:
+                index["prefixes"][model_hash] = prefix
+        return prefix
+
+    def sidecar_path(self, key):
+        return self.cache_dir / f"{key}.h5"
+
+    def get(self, key):
+        """Sidecar file of key (marked as used), None if not cached"""
+        with self.index() as index:
+            entry = index["entries"].get(key)
+            if entry is None or not self.sidecar_path(key).exists():
+                index["entries"].pop(key, None)
+                return None
+            entry["last_used"] = time.time()
+        return self.sidecar_path(key)
+
+    def put(self, key, sidecar_file, model=""):
+        """Move sidecar_file into the cache as key, then remove the least recently used above the budget"""
+        os.replace(sidecar_file, self.sidecar_path(key))
+        with self.index() as index:
+            entries = index["entries"]
+            entries[key] = dict(size=os.path.getsize(self.sidecar_path(key)), last_used=time.time(), model=model)
+            total = sum(entry["size"] for entry in entries.values())
+            for old_key in sorted(entries, key=lambda old_key: entries[old_key]["last_used"]):
+                if total <= self.budget:
+                    break
+                if old_key == key:
+                    continue
+                total -= entries.pop(old_key)["size"]
+                if self.sidecar_path(old_key).exists():
+                    os.remove(self.sidecar_path(old_key))
+
+
+def chain_keys(input_hash, config_hash, model_hashes):
+    """Cache key of each model: input, configuration, and the models up to it"""
+    return [
+        hashlib.sha256(json.dumps([input_hash, config_hash, model_hashes[:num + 1]]).encode()).hexdigest()
+        for num in range(len(model_hashes))
+    ]
+
+
+def _dl2_tables(h5file, prefix=None):
+    """dl2 tables of h5file, only those of prefix (a component of their path) if given"""
+    if DL2_GROUP not in h5file:
+        return []
+    return [
+        table for table in h5file.walk_nodes(DL2_GROUP, "Table")
+        if prefix is None or prefix in table._v_pathname.split("/")
+    ]
+
+
+def copy_tables(from_file, to_file, prefix=None):
+    """Copy the dl2 tables (of prefix, if given) of from_file into to_file, at the same paths"""
+    with tables.open_file(from_file) as source, tables.open_file(to_file, mode="a") as target:
+        for table in _dl2_tables(source, prefix):
+            table._f_copy(newparent=ensure_group(target, table._v_parent._v_pathname), overwrite=True)
+
+
+def apply_models(in_file, out_file, models, cache, apply_args=(), config_file=None):
+    """
+    Write out_file as ctapipe-apply-models --input in_file --reconstructor
+    models... (apply_args passed on), with the predictions of the cache where
+    possible. Returns the number of models taken from the cache.
+
+    apply_args (logging, --n-jobs) are not part of the cache key, the
+    configuration file and ctapipe version are.
+    """
+    config = [ctapipe_version]
+    if config_file is not None:
+        config.append(cache.file_hash(config_file))
+    config_hash = hashlib.sha256(json.dumps(config).encode()).hexdigest()
+    model_hashes = [cache.file_hash(model) for model in models]
+    keys = chain_keys(cache.file_hash(in_file), config_hash, model_hashes)
+
+    sidecars = []
+    for key in keys:
+        sidecar = cache.get(key)
+        if sidecar is None:
+            break
+        sidecars.append(sidecar)
+
+    base_file = str(out_file) + ".base.h5"
+    if sidecars:
+        # As ctapipe-apply-models copies its input, then the tables of the cached models
+        with HDF5Merger(base_file, overwrite=True) as merger:
+            merger(in_file)
+        for sidecar in sidecars:
+            copy_tables(sidecar, base_file)
+
+    remaining = list(zip(models[len(sidecars):], model_hashes[len(sidecars):], keys[len(sidecars):]))
+    if not remaining:
+        os.replace(base_file, out_file)
+        return len(sidecars)
+
+    applied_file = str(out_file) + ".applied.h5"
+    command = ["ctapipe-apply-models", "--input", base_file if sidecars else in_file,
+               "--output", applied_file, "--overwrite",
+               *[arg for model, _, _ in remaining for arg in ("--reconstructor", model)], *apply_args]
+    if config_file is not None:
+        command += ["--config", config_file]
+    try:
+        subprocess.run(command, check=True)
+        for model, model_hash, key in remaining:
+            sidecar = cache.cache_dir / f"{key}.tmp.h5"
+            tables.open_file(sidecar, mode="w").close()
+            copy_tables(applied_file, sidecar, cache.model_prefix(model, model_hash))
+            cache.put(key, sidecar, model=Path(model).name)
+        os.replace(applied_file, out_file)
+    finally:
+        for path in (base_file, applied_file):
+            if os.path.exists(path):
+                os.remove(path)
+    return len(sidecars)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+                    prog='model_cache',
+                    description='ctapipe-apply-models, with the predictions of unchanged models and inputs from a cache '
+                                '(arguments after -- are passed on to ctapipe-apply-models)',
+                    )
+    parser.add_argument("--cache-dir",required=True)
+    parser.add_argument("--budget-gb",type=float,default=100.,help="Disk space of the cache")
+    parser.add_argument("--input","-i",required=True)
+    parser.add_argument("--output","-o",required=True)
+    parser.add_argument("--reconstructor","-r",nargs="+",required=True,help="Model pickles, in the order applied")
+    parser.add_argument("--config",default=None,help="Configuration file of ctapipe-apply-models")
+    parser.add_argument("apply_args",nargs="*")
+    args = parser.parse_args()
+
+    cache = PredictionCache(args.cache_dir, args.budget_gb)
+    n_cached = apply_models(args.input, args.output, args.reconstructor, cache, args.apply_args, args.config)
+    print(f"{args.output}: {n_cached} of {len(args.reconstructor)} models from the cache")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""
+Output profiles of Make_reduced_Readout_window_file.py (`--output-profile`, see output_profiles.yml)
+
+The "full" profile writes what DataWriter writes by default (all dl1 parameters
+and dl2). The "compact" profile keeps only what the downstream tools read:
+
+* of the dl1 parameters, only the columns used by the training configurations
+  (features, quality criteria and generated features of
+  train_energy_regressor.yml, train_particle_classifier.yml and
+  train_disp_reconstructor.yml), plus those always needed (ids, and the Hillas
+  position and direction used for the disp target)
+* floats stored as float32 in the dl1 parameters and dl2 tables
+* a given HDF5 compression (blosc:zstd or zlib, and level), and tables repacked
+  at the end with chunks of about chunk_kib kB, rather than the small chunks
+  of tables grown event by event, for faster reads of whole columns
+"""
+import os
+import re
+from pathlib import Path
+
+import numpy as np
+import tables
+import yaml
+from astropy.units import Quantity
+from ctapipe import __version__ as ctapipe_version
+from ctapipe.io.tableio import ColumnTransform
+from traitlets.config import Config
+
+PARAMETER_TABLES = "dl1/event/telescope/parameters/.*"
+DL2_TABLES = "dl2/event/.*"
+
+# Needed whatever the training configurations use
+ALWAYS_KEPT = {"obs_id", "event_id", "tel_id", "hillas_fov_lon", "hillas_fov_lat", "hillas_psi"}
+
+_IDENTIFIER = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+
+
+class Float32ColumnTransform(ColumnTransform):
+    """Store float (or float Quantity) columns as float32, other columns as they are"""
+
+    def __call__(self, value):
+        if isinstance(value, Quantity):
+            return value.astype(np.float32) if value.dtype.kind == "f" else value
+        if isinstance(value, (float, np.floating)):
+            return np.float32(value)
+        if isinstance(value, np.ndarray) and value.dtype.kind == "f":
+            return value.astype(np.float32)
+        return value
+
+    def inverse(self, value):
+        return value
+
+    def get_meta(self, colname):
+        return {}
+
+
+def _find_key(config, key):
+    """All values of key in the nested dicts of config"""
+    if isinstance(config, dict):
+        for name, value in config.items():
+            if name == key:
+                yield value
+            else:
+                yield from _find_key(value, key)
+
+
+def training_columns(config_files):
+    """
+    Columns read by the training configurations: features, and the columns in
+    the quality criteria and generated features expressions
+    """
+    columns = set()
+    for config_file in config_files:
+        with open(config_file) as stream:
+            config = yaml.safe_load(stream)
+        for features in _find_key(config, "features"):
+            for feature in features:
+                if isinstance(feature, str):
+                    columns.add(feature)
+                else:
+                    # FeatureGenerator: [name, expression]
+                    columns.update(_IDENTIFIER.findall(feature[1]))
+        for criteria in _find_key(config, "quality_criteria"):
+            for _, expression in criteria:
+                columns.update(_IDENTIFIER.findall(expression))
+    return columns
+
+
+def load_output_profile(name, profiles_file="output_profiles.yml"):
+    """Profile name of profiles_file, with the kept columns (for compact profiles) as a set"""
+    with open(profiles_file) as stream:
+        profile = dict(yaml.safe_load(stream)[name])
+    if profile.get("training_configs"):
+        profile["keep_parameters"] = sorted(training_columns(profile["training_configs"]) | ALWAYS_KEPT)
+    return profile
+
+
+def writer_config(profile):
+    """Configuration of the DataWriter for profile (compression)"""
+    if profile is None:
+        return Config()
+    return Config({"DataWriter": {
+        key: profile[key] for key in ("compression_type", "compression_level") if key in profile
+    }})
+
+
+def apply_output_profile(data_writer, profile):
+    """
+    Exclude the columns not kept and store floats as float32, in the
+    HDF5TableWriter of data_writer (before any event is written)
+    """
+    if profile is None:
+        return
+    # No public interface to the table writer of DataWriter: its private
+    # _writer (an HDF5TableWriter, set up by DataWriter.__init__ in ctapipe 0.24)
+    table_writer = getattr(data_writer, "_writer", None)
+    if table_writer is None:
+        raise RuntimeError(
+            f"DataWriter of ctapipe {ctapipe_version} has no _writer table writer "
+            "(written against ctapipe 0.24), output profiles can not be applied"
+        )
+    keep = profile.get("keep_parameters")
+    if keep is not None:
+        table_writer.exclude(PARAMETER_TABLES, "(?!(?:{})$).*".format("|".join(map(re.escape, keep))))
+    if profile.get("float32", False):
+        transform = Float32ColumnTransform()
+        table_writer.add_column_transform_regexp(PARAMETER_TABLES, ".*", transform)
+        # Except the telescope lists, transformed to masks by DataWriter
+        table_writer.add_column_transform_regexp(DL2_TABLES, "(?!.*telescopes$).*", transform)
+
+
+def repack(out_file, profile):
+    """
+    Copy out_file with the compression of profile, and tables in chunks of
+    about profile["chunk_kib"] kB, then replace it.
+    """
+    if profile is None or not profile.get("chunk_kib"):
+        return
+    filters = tables.Filters(
+        complevel=profile.get("compression_level", 5),
+        complib=profile.get("compression_type", "blosc:zstd"),
+    )
+    tmp_file = str(Path(out_file).with_suffix(".repack.h5"))
+    with tables.open_file(out_file) as source, tables.open_file(tmp_file, mode="w") as target:
+        source.root._v_attrs._f_copy(target.root)
+        for group in source.walk_groups("/"):
+            target_group = target.get_node(group._v_pathname)
+            for node in group._f_iter_nodes():
+                if isinstance(node, tables.Group):
+                    node._f_copy(newparent=target_group, recursive=False)
+                elif isinstance(node, tables.Table):
+                    chunk_rows = max(1, profile["chunk_kib"] * 1024 // node.rowsize)
+                    node._f_copy(newparent=target_group, filters=filters, chunkshape=(chunk_rows,))
+                else:
+                    node._f_copy(newparent=target_group, filters=filters)
+    os.replace(tmp_file, out_file)
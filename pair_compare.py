@@ -0,0 +1,290 @@
+"""
+Event by event comparison of the std and red window outputs of the same simtel files
+
+Both outputs come from the same simulated events, so rather than comparing
+IRFs (where the effect of the window is within the statistical noise), each
+telescope event of the red output is paired with the same (obs_id, event_id,
+tel_id) of the std output, and each subarray event with the same (obs_id,
+event_id), and the differences are histogrammed:
+
+* per telescope type: relative difference of the Hillas intensity and width,
+  migration matrix of log10(intensity) std -> red, and images lost or gained
+  (Hillas parameters nan in one of the two)
+* per event: angle between the std and red reconstructed directions, and
+  migration of the validity of the reconstruction
+
+The pairs are found by merge joins of sorted integer keys with numpy, one
+telescope table of one file pair at a time, so memory does not depend on the
+size of the production, and the histograms are added over the files.
+
+e.g.
+    python3 pair_compare.py $OUT_DIR --output $OUT_DIR/std_vs_red.h5
+"""
+import argparse
+import os
+from glob import glob
+
+import numpy as np
+import tables
+from astropy.table import Table
+from ctapipe.instrument import SubarrayDescription
+from ctapipe.io import write_table
+
+from theta2 import GEOMETRY_TABLE, angular_separation, read_chunks
+from window_names import WINDOW_SUFFIXES
+
+PARAMETERS_GROUP = "/dl1/event/telescope/parameters"
+COMPARISON_GROUP = "/std_vs_red"
+
+# (low, high, number of bins), under- and overflows in the first and last entries
+# An odd number of bins centred on 0, so that unchanged images are in the bin of centre 0
+RELATIVE_BINS = (-1.01, 1.01, 101)
+LOG_INTENSITY_BINS = (1.0, 6.0, 50)
+DIRECTION_BINS = (0.0, 0.5, 100)  # deg
+
+
+def _bin_indices(values, bins):
+    """Bins of values (not nan) in the uniform bins (low, high, n): 0 below, n + 1 above"""
+    low, high, n_bins = bins
+    values = np.clip(values, low - 1, high + 1)
+    indices = np.floor((values - low) / (high - low) * n_bins).astype(np.int64) + 1
+    return np.clip(indices, 0, n_bins + 1)
+
+
+def _histogram(values, bins):
+    return np.bincount(_bin_indices(values[~np.isnan(values)], bins), minlength=bins[2] + 2)
+
+
+def event_keys(obs_id, event_id):
+    """Single int64 key per (obs_id, event_id), ordered as the pairs"""
+    event_id = np.asarray(event_id, dtype=np.int64)
+    if len(event_id) and (event_id.min() < 0 or event_id.max() >= 2**40):
+        raise ValueError("event_id out of the range of the join keys")
+    return (np.asarray(obs_id, dtype=np.int64) << 40) | event_id
+
+
+def merge_join(left_keys, right_keys):
+    """
+    (left indices, right indices) of the keys in both (unique keys), from the
+    keys sorted (if not already, e.g. sharded outputs grouped by shard)
+    """
+    left_order = np.argsort(left_keys, kind="stable")
+    right_order = np.argsort(right_keys, kind="stable")
+    left_sorted = left_keys[left_order]
+    right_sorted = right_keys[right_order]
+    positions = np.searchsorted(right_sorted, left_sorted)
+    positions_ok = positions < len(right_sorted)
+    matched = np.zeros(len(left_sorted), dtype=bool)
+    matched[positions_ok] = right_sorted[positions[positions_ok]] == left_sorted[positions_ok]
+    return left_order[matched], right_order[positions[matched]]
+
+
+def _read_columns(table, columns):
+    """{column: array} of the whole of table (one telescope or the geometry of one file), angles in radians"""
+    chunks = list(read_chunks(table, columns))
+    return {column: np.concatenate([chunk[column] for chunk in chunks]) for column in columns} if chunks else {
+        column: np.zeros(0) for column in columns
+    }
+
+
+class TelTypeComparison:
+    """Histograms of the paired telescope events of one telescope type"""
+
+    def __init__(self):
+        self.n_pairs = 0
+        self.only_std = 0
+        self.only_red = 0
+        self.lost = 0
+        self.gained = 0
+        self.intensity_difference = np.zeros(RELATIVE_BINS[2] + 2, dtype=np.int64)
+        self.width_difference = np.zeros(RELATIVE_BINS[2] + 2, dtype=np.int64)
+        n_intensity = LOG_INTENSITY_BINS[2] + 2
+        self.intensity_migration = np.zeros((n_intensity, n_intensity), dtype=np.int64)
+
+    def fill(self, std, red):
+        """Add paired telescope events, std and red {column: array} in the same order"""
+        self.n_pairs += len(std["hillas_intensity"])
+        std_ok = np.isfinite(std["hillas_intensity"])
+        red_ok = np.isfinite(red["hillas_intensity"])
+        self.lost += int(np.count_nonzero(std_ok & ~red_ok))
+        self.gained += int(np.count_nonzero(~std_ok & red_ok))
+        both = std_ok & red_ok
+        std_intensity = std["hillas_intensity"][both]
+        red_intensity = red["hillas_intensity"][both]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self.intensity_difference += _histogram((red_intensity - std_intensity) / std_intensity, RELATIVE_BINS)
+            self.width_difference += _histogram(
+                (red["hillas_width"][both] - std["hillas_width"][both]) / std["hillas_width"][both], RELATIVE_BINS
+            )
+            std_bins = _bin_indices(np.log10(std_intensity), LOG_INTENSITY_BINS)
+            red_bins = _bin_indices(np.log10(red_intensity), LOG_INTENSITY_BINS)
+        np.add.at(self.intensity_migration, (std_bins, red_bins), 1)
+
+    def merge(self, other):
+        for name in ("n_pairs", "only_std", "only_red", "lost", "gained"):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        self.intensity_difference += other.intensity_difference
+        self.width_difference += other.width_difference
+        self.intensity_migration += other.intensity_migration
+
+
+class PairComparison:
+    """
+    Paired differences of std and red outputs, added file pair by file pair
+    (fill_pair), or from other comparisons (merge, e.g. of other workers)
+    """
+
+    def __init__(self, reconstructor="HillasReconstructor"):
+        self.reconstructor = reconstructor
+        self.n_files = 0
+        # {telescope type: TelTypeComparison}
+        self.tel_types = {}
+        self.n_events = 0
+        self.direction_difference = np.zeros(DIRECTION_BINS[2] + 2, dtype=np.int64)
+        # [std valid, red valid]
+        self.validity_migration = np.zeros((2, 2), dtype=np.int64)
+
+    def fill_pair(self, std_file, red_file):
+        """Add the paired events of the std and red outputs of one simtel file"""
+        subarray = SubarrayDescription.from_hdf(std_file)
+        with tables.open_file(std_file) as std_h5, tables.open_file(red_file) as red_h5:
+            std_tables = {table.name: table for table in std_h5.iter_nodes(PARAMETERS_GROUP, "Table")}
+            red_tables = {table.name: table for table in red_h5.iter_nodes(PARAMETERS_GROUP, "Table")}
+            for name in sorted(std_tables.keys() | red_tables.keys()):
+                tel_type = str(subarray.tel[int(name.split("_")[-1])])
+                comparison = self.tel_types.setdefault(tel_type, TelTypeComparison())
+                if name not in red_tables:
+                    comparison.only_std += std_tables[name].nrows
+                    continue
+                if name not in std_tables:
+                    comparison.only_red += red_tables[name].nrows
+                    continue
+                columns = ["obs_id", "event_id", "hillas_intensity", "hillas_width"]
+                std = _read_columns(std_tables[name], columns)
+                red = _read_columns(red_tables[name], columns)
+                std_index, red_index = merge_join(event_keys(std["obs_id"], std["event_id"]),
+                                                  event_keys(red["obs_id"], red["event_id"]))
+                comparison.only_std += len(std["obs_id"]) - len(std_index)
+                comparison.only_red += len(red["obs_id"]) - len(red_index)
+                comparison.fill({column: values[std_index] for column, values in std.items()},
+                                {column: values[red_index] for column, values in red.items()})
+
+            geometry_table = GEOMETRY_TABLE.format(reconstructor=self.reconstructor)
+            prefix = self.reconstructor
+            columns = ["obs_id", "event_id", f"{prefix}_alt", f"{prefix}_az", f"{prefix}_is_valid"]
+            std = _read_columns(std_h5.get_node(geometry_table), columns)
+            red = _read_columns(red_h5.get_node(geometry_table), columns)
+        std_index, red_index = merge_join(event_keys(std["obs_id"], std["event_id"]),
+                                          event_keys(red["obs_id"], red["event_id"]))
+        self.n_events += len(std_index)
+        std_valid = std[f"{prefix}_is_valid"][std_index].astype(bool)
+        red_valid = red[f"{prefix}_is_valid"][red_index].astype(bool)
+        np.add.at(self.validity_migration, (std_valid.astype(int), red_valid.astype(int)), 1)
+        both = std_valid & red_valid
+        direction = angular_separation(
+            std[f"{prefix}_az"][std_index][both], std[f"{prefix}_alt"][std_index][both],
+            red[f"{prefix}_az"][red_index][both], red[f"{prefix}_alt"][red_index][both],
+        )
+        self.direction_difference += _histogram(np.rad2deg(direction), DIRECTION_BINS)
+        self.n_files += 1
+
+    def merge(self, other):
+        self.n_files += other.n_files
+        self.n_events += other.n_events
+        self.direction_difference += other.direction_difference
+        self.validity_migration += other.validity_migration
+        for tel_type, comparison in other.tel_types.items():
+            self.tel_types.setdefault(tel_type, TelTypeComparison()).merge(comparison)
+
+    def to_tables(self):
+        """{name: Table}, as written in COMPARISON_GROUP"""
+        tel_types = list(self.tel_types.values())
+        telescope = Table({
+            "tel_type": list(self.tel_types),
+            **{
+                name: np.array([getattr(comparison, name) for comparison in tel_types], dtype=np.int64)
+                for name in ("n_pairs", "only_std", "only_red", "lost", "gained")
+            },
+            **{
+                name: np.array([getattr(comparison, name) for comparison in tel_types])
+                for name in ("intensity_difference", "width_difference", "intensity_migration")
+            },
+        })
+        telescope.meta.update(relative_bins=list(RELATIVE_BINS), log10_intensity_bins=list(LOG_INTENSITY_BINS))
+        subarray = Table({
+            "n_events": [self.n_events],
+            "direction_difference": [self.direction_difference],
+            "validity_migration": [self.validity_migration],
+        })
+        subarray.meta.update(reconstructor=self.reconstructor, n_files=self.n_files,
+                             direction_bins_deg=list(DIRECTION_BINS))
+        return dict(telescope=telescope, subarray=subarray)
+
+    def write(self, out_file):
+        for name, table in self.to_tables().items():
+            write_table(table, out_file, f"{COMPARISON_GROUP}/{name}", overwrite=True)
+
+
+def output_pairs(out_dir):
+    """[(std output, red output)] of the simtel files with both in out_dir"""
+    std_suffix, red_suffix = WINDOW_SUFFIXES["std"], WINDOW_SUFFIXES["red"]
+    pairs = []
+    for std_file in sorted(glob(os.path.join(out_dir, "*" + std_suffix))):
+        red_file = std_file[:-len(std_suffix)] + red_suffix
+        if os.path.exists(red_file):
+            pairs.append((std_file, red_file))
+    return pairs
+
+
+def compare_outputs(out_dir, reconstructor="HillasReconstructor"):
+    """PairComparison of all the std/red output pairs of out_dir"""
+    comparison = PairComparison(reconstructor)
+    for std_file, red_file in output_pairs(out_dir):
+        comparison.fill_pair(std_file, red_file)
+    return comparison
+
+
+def _bin_centers(bins):
+    low, high, n_bins = bins
+    return low + (np.arange(n_bins) + 0.5) * (high - low) / n_bins
+
+
+def _median(counts, bins):
+    """Median of the histogram counts (with under/overflows), from the bin centres"""
+    cumulative = np.cumsum(counts)
+    if cumulative[-1] == 0:
+        return np.nan
+    num_bin = np.searchsorted(cumulative, cumulative[-1] / 2)
+    if num_bin == 0 or num_bin > bins[2]:
+        return np.nan
+    return _bin_centers(bins)[num_bin - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+                    prog='pair_compare',
+                    description='Event by event differences between the std and red outputs in OUT_DIR',
+                    )
+    parser.add_argument("out_dir")
+    parser.add_argument("--output",default=None,help="Write the histograms in this HDF5 file")
+    parser.add_argument("--reconstructor",default="HillasReconstructor")
+    args = parser.parse_args()
+
+    comparison = compare_outputs(args.out_dir, args.reconstructor)
+    print(f"{comparison.n_files} file pairs, {comparison.n_events} paired events")
+    std_valid, red_valid = comparison.validity_migration.sum(axis=1), comparison.validity_migration.sum(axis=0)
+    print(f"  valid reconstructions: std {std_valid[1]}, red {red_valid[1]}, "
+          f"valid only in std {comparison.validity_migration[1, 0]}, only in red {comparison.validity_migration[0, 1]}")
+    print(f"  median angle between std and red directions: "
+          f"{_median(comparison.direction_difference, DIRECTION_BINS):.4f} deg")
+    print(f"  {'telescope type':30s} {'pairs':>8s} {'lost':>6s} {'gained':>6s} {'ΔI/I':>7s} {'Δw/w':>7s}")
+    for tel_type, tel_comparison in comparison.tel_types.items():
+        print(f"  {tel_type:30s} {tel_comparison.n_pairs:8d} {tel_comparison.lost:6d} {tel_comparison.gained:6d} "
+              f"{_median(tel_comparison.intensity_difference, RELATIVE_BINS):7.3f} "
+              f"{_median(tel_comparison.width_difference, RELATIVE_BINS):7.3f}")
+    if args.output is not None:
+        comparison.write(args.output)
+
+
+if __name__ == "__main__":
+    main()
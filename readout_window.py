@@ -0,0 +1,172 @@
+"""
+Readout window reduction, used by Make_reduced_Readout_window_file.py
+
+Kept in its own module so that worker processes can import it.
+"""
+from copy import deepcopy
+
+import numpy as np
+from ctapipe.core import TelescopeComponent
+from ctapipe.core.traits import Bool, CaselessStrEnum, Int, IntTelescopeParameter
+
+
+class ReadoutWindowReducer(TelescopeComponent):
+    """
+    Readout Window Reducer
+    With mode "fixed" (default), reduce the readout window to samples
+    [window_start, window_start + window_width), the same over the whole
+    camera, per camera type (see readout_windows.yml).
+
+    Defaults are the windows hardwired so far, for MSTs [12:27] and LSTs [10:30],
+    so a reduction of a factor of 4 for MST-NectarCAM, and factor 2 for LST.
+    A window_width of 0 keeps the window as simulated (default for other cameras).
+
+    The window of each telescope is looked up once, at construction, so that
+    for each event only a dict lookup and slicing are needed.
+
+    With mode "peak", the window is instead placed for each telescope event:
+    window_width samples starting samples_before_peak before the peak of the
+    waveform summed over its n_peak_pixels brightest pixels (high gain R1),
+    shifted to stay within the readout. Finding the peaks (`event_windows`)
+    is a few vectorized operations per telescope, timed as its own stage
+    ("peak_finder") in the stage timing.
+
+    By default the reduced waveforms are views of the full ones, which keeps the
+    full buffers alive through the calibration. With contiguous, they are copied
+    to compact arrays, and with drop_r0 the R0 waveforms (not used by the
+    calibration) are dropped altogether.
+    """
+
+    window_start = IntTelescopeParameter(
+        default_value=[
+            ("type", "*", 0),
+            ("type", "*NectarCam", 12),
+            ("type", "*LSTCam", 10),
+        ],
+        help="First sample of the reduced readout window",
+    ).tag(config=True)
+
+    window_width = IntTelescopeParameter(
+        default_value=[
+            ("type", "*", 0),
+            ("type", "*NectarCam", 15),
+            ("type", "*LSTCam", 20),
+        ],
+        help="Number of samples in the reduced readout window, 0 to keep the window as simulated",
+    ).tag(config=True)
+
+    mode = CaselessStrEnum(
+        ["fixed", "peak"],
+        default_value="fixed",
+        help="fixed: window_start for all events; peak: window centred on the summed waveform peak of each telescope event",
+    ).tag(config=True)
+
+    samples_before_peak = IntTelescopeParameter(
+        default_value=[
+            ("type", "*", 0),
+            ("type", "*NectarCam", 5),
+            ("type", "*LSTCam", 7),
+        ],
+        help="With mode peak, number of samples of the window before the peak",
+    ).tag(config=True)
+
+    n_peak_pixels = Int(
+        default_value=20,
+        help="With mode peak, number of brightest pixels summed to find the peak",
+    ).tag(config=True)
+
+    contiguous = Bool(
+        default_value=False,
+        help="Copy the reduced windows to compact, contiguous, arrays instead of keeping views of the full windows",
+    ).tag(config=True)
+
+    drop_r0 = Bool(
+        default_value=False,
+        help="Drop the R0 waveforms, only R1 is used by the calibration",
+    ).tag(config=True)
+
+    def __init__(self, subarray, config=None, parent=None, **kwargs):
+        super().__init__(subarray=subarray, config=config, parent=parent, **kwargs)
+
+        # tel_id -> slice of the samples to keep, telescopes not in there are not reduced
+        self.windows = {}
+        # tel_id -> (width, samples before peak, n_samples), for mode peak
+        self.peak_windows = {}
+        for tel_id, tel in subarray.tel.items():
+            start = self.window_start.tel[tel_id]
+            width = self.window_width.tel[tel_id]
+            if width <= 0:
+                continue
+            n_samples = tel.camera.readout.n_samples
+            if start < 0 or start + width > n_samples:
+                raise ValueError(
+                    f"Readout window [{start}:{start + width}] for tel {tel_id} ({tel}) "
+                    f"outside of its {n_samples} samples"
+                )
+            self.windows[tel_id] = slice(start, start + width)
+            self.peak_windows[tel_id] = (width, self.samples_before_peak.tel[tel_id], n_samples)
+
+        for tel_type in subarray.telescope_types:
+            tel_ids = subarray.get_tel_ids_for_type(tel_type)
+            if tel_ids and tel_ids[0] not in self.windows:
+                self.log.info("Keeping the simulated readout window for %s", tel_type)
+
+    def _peak_window(self, waveform, width, before, n_samples):
+        charge = waveform[0]
+        n_pixels = min(self.n_peak_pixels, charge.shape[0])
+        brightest = np.argpartition(charge.max(axis=1), -n_pixels)[-n_pixels:]
+        peak = int(np.argmax(charge[brightest].sum(axis=0)))
+        start = min(max(peak - before, 0), n_samples - width)
+        return slice(start, start + width)
+
+    def event_windows(self, event):
+        """tel_id -> slice of the samples to keep for event (the same for all events with mode fixed)"""
+        if self.mode == "fixed":
+            return self.windows
+        windows = {}
+        for tel_id in event.trigger.tels_with_trigger:
+            params = self.peak_windows.get(tel_id)
+            if params is not None:
+                windows[tel_id] = self._peak_window(event.r1.tel[tel_id].waveform, *params)
+        return windows
+
+    def __call__(self, event, windows=None):
+        """Reduce the windows of event, to windows if given (see `event_windows`)"""
+        if windows is None:
+            windows = self.event_windows(event)
+        contiguous = self.contiguous
+        drop_r0 = self.drop_r0
+        for tel_id in event.trigger.tels_with_trigger:
+            if drop_r0:
+                event.r0.tel.pop(tel_id, None)
+            window = windows.get(tel_id)
+            if window is None:
+                continue
+            if not drop_r0:
+                r0 = event.r0.tel[tel_id]
+                r0.waveform = r0.waveform[:, :, window]
+                if contiguous:
+                    r0.waveform = np.ascontiguousarray(r0.waveform)
+            r1 = event.r1.tel[tel_id]
+            r1.waveform = r1.waveform[:, :, window]
+            if contiguous:
+                r1.waveform = np.ascontiguousarray(r1.waveform)
+
+
+def scan_window_configs(readout_windows, window_scan):
+    """
+    {name: ReadoutWindowReducer configuration} of each window of a scan
+    (see window_scan.yml): the configuration of readout_windows, with the
+    window_start/window_width of each camera type pattern of the scan entry
+    appended (later entries override earlier ones).
+    """
+    configs = {}
+    for name, windows in window_scan["WindowScan"].items():
+        config = deepcopy(readout_windows)
+        reducer = config.setdefault("ReadoutWindowReducer", {})
+        for trait in ("window_start", "window_width"):
+            rules = list(reducer.get(trait, []))
+            rules += [["type", pattern, value] for pattern, value in windows.get(trait, {}).items()]
+            reducer[trait] = rules
+        configs[name] = config
+    return configs
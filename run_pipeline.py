@@ -0,0 +1,370 @@
+"""
+The merge, training, apply-models, cut optimisation and IRF commands of the
+README, for both windows, as one run
+
+Each command is a stage with its input and output files; a stage runs once
+the stages making its inputs are done. Stages are skipped when they are up
+to date: the sha256 of the command and of the content of its inputs is the
+same as when it last succeeded (recorded in $OUTPUT_DIR/pipeline_state.json),
+and its outputs are still there, unchanged. The sha256 of a file is only
+computed again when its size or modification time changed.
+
+Independent stages (std and red, the apply-models of each particle, the
+classifier and disp trainings) run at the same time, as long as the cores
+they use (--n-jobs of the tools) fit in --cores. The wall time of each stage
+is printed at the end and written in $OUTPUT_DIR/pipeline_timing.ecsv.
+
+e.g.
+    python3 run_pipeline.py --output-dir $OUTPUT_DIR --cores 64
+    python3 run_pipeline.py --output-dir $OUTPUT_DIR --windows red --dry-run
+"""
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from glob import glob
+from pathlib import Path
+from time import perf_counter
+
+import yaml
+from astropy.table import Table
+
+from file_utils import file_sha256_entry
+from manifest import Manifest
+from split_merge import assign_splits
+from window_names import WINDOW_SUFFIXES
+
+TIMING_COLUMNS = ["stage", "status", "start", "wall", "cores"]
+
+MODEL_CACHE_SCRIPT = str(Path(__file__).with_name("model_cache.py"))
+
+
+class Stage:
+    """A command, the files it reads and writes, and the cores it uses"""
+
+    def __init__(self, name, command, inputs, outputs, cores=1):
+        self.name = name
+        self.command = [str(arg) for arg in command]
+        self.inputs = [str(path) for path in inputs]
+        self.outputs = [str(path) for path in outputs]
+        self.cores = cores
+        # Names of the stages making the inputs, set by link_stages
+        self.after = set()
+
+
+def link_stages(stages):
+    """Set the dependencies of stages, from their inputs and outputs"""
+    made_by = {output: stage.name for stage in stages for output in stage.outputs}
+    for stage in stages:
+        stage.after = {made_by[path] for path in stage.inputs if path in made_by}
+
+
+def _merged_outputs(output_dir, particle):
+    """{output name: name of the merged file} of the outputs merged while processing (--merge-splits)"""
+    manifest = Manifest(os.path.join(output_dir, particle, "processing_manifest.json"))
+    return {
+        out_name: entry["merged_into"]
+        for file_entry in manifest.files.values()
+        for out_name, entry in file_entry.get("outputs", {}).items()
+        if entry.get("merge") == "merged"
+    }
+
+
+def merge_stages(output_dir, dataset_splits, window):
+    """
+    ctapipe-merge of the per-run outputs of each dataset of dataset_splits (see
+    split_merge.py), but for the merged files made while processing
+    (--merge-splits, recorded in the processing manifest of the dataset)
+    """
+    stages = []
+    for particle, split in dataset_splits.items():
+        out_files = sorted(glob(os.path.join(output_dir, particle, "*" + WINDOW_SUFFIXES[window])))
+        purposes = assign_splits(out_files, split["splits"])
+        merged_outputs = _merged_outputs(output_dir, particle)
+        for purpose, _ in split["splits"]:
+            inputs = [out_file for out_file in out_files if purposes[Path(out_file).name] == purpose]
+            if not inputs:
+                continue
+            merged_file = os.path.join(output_dir, f"{split['prefix']}_merged_{purpose}.{window}.dl2.h5")
+            n_merged = sum(merged_outputs.get(Path(out_file).name) == Path(merged_file).name for out_file in inputs)
+            if n_merged == len(inputs):
+                # Merged while processing, the merged file is an input as it is
+                continue
+            if n_merged > 0:
+                raise ValueError(
+                    f"{merged_file}: {n_merged} of its {len(inputs)} outputs were merged while processing "
+                    "(--merge-splits), run the processing again to append the others"
+                )
+            stages.append(Stage(
+                f"merge_{split['prefix']}_{purpose}.{window}",
+                ["ctapipe-merge", *inputs, "--output", merged_file, "--overwrite"],
+                inputs, [merged_file],
+            ))
+    return stages
+
+
+def model_stages(output_dir, window, train_cores, apply_cores, configs, model_cache=None):
+    """
+    Training, apply-models, cut optimisation and IRFs of the README, for window.
+    With model_cache (cache directory, budget [GB]), models are applied through
+    model_cache.py, reusing the predictions of unchanged models and inputs.
+    """
+    def out(name):
+        return os.path.join(output_dir, name)
+
+    def log_args(name):
+        return ["--provenance-log", out(f"{name}.provenance.log"), "--log-file", out(f"{name}.log"),
+                "--log-level", "INFO", "--overwrite"]
+
+    merged = {
+        name: out(f"{name}.{window}.dl2.h5")
+        for name in ("gamma_diffuse_merged_train_en", "gamma_diffuse_merged_train_cls",
+                     "gamma_diffuse_merged_optimize_cuts", "proton_merged_train_cls",
+                     "proton_merged_irfs", "electron_merged_irfs")
+    }
+    energy = out(f"energy_regressor_{window}.pkl")
+    classifier = out(f"particle_classifier_{window}.pkl")
+    disp = out(f"disp_reconstructor_{window}.pkl")
+    gamma_train = out(f"gamma_train_clf_{window}.dl2.h5")
+    proton_train = out(f"proton_train_clf_{window}.dl2.h5")
+    finals = {particle: out(f"{particle}_final_{window}.dl2.h5") for particle in ("gamma", "proton", "electron")}
+    cuts = out(f"cuts.{window}.fits")
+
+    def apply(name, in_file, out_file, models):
+        apply_args = ["--n-jobs", apply_cores, *log_args(f"{name}_{window}")]
+        if model_cache is None:
+            command = ["ctapipe-apply-models", "--input", in_file, "--output", out_file,
+                       *[arg for model in models for arg in ("--reconstructor", model)], *apply_args]
+        else:
+            cache_dir, budget_gb = model_cache
+            command = [sys.executable, MODEL_CACHE_SCRIPT, "--cache-dir", cache_dir, "--budget-gb", budget_gb,
+                       "--input", in_file, "--output", out_file, "--reconstructor", *models, "--", *apply_args]
+        return Stage(f"{name}.{window}", command, [in_file, *models], [out_file], cores=apply_cores)
+
+    stages = [
+        Stage(
+            f"train_energy.{window}",
+            ["ctapipe-train-energy-regressor", "--input", merged["gamma_diffuse_merged_train_en"],
+             "--output", energy, "--config", configs["energy"], "--cv-output", out(f"cv_energy_{window}.h5"),
+             "--n-jobs", train_cores, *log_args(f"train_energy_{window}")],
+            [merged["gamma_diffuse_merged_train_en"], configs["energy"]], [energy], cores=train_cores,
+        ),
+        apply("apply_gamma_train_clf", merged["gamma_diffuse_merged_train_cls"], gamma_train, [energy]),
+        apply("apply_proton_train", merged["proton_merged_train_cls"], proton_train, [energy]),
+        Stage(
+            f"train_particle.{window}",
+            ["ctapipe-train-particle-classifier", "--signal", gamma_train, "--background", proton_train,
+             "--output", classifier, "--config", configs["classifier"],
+             "--cv-output", out(f"cv_particle_{window}.h5"),
+             "--n-jobs", train_cores, *log_args(f"train_particle_{window}")],
+            [gamma_train, proton_train, configs["classifier"]], [classifier], cores=train_cores,
+        ),
+        Stage(
+            f"train_disp.{window}",
+            ["ctapipe-train-disp-reconstructor", "--input", gamma_train, "--output", disp,
+             "--config", configs["disp"], "--cv-output", out(f"cv_disp_{window}.h5"),
+             "--n-jobs", train_cores, *log_args(f"train_disp_{window}")],
+            [gamma_train, configs["disp"]], [disp], cores=train_cores,
+        ),
+        apply("apply_gamma_final", merged["gamma_diffuse_merged_optimize_cuts"], finals["gamma"],
+              [energy, classifier, disp]),
+        apply("apply_proton_final", merged["proton_merged_irfs"], finals["proton"], [energy, classifier, disp]),
+        apply("apply_electron_final", merged["electron_merged_irfs"], finals["electron"], [energy, classifier, disp]),
+        Stage(
+            f"optimize_cuts.{window}",
+            ["ctapipe-optimize-event-selection", "--config", configs["cuts"],
+             f"--gamma-file={finals['gamma']}", f"--electron-file={finals['electron']}",
+             f"--proton-file={finals['proton']}", "--output", cuts, "--overwrite"],
+            [configs["cuts"], *finals.values()], [cuts],
+        ),
+        Stage(
+            f"compute_irf.{window}",
+            ["ctapipe-compute-irf", "--config", configs["irf"], "--cuts", cuts,
+             f"--gamma-file={finals['gamma']}", f"--electron-file={finals['electron']}",
+             f"--proton-file={finals['proton']}", "--output", out(f"irf.{window}.fits"),
+             "--benchmark-output", out(f"benchmark.{window}.fits"), "--overwrite"],
+            [configs["irf"], cuts, *finals.values()], [out(f"irf.{window}.fits"), out(f"benchmark.{window}.fits")],
+        ),
+    ]
+    return stages
+
+
+class PipelineState:
+    """
+    Content hashes of the files and of the stages that succeeded, saved as JSON at path
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        state = {}
+        if self.path.exists():
+            with open(self.path) as stream:
+                state = json.load(stream)
+        # path -> dict(size, mtime_ns, sha256)
+        self.files = state.get("files", {})
+        # stage name -> dict(key, outputs={path: sha256})
+        self.stages = state.get("stages", {})
+        self.lock = threading.Lock()
+
+    def file_hash(self, path):
+        """sha256 of path, computed again only if its size or modification time changed"""
+        with self.lock:
+            entry = self.files.get(path)
+        new_entry = file_sha256_entry(path, entry)
+        if new_entry is not entry:
+            with self.lock:
+                self.files[path] = new_entry
+        return new_entry["sha256"]
+
+    def stage_key(self, stage):
+        """sha256 of the command of stage and of the content of its inputs"""
+        inputs = [(path, self.file_hash(path)) for path in stage.inputs]
+        return hashlib.sha256(json.dumps([stage.command, inputs]).encode()).hexdigest()
+
+    def is_up_to_date(self, stage, key):
+        with self.lock:
+            entry = self.stages.get(stage.name)
+        if entry is None or entry["key"] != key:
+            return False
+        return all(
+            os.path.exists(path) and self.file_hash(path) == entry["outputs"].get(path)
+            for path in stage.outputs
+        )
+
+    def record(self, stage, key):
+        outputs = {path: self.file_hash(path) for path in stage.outputs}
+        with self.lock:
+            self.stages[stage.name] = dict(key=key, outputs=outputs)
+
+    def save(self):
+        with self.lock:
+            tmp_path = self.path.with_suffix(".tmp")
+            with open(tmp_path, "w") as stream:
+                json.dump(dict(files=self.files, stages=self.stages), stream, indent=1, sort_keys=True)
+            os.replace(tmp_path, self.path)
+
+
+def run_stage(stage, state, log_dir):
+    """(status, wall time [s], error) of stage: "skipped" if up to date, else "done" or "failed" """
+    t_start = perf_counter()
+    try:
+        missing = [path for path in stage.inputs if not os.path.exists(path)]
+        if missing:
+            return "failed", perf_counter() - t_start, "missing inputs: " + ", ".join(missing)
+        key = state.stage_key(stage)
+        if state.is_up_to_date(stage, key):
+            return "skipped", perf_counter() - t_start, None
+        with open(os.path.join(log_dir, f"{stage.name}.out"), "w") as log:
+            completed = subprocess.run(stage.command, stdout=log, stderr=subprocess.STDOUT)
+        if completed.returncode != 0:
+            return "failed", perf_counter() - t_start, f"exit code {completed.returncode}, see {log.name}"
+        state.record(stage, key)
+        return "done", perf_counter() - t_start, None
+    except Exception as exc:
+        return "failed", perf_counter() - t_start, repr(exc)
+
+
+def run_pipeline(stages, state, cores, log_dir):
+    """
+    Run stages (linked, see link_stages) as their dependencies are done, using
+    at most cores (a stage using more runs alone). Returns the timing Table.
+    """
+    os.makedirs(log_dir, exist_ok=True)
+    pending = list(stages)
+    status = {}
+    rows = []
+    t_start = perf_counter()
+    with ThreadPoolExecutor(max_workers=len(stages) or 1) as pool:
+        running = {}
+        while pending or running:
+            used = sum(stage.cores for stage, _ in running.values())
+            for stage in list(pending):
+                if any(status.get(name) in ("failed", "blocked") for name in stage.after):
+                    status[stage.name] = "blocked"
+                    rows.append(dict(stage=stage.name, status="blocked", start=0., wall=0., cores=stage.cores))
+                    pending.remove(stage)
+                    continue
+                if not all(status.get(name) in ("done", "skipped") for name in stage.after):
+                    continue
+                if running and used + stage.cores > cores:
+                    continue
+                print(f"Starting {stage.name}", flush=True)
+                future = pool.submit(run_stage, stage, state, log_dir)
+                running[future] = (stage, perf_counter() - t_start)
+                used += stage.cores
+                pending.remove(stage)
+            if not running:
+                if pending:
+                    raise RuntimeError("Stages waiting for each other: " + ", ".join(stage.name for stage in pending))
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage, start = running.pop(future)
+                stage_status, wall, error = future.result()
+                status[stage.name] = stage_status
+                rows.append(dict(stage=stage.name, status=stage_status, start=start, wall=wall, cores=stage.cores))
+                print(f"{stage_status.capitalize()} {stage.name} ({wall:.0f} s)" + (f": {error}" if error else ""),
+                      flush=True)
+                state.save()
+    timing = Table(rows=[[row[name] for name in TIMING_COLUMNS] for row in rows], names=TIMING_COLUMNS,
+                   dtype=[str, str, float, float, int])
+    timing.meta["total_wall"] = perf_counter() - t_start
+    return timing
+
+
+def main():
+    parser = argparse.ArgumentParser(
+                    prog='run_pipeline',
+                    description='Merge, train, apply models, optimise cuts and compute IRFs for the std and red windows',
+                    )
+    parser.add_argument("--output-dir",default=os.environ.get("OUTPUT_DIR", "/scr/punch/CTA/Prod6/LaPalma/2025/"),
+                        help="Directory with the per-particle output directories (default $OUTPUT_DIR)")
+    parser.add_argument("--windows",nargs="+",default=["std","red"])
+    parser.add_argument("--cores",type=int,default=os.cpu_count(),help="Cores used by the stages running at the same time")
+    parser.add_argument("--train-cores",type=int,default=None,help="--n-jobs of the trainings (default: half of --cores)")
+    parser.add_argument("--apply-cores",type=int,default=2,help="--n-jobs of ctapipe-apply-models")
+    parser.add_argument("--no-merge",action="store_true",
+                        help="Use all the merged files as they are, without ctapipe-merge "
+                             "(those merged while processing, --merge-splits, are anyway)")
+    parser.add_argument("--model-cache",default=None,metavar="DIR",
+                        help="Cache the predictions of each model in DIR, to apply only changed models (see model_cache.py)")
+    parser.add_argument("--model-cache-gb",type=float,default=100.,help="Disk budget of the model cache")
+    parser.add_argument("--dataset-splits",default="dataset_splits.yml")
+    parser.add_argument("--dry-run",action="store_true",help="Only print the stages and their commands")
+    args = parser.parse_args()
+
+    train_cores = args.train_cores or max(1, args.cores // 2)
+    configs = dict(energy="train_energy_regressor.yml", classifier="train_particle_classifier.yml",
+                   disp="train_disp_reconstructor.yml", cuts="optimize_cuts.yaml", irf="compute_irf.yaml")
+    with open(args.dataset_splits) as stream:
+        dataset_splits = yaml.safe_load(stream)
+
+    stages = []
+    for window in args.windows:
+        if not args.no_merge:
+            stages += merge_stages(args.output_dir, dataset_splits, window)
+        model_cache = (args.model_cache, args.model_cache_gb) if args.model_cache is not None else None
+        stages += model_stages(args.output_dir, window, train_cores, args.apply_cores, configs, model_cache)
+    link_stages(stages)
+
+    if args.dry_run:
+        for stage in stages:
+            after = f" (after {', '.join(sorted(stage.after))})" if stage.after else ""
+            print(f"{stage.name}{after}:\n  {' '.join(stage.command)}")
+        return
+
+    state = PipelineState(os.path.join(args.output_dir, "pipeline_state.json"))
+    timing = run_pipeline(stages, state, args.cores, os.path.join(args.output_dir, "pipeline_logs"))
+    timing.write(os.path.join(args.output_dir, "pipeline_timing.ecsv"), overwrite=True)
+    print(f"{'stage':45s} {'status':>8s} {'start s':>8s} {'wall s':>8s} {'cores':>6s}")
+    for row in timing:
+        print(f"{row['stage']:45s} {row['status']:>8s} {row['start']:8.0f} {row['wall']:8.0f} {row['cores']:6d}")
+    print(f"Total {timing.meta['total_wall']:.0f} s")
+
+
+if __name__ == "__main__":
+    main()
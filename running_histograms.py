@@ -0,0 +1,217 @@
+"""
+Running histograms of the processed events (`--histograms`), for a quick
+std vs red comparison while a production is running, without waiting for the
+merging, training and IRFs
+
+For each window chain, while processing:
+
+* θ² (reconstructed vs true direction) per bin of true energy, and the number
+  of events and of validly reconstructed events per bin of true energy
+* the telescope multiplicity of the triggered events
+* the Hillas intensity per telescope type
+
+They are written in /processing/histograms/ of each output (small tables),
+and can be added over files, shards and workers: `python3
+running_histograms.py $OUT_DIR` sums them over all the outputs of each window
+written so far and prints the θ68 and reconstruction efficiency per energy bin.
+"""
+import argparse
+import os
+from glob import glob
+
+import numpy as np
+import tables
+from astropy import units as u
+from astropy.table import Table
+from ctapipe.io import read_table, write_table
+
+from theta2 import Theta2Histogram, angular_separation
+from window_names import WINDOW_SUFFIXES
+
+HISTOGRAMS_GROUP = "/processing/histograms"
+
+# log10(E / TeV), log10(θ² / deg²), log10(intensity / p.e.): (low, high, number of bins)
+ENERGY_BINS = (-2.0, 2.5, 18)
+# θ from 0.003° to 3.2°, 20 bins per decade of θ² (6 % in θ): θ68 is above 1° at the lowest energies
+THETA2_BINS = (-5.0, 1.0, 120)
+INTENSITY_BINS = (0.0, 6.0, 60)
+
+
+def _bin_index(value, bins):
+    """Bin of value in the uniform bins (low, high, n): -1 below (or nan), n above"""
+    low, high, n_bins = bins
+    if not value >= low:
+        return -1
+    return min(int((value - low) / (high - low) * n_bins), n_bins)
+
+
+def _edges(bins):
+    low, high, n_bins = bins
+    return np.linspace(low, high, n_bins + 1)
+
+
+class RunningHistograms:
+    """
+    Histograms of the events offered (after reconstruction), see the module
+    docstring. The under- and overflows are in the first and last entry of
+    each histogram.
+    """
+
+    def __init__(self, tel_types, reconstructor="HillasReconstructor"):
+        # {tel_id: telescope type}
+        self.tel_types = dict(tel_types)
+        self.reconstructor = reconstructor
+        n_energy = ENERGY_BINS[2] + 2
+        self.n_events = np.zeros(n_energy, dtype=np.int64)
+        self.n_valid = np.zeros(n_energy, dtype=np.int64)
+        self.theta2 = np.zeros((n_energy, THETA2_BINS[2] + 2), dtype=np.int64)
+        self.multiplicity = np.zeros(len(self.tel_types) + 1, dtype=np.int64)
+        self.intensity = {
+            tel_type: np.zeros(INTENSITY_BINS[2] + 2, dtype=np.int64)
+            for tel_type in sorted(set(self.tel_types.values()))
+        }
+
+    @classmethod
+    def from_subarray(cls, subarray, reconstructor="HillasReconstructor"):
+        return cls({tel_id: str(tel) for tel_id, tel in subarray.tel.items()}, reconstructor)
+
+    def offer(self, event):
+        """Add event (after reconstruction)"""
+        shower = event.simulation.shower if event.simulation is not None else None
+        log_energy = np.log10(shower.energy.to_value(u.TeV)) if shower is not None else np.nan
+        num_energy = _bin_index(log_energy, ENERGY_BINS) + 1
+        self.n_events[num_energy] += 1
+
+        geometry = event.dl2.stereo.geometry.get(self.reconstructor)
+        if geometry is not None and geometry.is_valid and shower is not None:
+            self.n_valid[num_energy] += 1
+            theta = angular_separation(
+                geometry.az.to_value(u.rad), geometry.alt.to_value(u.rad),
+                shower.az.to_value(u.rad), shower.alt.to_value(u.rad),
+            )
+            theta2 = np.rad2deg(theta) ** 2
+            log_theta2 = np.log10(theta2) if theta2 > 0 else -np.inf
+            self.theta2[num_energy, _bin_index(log_theta2, THETA2_BINS) + 1] += 1
+
+        self.multiplicity[min(len(event.trigger.tels_with_trigger), len(self.multiplicity) - 1)] += 1
+        for tel_id, dl1 in event.dl1.tel.items():
+            intensity = dl1.parameters.hillas.intensity
+            log_intensity = np.log10(intensity) if intensity > 0 else np.nan
+            self.intensity[self.tel_types[tel_id]][_bin_index(log_intensity, INTENSITY_BINS) + 1] += 1
+
+    def merge(self, other):
+        """Add the histograms of other (e.g. another shard or file)"""
+        self.n_events += other.n_events
+        self.n_valid += other.n_valid
+        self.theta2 += other.theta2
+        if len(other.multiplicity) > len(self.multiplicity):
+            self.multiplicity = np.pad(self.multiplicity, (0, len(other.multiplicity) - len(self.multiplicity)))
+        self.multiplicity[:len(other.multiplicity)] += other.multiplicity
+        for tel_type, counts in other.intensity.items():
+            if tel_type in self.intensity:
+                self.intensity[tel_type] += counts
+            else:
+                self.intensity[tel_type] = counts.copy()
+
+    def to_tables(self):
+        """{name: Table} as written in HISTOGRAMS_GROUP"""
+        energy_edges = 10 ** _edges(ENERGY_BINS)
+        energy = Table({
+            "energy_min": np.concatenate([[0], energy_edges]) * u.TeV,
+            "energy_max": np.concatenate([energy_edges, [np.inf]]) * u.TeV,
+            "n_events": self.n_events,
+            "n_valid": self.n_valid,
+            "theta2_counts": self.theta2,
+        })
+        energy.meta.update(reconstructor=self.reconstructor,
+                           log10_theta2_low=THETA2_BINS[0], log10_theta2_high=THETA2_BINS[1],
+                           theta2_n_bins=THETA2_BINS[2])
+        multiplicity = Table({
+            "multiplicity": np.arange(len(self.multiplicity)),
+            "n_events": self.multiplicity,
+        })
+        intensity = Table({
+            "tel_type": list(self.intensity),
+            "counts": np.array(list(self.intensity.values())).reshape(len(self.intensity), INTENSITY_BINS[2] + 2),
+        })
+        intensity.meta.update(log10_low=INTENSITY_BINS[0], log10_high=INTENSITY_BINS[1], n_bins=INTENSITY_BINS[2])
+        return dict(energy=energy, multiplicity=multiplicity, intensity=intensity)
+
+    def write(self, out_file):
+        """Write the histograms in out_file (HISTOGRAMS_GROUP)"""
+        for name, table in self.to_tables().items():
+            write_table(table, out_file, f"{HISTOGRAMS_GROUP}/{name}", overwrite=True)
+
+    @classmethod
+    def read(cls, out_file):
+        """RunningHistograms written in out_file"""
+        energy = read_table(out_file, f"{HISTOGRAMS_GROUP}/energy")
+        multiplicity = read_table(out_file, f"{HISTOGRAMS_GROUP}/multiplicity")
+        intensity = read_table(out_file, f"{HISTOGRAMS_GROUP}/intensity")
+        theta2_bins = tuple(energy.meta.get(key) for key in ("log10_theta2_low", "log10_theta2_high", "theta2_n_bins"))
+        if theta2_bins != THETA2_BINS:
+            raise ValueError(f"{out_file}: θ² bins {theta2_bins} rather than {THETA2_BINS}")
+        histograms = cls({}, energy.meta["reconstructor"])
+        histograms.n_events = np.asarray(energy["n_events"])
+        histograms.n_valid = np.asarray(energy["n_valid"])
+        histograms.theta2 = np.asarray(energy["theta2_counts"])
+        histograms.multiplicity = np.asarray(multiplicity["n_events"])
+        histograms.intensity = {str(row["tel_type"]): np.asarray(row["counts"]) for row in intensity}
+        return histograms
+
+    def theta2_histogram(self, num_energy):
+        """Theta2Histogram (see theta2.py) of the energy bin num_energy (0: underflow)"""
+        # The underflow as the first bin, from θ² = 0
+        histogram = Theta2Histogram(np.concatenate([[0.], 10 ** _edges(THETA2_BINS)]), self.reconstructor)
+        histogram.counts = self.theta2[num_energy, :-1].copy()
+        histogram.overflow = int(self.theta2[num_energy, -1])
+        histogram.n_invalid = int(self.n_events[num_energy] - self.n_valid[num_energy])
+        return histogram
+
+
+def sum_histograms(out_files):
+    """RunningHistograms summed over out_files, None if none has them"""
+    total = None
+    for out_file in out_files:
+        try:
+            histograms = RunningHistograms.read(out_file)
+        except (tables.NoSuchNodeError, KeyError):
+            # Processed without --histograms
+            continue
+        if total is None:
+            total = histograms
+        else:
+            total.merge(histograms)
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(
+                    prog='running_histograms',
+                    description='θ68 and reconstruction efficiency per true energy, summed over the outputs of each window',
+                    )
+    parser.add_argument("out_dir")
+    parser.add_argument("--windows",nargs="+",default=["std","red"])
+    args = parser.parse_args()
+
+    energy_edges = 10 ** _edges(ENERGY_BINS)
+    for window in args.windows:
+        out_files = sorted(glob(os.path.join(args.out_dir, "*" + WINDOW_SUFFIXES.get(window, f".{window}.h5"))))
+        histograms = sum_histograms(out_files)
+        if histograms is None:
+            print(f"{window}: no histograms in {len(out_files)} outputs")
+            continue
+        print(f"{window}: {histograms.n_events.sum()} events")
+        print(f"  {'E min TeV':>10s} {'E max TeV':>10s} {'events':>9s} {'valid':>6s} {'θ68 deg':>8s}")
+        for num_energy in range(1, len(energy_edges)):
+            n_events = histograms.n_events[num_energy]
+            if n_events == 0:
+                continue
+            efficiency = histograms.n_valid[num_energy] / n_events
+            theta68 = histograms.theta2_histogram(num_energy).containment(0.68)
+            print(f"  {energy_edges[num_energy-1]:10.3g} {energy_edges[num_energy]:10.3g} {n_events:9d} "
+                  f"{efficiency:6.2f} {theta68:8.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Sample events for the plots of Make_reduced_Readout_window_file.py (`--sample-events N`)
+
+Rather than a copy of a whole event (waveforms and all) kept for the
+ArrayDisplay plot, a reservoir of at most N events with many triggered
+telescopes is kept while processing, each with only the fields needed by the
+plot: per telescope the Hillas intensity and psi and the core psi, and the
+true and reconstructed impact. It is written in /processing/sample_events of
+each output, one row per telescope event.
+"""
+import numpy as np
+import tables
+from astropy import units as u
+from astropy.table import Table
+from ctapipe.containers import HillasParametersContainer
+from ctapipe.io import read_table, write_table
+
+SAMPLE_EVENTS_TABLE = "/processing/sample_events"
+
+COLUMNS = {
+    "obs_id": (np.int32, None),
+    "event_id": (np.int64, None),
+    "tel_id": (np.int16, None),
+    "hillas_intensity": (np.float32, None),
+    "hillas_psi": (np.float32, u.deg),
+    "core_psi": (np.float32, u.deg),
+    "true_core_x": (np.float32, u.m),
+    "true_core_y": (np.float32, u.m),
+    "reco_core_x": (np.float32, u.m),
+    "reco_core_y": (np.float32, u.m),
+    "array_azimuth": (np.float32, u.deg),
+}
+
+
+class EventReservoir:
+    """
+    Uniform random sample (reservoir sampling) of at most size of the events
+    offered with at least min_tels triggered telescopes.
+
+    Reservoirs with the same seed offered the same events (e.g. the window
+    chains of a file) keep the same events.
+    """
+
+    def __init__(self, size, min_tels=10, seed=0, reconstructor="HillasReconstructor"):
+        self.size = size
+        self.min_tels = min_tels
+        self.reconstructor = reconstructor
+        self.rng = np.random.default_rng(seed)
+        self.n_seen = 0
+        # slot -> rows of the event kept there
+        self.samples = []
+
+    def offer(self, event):
+        """Consider event (after reconstruction), only its plotted fields are kept"""
+        if len(event.trigger.tels_with_trigger) < self.min_tels:
+            return
+        self.n_seen += 1
+        if len(self.samples) < self.size:
+            self.samples.append(self._rows(event))
+            return
+        slot = self.rng.integers(self.n_seen)
+        if slot < self.size:
+            self.samples[slot] = self._rows(event)
+
+    def _rows(self, event):
+        shower = event.simulation.shower if event.simulation is not None else None
+        geometry = event.dl2.stereo.geometry.get(self.reconstructor)
+        common = dict(
+            obs_id=event.index.obs_id,
+            event_id=event.index.event_id,
+            true_core_x=shower.core_x.to_value(u.m) if shower is not None else np.nan,
+            true_core_y=shower.core_y.to_value(u.m) if shower is not None else np.nan,
+            reco_core_x=geometry.core_x.to_value(u.m) if geometry is not None else np.nan,
+            reco_core_y=geometry.core_y.to_value(u.m) if geometry is not None else np.nan,
+            array_azimuth=event.pointing.array_azimuth.to_value(u.deg),
+        )
+        return [
+            dict(
+                common,
+                tel_id=tel_id,
+                hillas_intensity=dl1.parameters.hillas.intensity,
+                hillas_psi=dl1.parameters.hillas.psi.to_value(u.deg),
+                core_psi=dl1.parameters.core.psi.to_value(u.deg),
+            )
+            for tel_id, dl1 in event.dl1.tel.items()
+        ]
+
+    def merge(self, other):
+        """
+        Add the events of other (e.g. another shard), keeping a uniform sample
+        of the events seen by both.
+        """
+        pool = self.samples + other.samples
+        if len(pool) > self.size:
+            # Each kept event stands for n_seen / len(samples) events of its reservoir
+            weights = np.array(
+                [self.n_seen / len(self.samples)] * len(self.samples)
+                + [other.n_seen / len(other.samples)] * len(other.samples)
+            )
+            keep = self.rng.choice(len(pool), self.size, replace=False, p=weights / weights.sum())
+            pool = [pool[num] for num in sorted(keep)]
+        self.samples = pool
+        self.n_seen += other.n_seen
+
+    def to_table(self):
+        rows = [row for rows in self.samples for row in rows]
+        table = Table(
+            {name: np.array([row[name] for row in rows], dtype=dtype) for name, (dtype, _) in COLUMNS.items()}
+        )
+        for name, (_, unit) in COLUMNS.items():
+            if unit is not None:
+                table[name].unit = unit
+        table.meta["n_seen"] = self.n_seen
+        table.meta["min_tels"] = self.min_tels
+        return table
+
+    def write(self, out_file):
+        """Write the sample in out_file (SAMPLE_EVENTS_TABLE)"""
+        write_table(self.to_table(), out_file, SAMPLE_EVENTS_TABLE, overwrite=True)
+
+
+def read_sample_events(out_file):
+    """Table of the sample events of out_file, None if there are none"""
+    try:
+        return read_table(out_file, SAMPLE_EVENTS_TABLE)
+    except (tables.NoSuchNodeError, KeyError):
+        return None
+
+
+def plotting_event(table, num_event=0):
+    """
+    (hillas, core_psi, true_core, reco_core) of the sample event number
+    num_event of table, as needed by ArrayDisplay.set_line_hillas and the
+    impact markers: {tel_id: HillasParametersContainer}, {tel_id: psi}, (x, y), (x, y)
+    """
+    events = table.group_by(["obs_id", "event_id"])
+    rows = events.groups[num_event]
+    hillas = {
+        row["tel_id"]: HillasParametersContainer(intensity=row["hillas_intensity"], psi=row["hillas_psi"] * u.deg)
+        for row in rows
+    }
+    core_psi = {row["tel_id"]: row["core_psi"] * u.deg for row in rows}
+    true_core = (rows["true_core_x"][0] * u.m, rows["true_core_y"][0] * u.m)
+    reco_core = (rows["reco_core_x"][0] * u.m, rows["reco_core_y"][0] * u.m)
+    return hillas, core_psi, true_core, reco_core
@@ -0,0 +1,114 @@
+"""
+Merging the per-run outputs into the per-purpose DL2 files while processing
+
+Replaces the `ls ... | split -n 4` and `ctapipe-merge` steps of the README:
+the sorted simtel files of a particle are split into datasets following
+dataset_splits.yml (e.g. gamma-diffuse 4x10: train_en, train_cls,
+optimize_cuts, irfs), and each output is appended to its merged file
+(<prefix>_merged_<purpose>.<std|red>.dl2.h5, as in the README) as soon as it
+is written, while it is still in the page cache, rather than in a second pass
+over all the files on the shared filesystem.
+
+The manifest (see manifest.py) records which outputs are merged, so that on
+restart outputs already written are appended once, and a merged file left
+half-appended by a killed job is rebuilt.
+"""
+import os
+from pathlib import Path
+
+import numpy as np
+from ctapipe.io import HDF5Merger
+
+
+def assign_splits(simtel_files, splits):
+    """
+    {file name: purpose}, splitting the sorted files into consecutive groups of
+    the sizes in splits ([[purpose, n_files], ...]), scaled if the number of
+    files is not the same.
+    """
+    files = sorted(Path(in_file).name for in_file in simtel_files)
+    n_files = np.array([n for _, n in splits])
+    ends = np.round(np.cumsum(n_files) / n_files.sum() * len(files)).astype(int)
+    starts = np.concatenate([[0], ends[:-1]])
+    return {
+        name: purpose
+        for (purpose, _), start, end in zip(splits, starts, ends)
+        for name in files[start:end]
+    }
+
+
+class StreamingMerger:
+    """
+    Appends the outputs of each simtel file into the merged file of its dataset
+    """
+
+    def __init__(self, dataset_splits, particle, simtel_files, merged_dir, manifest):
+        self.prefix = dataset_splits[particle]["prefix"]
+        self.purposes = assign_splits(simtel_files, dataset_splits[particle]["splits"])
+        self.merged_dir = merged_dir
+        self.manifest = manifest
+
+    def merged_file_name(self, in_file, window):
+        purpose = self.purposes[Path(in_file).name]
+        return os.path.join(self.merged_dir, f"{self.prefix}_merged_{purpose}.{window}.dl2.h5")
+
+    def _append(self, in_file, out_file, merged_file):
+        self.manifest.record_merge(in_file, out_file, merged_file, "merging")
+        exists = os.path.exists(merged_file)
+        with HDF5Merger(output_path=merged_file, append=exists, overwrite=False) as merger:
+            merger(out_file)
+        self.manifest.record_merge(in_file, out_file, merged_file, "merged")
+
+    def _outputs_of(self, merged_file):
+        """(in_file, out_file, entry) of the outputs recorded as merged (or merging) in merged_file"""
+        merged_name = Path(merged_file).name
+        for file_entry in self.manifest.files.values():
+            for out_name, entry in file_entry["outputs"].items():
+                if entry.get("merged_into") == merged_name:
+                    out_file = os.path.join(os.path.dirname(self.manifest.path), out_name)
+                    yield file_entry["in_file"], out_file, entry
+
+    def _rebuild(self, merged_file):
+        """Merge again all done outputs of merged_file, e.g. after an interrupted append"""
+        print(f"Rebuilding {merged_file}")
+        if os.path.exists(merged_file):
+            os.remove(merged_file)
+        outputs = list(self._outputs_of(merged_file))
+        for in_file, out_file, _ in outputs:
+            self.manifest.record_merge(in_file, out_file, merged_file, None)
+        for in_file, out_file, entry in outputs:
+            if entry["status"] == "done":
+                self._append(in_file, out_file, merged_file)
+
+    def append(self, in_file, out_files):
+        """Append the outputs ({window: out_file}) of in_file to their merged files, if not done yet"""
+        for window, out_file in out_files.items():
+            merged_file = self.merged_file_name(in_file, window)
+            entry = self.manifest.output_entry(in_file, out_file)
+            if entry is None or entry["status"] != "done" or entry.get("merge") == "merged":
+                continue
+            if entry.get("merge") in ("merging", "rebuild"):
+                self._rebuild(merged_file)
+            else:
+                self._append(in_file, out_file, merged_file)
+
+    def catch_up(self, windows, out_file_name):
+        """
+        Before processing: rebuild merged files left half-appended, and append
+        the outputs already done but not merged yet. out_file_name(in_file, window)
+        gives the output of in_file.
+        """
+        to_rebuild = set()
+        for file_entry in self.manifest.files.values():
+            for entry in file_entry["outputs"].values():
+                if entry.get("merge") in ("merging", "rebuild"):
+                    to_rebuild.add(os.path.join(self.merged_dir, entry["merged_into"]))
+        for merged_file in sorted(to_rebuild):
+            self._rebuild(merged_file)
+
+        for in_name in sorted(self.purposes):
+            file_entry = self.manifest.files.get(in_name)
+            if file_entry is None:
+                continue
+            in_file = file_entry["in_file"]
+            self.append(in_file, {window: out_file_name(in_file, window) for window in windows})
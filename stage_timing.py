@@ -0,0 +1,212 @@
+"""
+Timing of the stages of the event loop (source, software_trigger, peak_finder
+for per-event windows, reducer, calibrator, image_processor, shower_processor,
+writer), to see whether the reduced window really speeds up the calibration,
+not only what it does to the IRFs.
+
+Each stage keeps running sums of its wall and CPU time, and a histogram of
+the wall time per event (log bins) for the median and 95th percentile, so
+that the timers stay small for any number of events. With by_type
+(`--timing-by-type`), the calibrator and the image processor are also timed
+per telescope type (e.g. LST vs MST-NectarCam), running them on the
+telescopes of each type of the event in turn; this adds some overhead to each
+event, so it is off by default.
+"""
+from contextlib import contextmanager
+from time import perf_counter, process_time
+
+import numpy as np
+from astropy.table import Table, vstack
+from ctapipe.io import write_table
+
+TIMING_TABLE = "/processing/stage_timing"
+
+# Edges of the bins of the wall time per event [s], 20 per decade from 100 ns to 1000 s
+# (quantiles within ~6 %)
+TIME_BINS = np.logspace(-7, 3, 201)
+
+
+class StageTimes:
+    """Running wall and CPU time of one stage, with a histogram of the wall time per event"""
+
+    def __init__(self):
+        self.n = 0
+        self.wall = 0.
+        self.cpu = 0.
+        self.wall_max = 0.
+        # Below the first edge, between the edges, above the last one
+        self.wall_hist = np.zeros(len(TIME_BINS) + 1, dtype=np.int64)
+
+    def add(self, wall, cpu):
+        self.n += 1
+        self.wall += wall
+        self.cpu += cpu
+        self.wall_max = max(self.wall_max, wall)
+        self.wall_hist[np.searchsorted(TIME_BINS, wall)] += 1
+
+    def merge(self, other):
+        self.n += other.n
+        self.wall += other.wall
+        self.cpu += other.cpu
+        self.wall_max = max(self.wall_max, other.wall_max)
+        self.wall_hist += other.wall_hist
+
+    def wall_quantile(self, q):
+        """Quantile q of the wall time per event [s], interpolated (log) in its bin"""
+        if self.n == 0:
+            return np.nan
+        cumulative = np.cumsum(self.wall_hist)
+        index = int(np.searchsorted(cumulative, q * self.n))
+        lower = TIME_BINS[max(index - 1, 0)]
+        upper = TIME_BINS[min(index, len(TIME_BINS) - 1)]
+        below = cumulative[index - 1] if index > 0 else 0
+        fraction = (q * self.n - below) / self.wall_hist[index]
+        return min(lower * (upper / lower) ** fraction, self.wall_max)
+
+
+@contextmanager
+def only_telescopes(event, tel_ids):
+    """
+    event with only tel_ids in its r1, dl0 and dl1 telescopes (which the
+    calibrator and image processor loop over), the telescopes they add
+    being kept afterwards
+    """
+    levels = (event.r1, event.dl0, event.dl1)
+    all_tels = [level.tel for level in levels]
+    for level, tel in zip(levels, all_tels):
+        level.tel = type(tel)(tel.default_factory, {tel_id: tel[tel_id] for tel_id in tel_ids if tel_id in tel})
+    try:
+        yield event
+    finally:
+        for level, tel in zip(levels, all_tels):
+            tel.update(level.tel)
+            level.tel = tel
+
+
+class StageTimer:
+    """
+    Cumulative wall and CPU time per stage (and per-event quantiles), and per telescope type
+
+    e.g.
+        with timer.stage("shower_processor"):
+            shower_processor(event)
+        timer.stage_by_type("calibrator", event, calibrator)
+    """
+
+    def __init__(self, subarray, name="", throughput_interval=None, by_type=False):
+        self.name = name
+        self.split_by_type = by_type
+        self.tel_types = {tel_id: str(tel) for tel_id, tel in subarray.tel.items()}
+        # stage -> StageTimes
+        self.stages = {}
+        # (stage, tel_type) -> [wall [s], cpu [s], number of telescope events]
+        self.by_type = {}
+
+        self.n_events = 0
+        self.throughput_interval = throughput_interval
+        self._t_start = self._t_last = perf_counter()
+        self._n_last = 0
+
+    @contextmanager
+    def stage(self, name):
+        """Time the block as stage name"""
+        wall_start = perf_counter()
+        cpu_start = process_time()
+        try:
+            yield
+        finally:
+            wall = perf_counter() - wall_start
+            cpu = process_time() - cpu_start
+            if name not in self.stages:
+                self.stages[name] = StageTimes()
+            self.stages[name].add(wall, cpu)
+
+    def stage_by_type(self, name, event, process):
+        """
+        process(event) timed as stage name, with by_type run on the telescopes
+        of each type of event in turn (see only_telescopes) to time it per
+        telescope type
+        """
+        if not self.split_by_type:
+            with self.stage(name):
+                process(event)
+            return
+        tel_ids_by_type = {}
+        for tel_id in sorted({*event.r1.tel, *event.dl0.tel, *event.dl1.tel}):
+            tel_ids_by_type.setdefault(self.tel_types[tel_id], []).append(tel_id)
+        with self.stage(name):
+            for tel_type, tel_ids in tel_ids_by_type.items():
+                wall_start = perf_counter()
+                cpu_start = process_time()
+                with only_telescopes(event, tel_ids):
+                    process(event)
+                times = self.by_type.setdefault((name, tel_type), [0., 0., 0])
+                times[0] += perf_counter() - wall_start
+                times[1] += process_time() - cpu_start
+                times[2] += len(tel_ids)
+
+    def event_done(self):
+        """Count an event, printing the throughput every throughput_interval seconds"""
+        self.n_events += 1
+        if self.throughput_interval is None:
+            return
+        now = perf_counter()
+        if now - self._t_last >= self.throughput_interval:
+            rate = (self.n_events - self._n_last) / (now - self._t_last)
+            mean_rate = self.n_events / (now - self._t_start)
+            print(f"{self.name}: {self.n_events} events, {rate:.1f} events/s "
+                  f"(mean {mean_rate:.1f} events/s)", flush=True)
+            self._t_last = now
+            self._n_last = self.n_events
+
+    def merge(self, other):
+        """Add the times of other (e.g. from another shard) to this one"""
+        for name, times in other.stages.items():
+            self.stages.setdefault(name, StageTimes()).merge(times)
+        for key, (wall, cpu, n_tel_events) in other.by_type.items():
+            times = self.by_type.setdefault(key, [0., 0., 0])
+            times[0] += wall
+            times[1] += cpu
+            times[2] += n_tel_events
+        self.n_events += other.n_events
+
+    def totals(self):
+        """stage -> total wall time [s]"""
+        return {name: times.wall for name, times in self.stages.items()}
+
+    def to_table(self):
+        """
+        One row per stage (tel_type "all", with per-event statistics), then
+        one row per stage and telescope type (per telescope event mean).
+        """
+        rows = []
+        for name, times in self.stages.items():
+            rows.append(dict(
+                chain=self.name, stage=name, tel_type="all", n=times.n,
+                wall_total_s=times.wall, cpu_total_s=times.cpu,
+                wall_mean_ms=times.wall / times.n * 1e3, cpu_mean_ms=times.cpu / times.n * 1e3,
+                wall_median_ms=times.wall_quantile(0.5) * 1e3,
+                wall_p95_ms=times.wall_quantile(0.95) * 1e3,
+                wall_max_ms=times.wall_max * 1e3,
+            ))
+        for (name, tel_type), (wall, cpu, n_tel_events) in sorted(self.by_type.items()):
+            rows.append(dict(
+                chain=self.name, stage=name, tel_type=tel_type, n=n_tel_events,
+                wall_total_s=wall, cpu_total_s=cpu,
+                wall_mean_ms=wall / n_tel_events * 1e3, cpu_mean_ms=cpu / n_tel_events * 1e3,
+                wall_median_ms=np.nan, wall_p95_ms=np.nan, wall_max_ms=np.nan,
+            ))
+
+        names = ["chain", "stage", "tel_type", "n", "wall_total_s", "cpu_total_s",
+                 "wall_mean_ms", "cpu_mean_ms", "wall_median_ms", "wall_p95_ms", "wall_max_ms"]
+        table = Table(rows=rows, names=names) if rows else Table(names=names, dtype=[str, str, str, int] + [float] * 7)
+        table.meta["comment"] = (
+            "Per telescope type times are measured running the stage on the telescopes of each type in turn"
+        )
+        return table
+
+
+def write_timing(out_file, *timers):
+    """Write the timing tables of timers in out_file (TIMING_TABLE)"""
+    table = vstack([timer.to_table() for timer in timers], metadata_conflicts="silent")
+    write_table(table, out_file, TIMING_TABLE, overwrite=True)
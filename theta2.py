@@ -0,0 +1,175 @@
+"""
+θ² distributions of the outputs, read column by column (see the "Show some
+results" section of Make_reduced_Readout_window_file.py)
+
+Rather than TableLoader, which reads whole tables of one file into astropy
+tables, only the reconstructed and true directions are read, in chunks of
+rows, from the HDF5 tables of any number of outputs, and θ² is accumulated
+in a fixed-binning histogram with plain numpy: the memory used does not depend
+on the number of files, so a std vs red comparison can run over a whole
+production.
+
+e.g.
+    python3 theta2.py $OUT_DIR --windows std red
+"""
+import argparse
+import os
+from glob import glob
+
+import numpy as np
+import tables
+from astropy import units as u
+
+from window_names import WINDOW_SUFFIXES
+
+SHOWER_TABLE = "/simulation/event/subarray/shower"
+GEOMETRY_TABLE = "/dl2/event/subarray/geometry/{reconstructor}"
+
+# As the histogram of the notebook, in deg²
+THETA2_BINS = np.linspace(0, 0.1, 501)
+
+CHUNK_ROWS = 100_000
+
+
+def column_unit(table, column):
+    """Unit of column in table, as written by ctapipe (FIELD_<n>_NAME, CTAFIELD_<n>_UNIT)"""
+    attrs = table.attrs
+    for name in attrs._v_attrnames:
+        if name.startswith("FIELD_") and name.endswith("_NAME") and attrs[name] == column:
+            unit_attr = "CTA" + name[:-len("NAME")] + "UNIT"
+            if unit_attr in attrs:
+                return u.Unit(attrs[unit_attr])
+    return u.dimensionless_unscaled
+
+
+def read_chunks(table, columns, chunk_rows=CHUNK_ROWS):
+    """{column: array} of chunk_rows rows at a time of the columns of table, angles in radians"""
+    units = {column: column_unit(table, column) for column in columns}
+    scales = {column: unit.to(u.rad) if unit.physical_type == "angle" else 1 for column, unit in units.items()}
+    for start in range(0, table.nrows, chunk_rows):
+        stop = min(start + chunk_rows, table.nrows)
+        yield {column: table.read(start, stop, field=column) * scale for column, scale in scales.items()}
+
+
+def angular_separation(lon1, lat1, lon2, lat2):
+    """Angular separation [rad] of arrays of directions [rad] (Vincenty formula, as astropy)"""
+    sdlon = np.sin(lon2 - lon1)
+    cdlon = np.cos(lon2 - lon1)
+    slat1, slat2 = np.sin(lat1), np.sin(lat2)
+    clat1, clat2 = np.cos(lat1), np.cos(lat2)
+    num1 = clat2 * sdlon
+    num2 = clat1 * slat2 - slat1 * clat2 * cdlon
+    denominator = slat1 * slat2 + clat1 * clat2 * cdlon
+    return np.arctan2(np.hypot(num1, num2), denominator)
+
+
+class Theta2Histogram:
+    """
+    Histogram of θ² [deg²] between the reconstructed and true directions,
+    filled file by file. Events beyond the last bin are counted in overflow,
+    those not reconstructed (nan direction) in n_invalid.
+    """
+
+    def __init__(self, bins=THETA2_BINS, reconstructor="HillasReconstructor"):
+        self.bins = np.asarray(bins)
+        self.reconstructor = reconstructor
+        self.counts = np.zeros(len(self.bins) - 1, dtype=np.int64)
+        self.overflow = 0
+        self.n_invalid = 0
+        self.n_files = 0
+
+    @property
+    def n_events(self):
+        return int(self.counts.sum()) + self.overflow + self.n_invalid
+
+    def fill(self, theta2):
+        """Add the θ² [deg²] of some events"""
+        valid = np.isfinite(theta2)
+        self.n_invalid += int(np.count_nonzero(~valid))
+        theta2 = theta2[valid]
+        self.counts += np.histogram(theta2, self.bins)[0]
+        self.overflow += int(np.count_nonzero(theta2 > self.bins[-1]))
+
+    def fill_file(self, out_file, chunk_rows=CHUNK_ROWS):
+        """
+        Add the events of out_file, reading chunk_rows rows at a time. The
+        geometry and shower tables are written one row per event, in the same
+        order, by DataWriter (and kept so by HDF5Merger).
+        """
+        prefix = self.reconstructor
+        with tables.open_file(out_file) as h5file:
+            geometry = h5file.get_node(GEOMETRY_TABLE.format(reconstructor=prefix))
+            shower = h5file.get_node(SHOWER_TABLE)
+            if geometry.nrows != shower.nrows:
+                raise ValueError(f"{out_file}: {geometry.nrows} reconstructed events but {shower.nrows} simulated")
+            reco_chunks = read_chunks(geometry, ["event_id", f"{prefix}_az", f"{prefix}_alt"], chunk_rows)
+            true_chunks = read_chunks(shower, ["event_id", "true_az", "true_alt"], chunk_rows)
+            for reco, true in zip(reco_chunks, true_chunks):
+                if not np.array_equal(reco["event_id"], true["event_id"]):
+                    raise ValueError(f"{out_file}: events of {geometry._v_pathname} and {SHOWER_TABLE} not in the same order")
+                theta = angular_separation(reco[f"{prefix}_az"], reco[f"{prefix}_alt"], true["true_az"], true["true_alt"])
+                self.fill(np.rad2deg(theta) ** 2)
+        self.n_files += 1
+
+    def add(self, other):
+        """Add the events of another histogram (e.g. of other files) with the same bins"""
+        if not np.array_equal(self.bins, other.bins):
+            raise ValueError("Histograms with different bins")
+        self.counts += other.counts
+        self.overflow += other.overflow
+        self.n_invalid += other.n_invalid
+        self.n_files += other.n_files
+
+    def containment(self, fraction=0.68):
+        """
+        θ [deg] containing fraction of the reconstructed events (upper edge of
+        the bin where it is reached), nan if beyond the bins
+        """
+        n_valid = self.counts.sum() + self.overflow
+        if n_valid == 0:
+            return np.nan
+        cumulative = np.cumsum(self.counts)
+        num_bin = np.searchsorted(cumulative, fraction * n_valid)
+        if num_bin >= len(self.counts):
+            return np.nan
+        return float(np.sqrt(self.bins[num_bin + 1]))
+
+
+def theta2_histogram(out_files, bins=THETA2_BINS, reconstructor="HillasReconstructor", chunk_rows=CHUNK_ROWS):
+    """Theta2Histogram of all events of out_files"""
+    histogram = Theta2Histogram(bins, reconstructor)
+    for out_file in out_files:
+        histogram.fill_file(out_file, chunk_rows)
+    return histogram
+
+
+def window_histograms(out_dir, windows=("std", "red"), **kwargs):
+    """{window: Theta2Histogram of all the outputs of window in out_dir}"""
+    return {
+        window: theta2_histogram(sorted(glob(os.path.join(out_dir, "*" + WINDOW_SUFFIXES.get(window, f".{window}.h5")))),
+                                 **kwargs)
+        for window in windows
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+                    prog='theta2',
+                    description='θ² distributions of all the outputs of each window in OUT_DIR',
+                    )
+    parser.add_argument("out_dir")
+    parser.add_argument("--windows",nargs="+",default=["std","red"])
+    parser.add_argument("--reconstructor",default="HillasReconstructor")
+    parser.add_argument("--chunk-rows",type=int,default=CHUNK_ROWS)
+    args = parser.parse_args()
+
+    histograms = window_histograms(args.out_dir, args.windows, reconstructor=args.reconstructor,
+                                   chunk_rows=args.chunk_rows)
+    print(f"{'window':10s} {'files':>6s} {'events':>9s} {'invalid':>8s} {'θ68 deg':>8s}")
+    for window, histogram in histograms.items():
+        print(f"{window:10s} {histogram.n_files:6d} {histogram.n_events:9d} {histogram.n_invalid:8d} "
+              f"{histogram.containment(0.68):8.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,14 @@
+"""
+Names of the windows in the output files, shared by the processing
+(file_processing.py) and the tools reading its outputs, which don't need the
+processing itself.
+"""
+
+WINDOW_SUFFIXES = {
+    "std": ".stdwindow.h5",
+    "red": ".redwindow.h5",
+}
+
+
+# Name of the window in the outputs of the scan (see window_scan.yml)
+SCAN_PREFIX = "scan_"